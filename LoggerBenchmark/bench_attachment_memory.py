@@ -0,0 +1,61 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_attachment_memory
+内存附件与流式文件附件在序列化发送时的内存峰值对比
+"""
+# Python内置库
+import os
+import pathlib
+import tempfile
+import tracemalloc
+
+# 项目内部库
+from DataVision.LoggerNotification.EmailNotification import make_message, make_streaming_message
+
+# 附件大小(MB)
+SIZES = (4, 16, 64)
+
+
+def _in_memory(path: str) -> int:
+    with open(path, 'rb') as f:
+        data = f.read()
+    message = make_message(sender="vision@localhost", targets="alert@localhost", subject="report",
+                           content="report", attachments={"report.bin": data}, part_cache=None)
+    # aiosmtplib发送前会把整封邮件序列化为bytes
+    return len(message.as_bytes())
+
+
+def _streaming(path: str) -> int:
+    message = make_streaming_message(sender="vision@localhost", targets="alert@localhost",
+                                     subject="report", content="report",
+                                     attachments={"report.bin": pathlib.Path(path)})
+    return sum(len(chunk) for chunk in message.iter_chunks())
+
+
+def _peak(func, path: str) -> tuple:
+    tracemalloc.start()
+    try:
+        size = func(path)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size, peak
+
+
+def main():
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size_mb in SIZES:
+            path = os.path.join(work_dir, "report_{}.bin".format(size_mb))
+            with open(path, 'wb') as f:
+                for _ in range(size_mb):
+                    f.write(os.urandom(1024 * 1024))
+            for name, func in (("in-memory", _in_memory), ("streaming", _streaming)):
+                message_size, peak = _peak(func, path)
+                print("{:>4}MB {:<10} message={:>8.1f}MB  peak={:>8.1f}MB  ({:.2f}x file)".format(
+                    size_mb, name, message_size / 2 ** 20, peak / 2 ** 20, peak / (size_mb * 2 ** 20)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_collector
+日志采集器(RingBufferHandler)的开销: 单条日志的写入耗时和写满后每条日志占用的内存,
+与直接保存LogRecord的deque(maxlen)对比; 以及从写满的缓冲中取快照的耗时.
+"""
+# Python内置库
+import logging
+import tracemalloc
+import collections
+
+# 项目内部库
+from DataVision.LoggerBenchmark.harness import measure
+from DataVision.LoggerHandler.collector import RingBufferHandler
+
+# 缓冲容量和单轮的写入/快照次数
+CAPACITY = 500
+EMITS = 100000
+SNAPSHOTS = 2000
+ROUNDS = 5
+
+
+class _DequeHandler(logging.Handler):
+    """
+    对比用: 直接保存LogRecord
+    """
+
+    def __init__(self, capacity: int) -> None:
+        logging.Handler.__init__(self)
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(record)
+
+
+def _records(count: int) -> list:
+    levels = (logging.DEBUG, logging.INFO, logging.INFO, logging.WARNING, logging.ERROR)
+    records = []
+    for i in range(count):
+        record = logging.makeLogRecord({"name": "DataVision.worker", "msg": "处理任务 %d 完成, 耗时 %.3f秒",
+                                        "args": (i, i / 1000), "levelno": levels[i % len(levels)],
+                                        "pathname": "/srv/app/worker.py", "lineno": 100})
+        record.levelname = logging.getLevelName(record.levelno)
+        records.append(record)
+    return records
+
+
+def _memory_per_record(factory) -> float:
+    """
+    :return: 写满缓冲后平均每条日志占用的字节数(包括LogRecord本身, 不包括之前的Handler格式化的文本)
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        handler = factory()
+        # 记录在写入后释放, 只有Handler保留的部分计入
+        for record in _records(CAPACITY * 2):
+            handler.handle(record)
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    handler.close()
+    return round(used / CAPACITY, 1)
+
+
+def run(scale: float = 1.0) -> dict:
+    """
+    :return: {"collector/名称": 统计(写入用例附加每条日志的内存bytes_per_record)}
+    """
+    results = {}
+    records = _records(CAPACITY * 2)
+    count = len(records)
+    # 挂在root上时, 之前的console/文件Handler已经格式化过消息(record.message)
+    formatted = _records(CAPACITY * 2)
+    for record in formatted:
+        record.message = record.getMessage()
+    for name, factory, inputs in (("ring buffer", lambda: RingBufferHandler(CAPACITY), records),
+                                  ("ring buffer, formatted", lambda: RingBufferHandler(CAPACITY), formatted),
+                                  ("deque of LogRecord", lambda: _DequeHandler(CAPACITY), records)):
+        handler = factory()
+        result = measure(lambda i: handler.handle(inputs[i % count]), int(EMITS * scale), ROUNDS)
+        handler.close()
+        result["bytes_per_record"] = _memory_per_record(factory)
+        results["collector/emit {}".format(name)] = result
+    collector = RingBufferHandler(CAPACITY)
+    for record in records:
+        collector.handle(record)
+    number = int(SNAPSHOTS * scale)
+    results["collector/snapshot limit 200"] = measure(lambda i: collector.snapshot(limit=200), number, ROUNDS)
+    results["collector/snapshot level WARNING"] = measure(lambda i: collector.snapshot(level="WARNING"),
+                                                          number, ROUNDS)
+    collector.close()
+    return results
+
+
+def main():
+    for name, result in run().items():
+        line = "{:<36} {:>10.0f} ops/s  p50 {:>7.2f}us  p99 {:>7.2f}us".format(
+            name, result["ops_per_sec"], result["p50_us"], result["p99_us"])
+        if "bytes_per_record" in result:
+            line += "  {:>8} bytes/record".format(result["bytes_per_record"])
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
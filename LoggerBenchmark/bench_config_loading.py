@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_config_loading
+VisionLogger启动和重复构造的耗时
+"""
+# Python内置库
+import os
+import time
+import shutil
+import timeit
+import logging
+import tempfile
+import logging.config
+
+# Python第三方库
+import yaml
+
+# 项目内部库
+from DataVision.LoggerHandler import config_loader
+from DataVision.LoggerHandler.logger import VisionLogger
+
+# 项目自带的日志配置
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'LoggerConfig', 'logger_config.yaml')
+
+# 每个用例的调用次数
+NUMBER = 200
+
+
+def legacy_construct(path: str):
+    """
+    旧版构造流程: 每次都检查目录、重新解析yaml并重新dictConfig
+    """
+    if os.path.exists('vision') is not True:
+        os.mkdir('vision')
+    with open(path, 'rt') as f:
+        config = yaml.load(f.read(), Loader=yaml.SafeLoader)
+    config.pop('vision', None)
+    logging.config.dictConfig(config)
+
+
+def _report(name: str, seconds: float, number: int = NUMBER):
+    print("{:<36} {:>10.1f}us/op".format(name, seconds / number * 1e6))
+
+
+def main():
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        # 终端输出重定向到文件, 避免污染测试结果
+        with open(CONFIG_PATH, 'rt') as f:
+            source = f.read().replace("ext://sys.stdout", "ext://sys.stderr")
+        path = os.path.join(work_dir, "logger_config.yaml")
+        with open(path, 'w') as f:
+            f.write(source)
+
+        _report("yaml.SafeLoader parse", timeit.timeit(
+            lambda: yaml.load(source, Loader=yaml.SafeLoader), number=NUMBER))
+        _report("{} parse".format(config_loader.YAML_LOADER.__name__), timeit.timeit(
+            lambda: yaml.load(source, Loader=config_loader.YAML_LOADER), number=NUMBER))
+
+        start = time.perf_counter()
+        VisionLogger(path)
+        _report("VisionLogger first construction", time.perf_counter() - start, 1)
+        _report("VisionLogger cached construction", timeit.timeit(
+            lambda: VisionLogger(path), number=NUMBER))
+        _report("legacy construction", timeit.timeit(
+            lambda: legacy_construct(path), number=NUMBER))
+    finally:
+        logging.config.dictConfig({"version": 1, "disable_existing_loggers": False})
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
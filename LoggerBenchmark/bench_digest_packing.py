@@ -0,0 +1,105 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_digest_packing
+积压的钉钉报警逐条发送与合并发送的请求数和耗时对比
+"""
+# Python内置库
+import os
+import json
+import time
+import socket
+import tempfile
+import threading
+import http.server
+
+# 项目内部库
+from DataVision.LoggerNotification.digest import MAX_MESSAGE_BYTES
+from DataVision.LoggerNotification.rate_limiter import get_limiter
+from DataVision.LoggerNotification.dispatcher import NotificationDispatcher
+
+# 积压的报警数量
+ALERTS = 200
+# 每个请求的处理延迟, 模拟钉钉接口的耗时
+REQUEST_DELAY = 0.05
+LEVELS = ("CRITICAL", "ERROR", "WARNING", "INFO")
+
+
+class RobotHandler(http.server.BaseHTTPRequestHandler):
+    """
+    钉钉机器人替身: 内容超过MAX_MESSAGE_BYTES字节时返回101002
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    requests = 0
+    too_long = 0
+
+    def do_POST(self):
+        message = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        time.sleep(REQUEST_DELAY)
+        RobotHandler.requests += 1
+        errcode = 0
+        if len(message["markdown"]["text"].encode('utf-8')) > MAX_MESSAGE_BYTES:
+            RobotHandler.too_long += 1
+            errcode = 101002
+        body = json.dumps({"errcode": errcode, "errmsg": "ok"}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _alert(index: int) -> dict:
+    level = LEVELS[index % len(LEVELS)]
+    text = "### [{}] 数据采集报警\n\n> 任务{}执行失败: connection refused".format(level, index)
+    if index == 7:
+        # 一条超长的报警(大段堆栈)
+        text += "\n\n```\n" + "\n".join("  File \"worker.py\", line {}, in run".format(i) for i in range(1500)) + "\n```"
+    return {"msg_type": "markdown", "title": "[{}] 数据采集报警".format(level), "text": text, "level": level}
+
+
+def _run(name: str, config_path: str, pack_dingding: bool):
+    RobotHandler.requests = RobotHandler.too_long = 0
+    dispatcher = NotificationDispatcher(config_path=config_path, pack_dingding=pack_dingding,
+                                        retries=0, concurrency=8, suppress_window=0)
+    start = time.perf_counter()
+    futures = [dispatcher.submit("dingding", **_alert(i)) for i in range(ALERTS)]
+    failed = sum(1 for future in futures if future.exception() is not None)
+    elapsed = time.perf_counter() - start
+    dispatcher.shutdown()
+    print("{:<12} {:>4} requests  {:>6.2f}s  failed alerts: {}  rejected as too long: {}".format(
+        name, RobotHandler.requests, elapsed, failed, RobotHandler.too_long))
+
+
+def main():
+    port = _free_port()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), RobotHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    robot_url = "http://127.0.0.1:{}/robot/send?access_token=".format(port)
+    # 替身服务器不限流, 先注册一个不会触发等待的限流器
+    get_limiter(robot_url + "benchmark", limit=10 ** 9, period=1)
+
+    fd, config_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({"DingDing": {"robot_url": robot_url, "robot_token": "benchmark"}}, f)
+    try:
+        _run("one by one", config_path, pack_dingding=False)
+        _run("packed", config_path, pack_dingding=True)
+    finally:
+        os.remove(config_path)
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_dingding_client
+本地HTTP替身服务器上, 每条报警新建发送器/事件循环/连接与长连接客户端的单条延迟对比
+"""
+# Python内置库
+import os
+import json
+import time
+import socket
+import tempfile
+import threading
+import http.server
+
+# Python第三方库
+import curio
+
+# 项目内部库
+from DataVision.LoggerNotification.rate_limiter import get_limiter
+from DataVision.LoggerNotification.DingDingNotification import DingDingSender, load_asks
+
+# 发送的报警数量
+MESSAGES = 200
+# 建立连接时注入的延迟, 模拟到钉钉的TLS握手耗时
+HANDSHAKE_DELAY = 0.02
+
+
+class RobotHandler(http.server.BaseHTTPRequestHandler):
+    """
+    钉钉机器人替身: 支持keep-alive, 每个新连接先等待HANDSHAKE_DELAY
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    received = 0
+    connections = 0
+
+    def setup(self):
+        RobotHandler.connections += 1
+        time.sleep(HANDSHAKE_DELAY)
+        super().setup()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        RobotHandler.received += 1
+        body = json.dumps({"errcode": 0, "errmsg": "ok"}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _send_fresh(config_path: str):
+    # 旧的send(): 每条报警新建发送器和curio内核, 使用不复用连接的asks.post
+    for i in range(MESSAGES):
+        dingding = DingDingSender(config_path=config_path, session=load_asks())
+        curio.run(dingding.send_message(msg_type="text", content="benchmark {}".format(i)))
+
+
+def _send_long_lived(config_path: str):
+    dingding = DingDingSender(config_path=config_path)
+    kernel = curio.Kernel()
+    try:
+        for i in range(MESSAGES):
+            kernel.run(dingding.send_message(msg_type="text", content="benchmark {}".format(i)))
+        kernel.run(dingding.close)
+    finally:
+        kernel.run(shutdown=True)
+
+
+def _report(name: str, func, config_path: str):
+    RobotHandler.connections = 0
+    start = time.perf_counter()
+    func(config_path)
+    elapsed = time.perf_counter() - start
+    print("{:<20} {:>8.2f} ms/alert  ({} connections for {} alerts)".format(
+        name, elapsed * 1000 / MESSAGES, RobotHandler.connections, MESSAGES))
+
+
+def main():
+    port = _free_port()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), RobotHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    robot_url = "http://127.0.0.1:{}/robot/send?access_token=".format(port)
+    # 替身服务器不限流, 先注册一个不会触发等待的限流器
+    get_limiter(robot_url + "benchmark", limit=10 ** 9, period=1)
+
+    fd, config_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({"DingDing": {"robot_url": robot_url, "robot_token": "benchmark"}}, f)
+    try:
+        _report("fresh per alert", _send_fresh, config_path)
+        _report("long-lived client", _send_long_lived, config_path)
+    finally:
+        os.remove(config_path)
+        server.shutdown()
+    print("server received: {}".format(RobotHandler.received))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_formatters
+各日志格式每秒输出的记录数: simple(逐层查找调用位置/直接取调用方栈帧)、fast和JSON格式
+"""
+# Python内置库
+import os
+import json
+import logging
+import tempfile
+import importlib.util
+import contextlib
+import logging.config
+
+# 项目内部库
+from DataVision.LoggerBenchmark.harness import measure
+from DataVision.LoggerHandler.logger import LEVEL_TABLE, VisionLogger
+
+# 单轮写入条数
+RECORDS = 20000
+ROUNDS = 5
+
+SIMPLE = {
+    "format": "%(asctime)s - File:%(filename)s - Line:%(lineno)d - Mode:%(levelname)s - Message:%(message)s",
+    "datefmt": "%F %T"
+}
+# (名称, Formatter配置, 是否按原来的方式(logging逐层查找调用位置)写日志)
+CASES = [
+    ("simple (findCaller)", SIMPLE, True),
+    ("simple", SIMPLE, False),
+    ("fast", {"class": "DataVision.LoggerHandler.formatters.FastFormatter",
+              "format": "%(asctime)s - Mode:%(levelname)s - Message:%(message)s", "datefmt": "%F %T"}, False),
+    ("json", {"()": "DataVision.LoggerHandler.formatters.JsonFormatter", "service": "DataVision",
+              "backend": "json"}, False),
+]
+if importlib.util.find_spec("orjson") is not None:
+    CASES.append(("json (orjson)", {"()": "DataVision.LoggerHandler.formatters.JsonFormatter",
+                                    "service": "DataVision", "backend": "orjson"}, False))
+
+
+def _config(formatter: dict) -> dict:
+    return {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {"bench": formatter},
+        "handlers": {"console": {"class": "logging.StreamHandler", "level": "DEBUG", "formatter": "bench",
+                                 "stream": "ext://sys.stdout"}},
+        "root": {"level": "DEBUG", "handlers": ["console"]},
+        "vision": {"caller": "auto"}
+    }
+
+
+def run(scale: float = 1.0) -> dict:
+    """
+    :return: {"formatter/名称": 统计}
+    """
+    results = {}
+    number = int(RECORDS * scale)
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as devnull:
+        for index, (name, formatter, find_caller) in enumerate(CASES):
+            path = os.path.join(directory, "logger_{}.yaml".format(index))
+            with open(path, 'w') as f:
+                json.dump(_config(formatter), f)
+            # 终端输出在配置时解析, 重定向到os.devnull
+            with contextlib.redirect_stdout(devnull):
+                vision = VisionLogger(path)
+            if find_caller:
+                # 原来的vision_logger: 检查等级后由logging逐层遍历调用栈查找调用位置
+                root = logging.getLogger()
+
+                def log(i: int):
+                    levelno = LEVEL_TABLE.get("INFO")
+                    if root.isEnabledFor(levelno):
+                        root._log(levelno, "benchmark record %d", (i,))
+            else:
+                def log(i: int):
+                    vision.vision_logger("INFO", "benchmark record %d", i)
+            results["formatter/{}".format(name)] = measure(log, number, ROUNDS)
+    logging.config.dictConfig({"version": 1, "disable_existing_loggers": False, "root": {"handlers": []}})
+    return results
+
+
+def main():
+    results = run()
+    baseline = results["formatter/simple (findCaller)"]["ops_per_sec"]
+    for name, result in results.items():
+        print("{:<32} {:>10.0f} records/s  p50 {:>6.2f}us  x{:.2f}".format(
+            name, result["ops_per_sec"], result["p50_us"], result["ops_per_sec"] / baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_import_time
+各入口的导入耗时(python -X importtime), 超过预算或加载了不该加载的依赖时返回非0
+"""
+# Python内置库
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+# 每个用例的子进程运行次数(取中位数)
+RUNS = 5
+# 预算的放大倍数, 在较慢的机器上可以通过环境变量调大
+BUDGET_SCALE = float(os.environ.get("VISION_IMPORT_BUDGET_SCALE", "1"))
+
+# (导入语句, 预算毫秒, 不允许加载的模块)
+CASES = (
+    ("from DataVision.LoggerHandler.logger import VisionLogger", 120,
+     ("asyncio", "asks", "curio", "aiosmtplib", "email.mime.multipart")),
+    ("import DataVision.LoggerNotification", 10,
+     ("asyncio", "asks", "curio", "aiosmtplib", "email.mime.multipart", "DataVision.LoggerHandler.logger")),
+    ("from DataVision.LoggerNotification.notification_handler import NotificationHandler", 120,
+     ("asyncio", "asks", "curio", "aiosmtplib")),
+    ("from DataVision.LoggerNotification.DingDingNotification import DingDingSender", 160,
+     ("asyncio", "asks", "curio", "aiosmtplib")),
+    ("from DataVision.LoggerNotification.EmailNotification import EmailSender", 220,
+     ("asks", "curio", "aiosmtplib")),
+    ("from DataVision.LoggerNotification.dispatcher import NotificationDispatcher", 220,
+     ("asks", "curio", "aiosmtplib")),
+)
+
+# 子进程: 先输出标记再导入, 标记之后的importtime记录才是该语句的开销
+_CHILD = """
+import sys
+import json
+sys.stderr.write("@@vision-start\\n")
+sys.stderr.flush()
+{statement}
+print(json.dumps(sorted(name for name in {forbidden!r} if name in sys.modules)))
+"""
+
+
+def _measure(statement: str, forbidden: tuple) -> tuple:
+    """
+    :return: (耗时微秒, 最重的顶层模块[(微秒, 名称)], 加载了的禁止模块)
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(path for path in sys.path if path)
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _CHILD.format(statement=statement, forbidden=forbidden)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, universal_newlines=True, check=True)
+    lines = process.stderr.split("@@vision-start\n", 1)[1].splitlines()
+    total, top = 0, []
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit() is not True:
+            continue
+        # 没有缩进的是该语句直接导入的模块, 累计时间已经包含了它们的依赖
+        if not name.startswith("  "):
+            total += int(cumulative)
+            top.append((int(cumulative), name.strip()))
+        elif name.startswith("    ") is not True:
+            top.append((int(cumulative), name.strip()))
+    loaded = json.loads(process.stdout.strip().splitlines()[-1])
+    return total, sorted(top, reverse=True)[:4], loaded
+
+
+def main() -> int:
+    failures = 0
+    for statement, budget, forbidden in CASES:
+        runs = [_measure(statement, forbidden) for _ in range(RUNS)]
+        cost = statistics.median(run[0] for run in runs) / 1000
+        _, heaviest, loaded = runs[-1]
+        limit = budget * BUDGET_SCALE
+        status = "ok"
+        if cost > limit:
+            status = "OVER BUDGET"
+        if loaded:
+            status = "LOADED {}".format(", ".join(loaded))
+        if status != "ok":
+            failures += 1
+        print("{:<88} {:>7.1f}ms / {:>5.0f}ms  {}".format(statement, cost, limit, status))
+        print("    " + ", ".join("{} {:.1f}ms".format(name, micros / 1000) for micros, name in heaviest))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_lazy_logging
+vision_logger在开启/关闭等级下的单次调用耗时
+"""
+# Python内置库
+import os
+import json
+import timeit
+import logging
+import tempfile
+
+# 项目内部库
+from DataVision.LoggerHandler.logger import VisionLogger
+
+# 每个用例的调用次数
+NUMBER = 100000
+
+# 模拟较大的日志内容
+PAYLOAD = {"rows": [{"id": i, "name": "row-{}".format(i)} for i in range(50)]}
+
+CONFIG = """
+version: 1
+disable_existing_loggers: False
+handlers:
+    devnull:
+        class: logging.FileHandler
+        filename: {devnull}
+root:
+    level: INFO
+    handlers: [devnull]
+"""
+
+
+def legacy_vision_logger(level='INFO', log_msg: str = ""):
+    """
+    旧版实现: 每次调用都获取logger并逐个比较等级名
+    """
+    logger = logging.getLogger()
+    if level == "DEBUG":
+        logger.debug(log_msg)
+    elif level == 'INFO':
+        logger.info(log_msg)
+    elif level == 'WARN':
+        logger.warning(log_msg)
+    elif level == 'ERROR':
+        logger.error(log_msg)
+    elif level == 'CRITICAL':
+        logger.critical(log_msg)
+    else:
+        raise ValueError("日志等级不存在或者拼写错误!")
+
+
+def _report(name: str, seconds: float):
+    print("{:<40} {:>8.3f}us/call".format(name, seconds / NUMBER * 1e6))
+
+
+def main():
+    with tempfile.TemporaryDirectory() as config_dir:
+        config_path = os.path.join(config_dir, "logger_config.yaml")
+        with open(config_path, 'w') as f:
+            f.write(CONFIG.format(devnull=os.devnull))
+        vision = VisionLogger(config_path)
+
+    cases = [
+        ("legacy DEBUG(disabled) eager", lambda: legacy_vision_logger(
+            "DEBUG", "payload: {}".format(json.dumps(PAYLOAD)))),
+        ("fast DEBUG(disabled) %-args", lambda: vision.vision_logger(
+            "DEBUG", "payload: %s", PAYLOAD)),
+        ("fast DEBUG(disabled) callable", lambda: vision.vision_logger(
+            "DEBUG", lambda: "payload: {}".format(json.dumps(PAYLOAD)))),
+        ("legacy INFO(enabled) eager", lambda: legacy_vision_logger(
+            "INFO", "payload: {}".format(json.dumps(PAYLOAD)))),
+        ("fast INFO(enabled) %-args", lambda: vision.vision_logger(
+            "INFO", "payload: %s", PAYLOAD)),
+        ("fast INFO(enabled) callable", lambda: vision.vision_logger(
+            "INFO", lambda: "payload: {}".format(json.dumps(PAYLOAD)))),
+    ]
+    for name, func in cases:
+        _report(name, timeit.timeit(func, number=NUMBER))
+
+
+if __name__ == '__main__':
+    main()
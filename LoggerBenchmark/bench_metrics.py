@@ -0,0 +1,80 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_metrics
+指标写入的开销: 按线程分片的计数器/直方图与加锁计数器对比(单线程和多线程), 以及导出的耗时
+"""
+# Python内置库
+import time
+import threading
+
+# 项目内部库
+from DataVision.LoggerNotification.metrics import MetricsRegistry, NotificationMetrics
+
+# 每个线程的写入次数
+OPERATIONS = 200000
+THREADS = (1, 4)
+
+
+class LockedCounter(object):
+    """
+    对照组: 每次加一都加锁
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+def _run(name: str, operation, threads: int, expected=None):
+    def work():
+        for _ in range(OPERATIONS):
+            operation()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    total = OPERATIONS * threads
+    line = "{:<28} threads={}  {:>7.1f}ns/op  {:>6.2f}M ops/s".format(
+        name, threads, elapsed / total * 1e9, total / elapsed / 1e6)
+    if expected is not None:
+        value = expected()
+        line += "  total={}{}".format(value, "" if value == total else "  LOST {}".format(total - value))
+    print(line)
+
+
+def main():
+    for threads in THREADS:
+        registry = MetricsRegistry()
+        counter = registry.counter("bench_total", "benchmark", ("channel",)).labels("dingding")
+        histogram = registry.histogram("bench_seconds", "benchmark", ("channel",)).labels("dingding")
+        channel = NotificationMetrics(registry).channel("dingding")
+        locked = LockedCounter()
+        family = registry.counter("bench_lookup_total", "benchmark", ("channel", "code"))
+
+        _run("sharded counter", counter.inc, threads, lambda: counter.value)
+        _run("locked counter", locked.inc, threads, lambda: locked.value)
+        _run("labels() + inc", lambda: family.labels("dingding", "0").inc(), threads,
+             lambda: family.labels("dingding", "0").value)
+        _run("histogram observe", lambda: histogram.observe(0.042), threads, lambda: histogram.value["count"])
+        _run("record (one send)", lambda: channel.record(True, 0, 0.042, 512), threads,
+             lambda: channel.sends.value)
+        print()
+
+    start = time.perf_counter()
+    for _ in range(100):
+        text = registry.to_prometheus()
+    print("to_prometheus: {:.1f}us ({} bytes)".format((time.perf_counter() - start) / 100 * 1e6, len(text)))
+
+
+if __name__ == '__main__':
+    main()
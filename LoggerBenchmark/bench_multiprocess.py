@@ -0,0 +1,117 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_multiprocess
+多个工作进程写同一个日志文件(按大小切分)的吞吐:
+    direct - 每个进程各自打开并切分同一个文件(原来的方式);
+    aggregator - 工作进程把记录发送给汇总进程, 由汇总进程写文件(vision.multiprocess).
+写完后统计所有文件中的行数(direct模式下切分时会丢失记录), 汇总后的正确性见tests/test_aggregator.py.
+    python -m DataVision.LoggerBenchmark.bench_multiprocess --producers 1 2 4 --records 20000
+"""
+# Python内置库
+import os
+import re
+import gzip
+import json
+import time
+import logging
+import argparse
+import tempfile
+import multiprocessing
+
+# 项目内部库
+from DataVision.LoggerHandler.aggregator import start_aggregator
+
+PRODUCERS = (1, 2, 4)
+RECORDS = 20000
+# 单个文件切分的大小(每个用例切分若干次)
+MAX_BYTES = 2 * 1024 * 1024
+PAYLOAD = "x" * 100
+MODES = ("direct", "aggregator")
+
+_SEGMENT = re.compile(r"^vision_log\.log\.(\S+?)(?:\.(\d+))?(?:\.gz)?$")
+
+
+def _write_config(directory: str, mode: str) -> str:
+    config = {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {"fast": {"class": "DataVision.LoggerHandler.formatters.FastFormatter",
+                                "format": "%(asctime)s - Mode:%(levelname)s - Message:%(message)s",
+                                "datefmt": "%F %T"}},
+        "handlers": {"info_file_handler": {
+            "class": "DataVision.LoggerHandler.rotating_handler.VisionRotatingFileHandler",
+            "level": "DEBUG", "formatter": "fast", "filename": os.path.join(directory, "vision_log.log"),
+            "maxBytes": MAX_BYTES, "compress": "gzip", "encoding": "utf8"}},
+        "root": {"level": "DEBUG", "handlers": ["info_file_handler"]},
+        "vision": {"multiprocess": {"enabled": mode == "aggregator",
+                                    "address": os.path.join(directory, "vision_log.sock")}},
+    }
+    path = os.path.join(directory, "logger_config.yaml")
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return path
+
+
+def _produce(config_path: str, producer: int, records: int):
+    from DataVision.LoggerHandler.logger import VisionLogger
+    # direct模式下多个进程切分同一个文件会失败(改名时文件已被其他进程改走), 不输出错误堆栈, 只统计丢失的记录
+    logging.raiseExceptions = False
+    vision = VisionLogger(config_path)
+    for i in range(records):
+        vision.vision_logger("INFO", "producer %d record %d %s", producer, i, PAYLOAD)
+    # multiprocessing的子进程退出时不执行atexit, 需要自己刷新并关闭Handler
+    logging.shutdown()
+
+
+def _count_lines(directory: str) -> int:
+    """
+    :return: 当前文件和所有切分出的文件中的总行数
+    """
+    names = [name for name in os.listdir(directory) if _SEGMENT.match(name) or name == "vision_log.log"]
+    count = 0
+    for name in names:
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(os.path.join(directory, name), 'rb') as f:
+            count += sum(1 for _ in f)
+    return count
+
+
+def run_case(mode: str, producers: int, records: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = _write_config(directory, mode)
+        aggregator = start_aggregator(config_path) if mode == "aggregator" else None
+        start = time.perf_counter()
+        workers = [multiprocessing.Process(target=_produce, args=(config_path, producer, records))
+                   for producer in range(producers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if aggregator is not None:
+            # 工作进程都已断开, 汇总进程写完剩余记录后退出
+            aggregator.terminate()
+            aggregator.join()
+        elapsed = time.perf_counter() - start
+        # 等待后台压缩完成
+        time.sleep(0.5)
+        lines = _count_lines(directory)
+    return {"records_per_sec": round(producers * records / elapsed, 1), "lost": producers * records - lines}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="多进程写日志的吞吐")
+    parser.add_argument("--producers", type=int, nargs="+", default=list(PRODUCERS), help="工作进程数")
+    parser.add_argument("--records", type=int, default=RECORDS, help="每个工作进程写入的记录数")
+    parser.add_argument("--mode", choices=MODES, action="append", help="只运行指定的模式(可以重复)")
+    args = parser.parse_args(argv)
+    print("{:<11} {:>9} {:>12} {:>8}".format("mode", "producers", "records/s", "lost"))
+    for producers in args.producers:
+        for mode in args.mode or MODES:
+            result = run_case(mode, producers, args.records)
+            print("{:<11} {:>9} {:>12.0f} {:>8}".format(mode, producers, result["records_per_sec"], result["lost"]))
+
+
+if __name__ == '__main__':
+    main()
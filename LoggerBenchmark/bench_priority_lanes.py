@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_priority_lanes
+过载时各级别报警的排队时间: 按到达顺序(FIFO)与按级别分道对比
+"""
+# Python内置库
+import random
+import asyncio
+import collections
+
+# 项目内部库
+from DataVision.LoggerNotification.priority import LANES, PrioritySemaphore
+from DataVision.LoggerNotification.rate_limiter import PriorityLimiter, SlidingWindowLimiter
+
+# 时间按比例缩小: 钉钉每分钟20条缩小为每秒20条
+LIMIT = 20
+PERIOD = 1.0
+# 到达速度为发送能力的两倍
+ARRIVAL_RATE = 40
+DURATION = 3.0
+# 各级别的比例
+MIX = (("CRITICAL", 0.05), ("ERROR", 0.1), ("WARNING", 0.15), ("INFO", 0.7))
+# 优先级提升时间(同样按比例缩小)
+AGING_SECONDS = 1.0
+# 邮件: 同时发送数和每封邮件的耗时
+EMAIL_CONCURRENCY = 4
+EMAIL_SECONDS = 0.05
+
+
+def _arrivals(seed: int = 7) -> list:
+    """
+    :return: [(到达时间, 级别), ...]
+    """
+    rng = random.Random(seed)
+    levels = [level for level, _ in MIX]
+    weights = [weight for _, weight in MIX]
+    count = int(ARRIVAL_RATE * DURATION)
+    return [(index / ARRIVAL_RATE, rng.choices(levels, weights)[0]) for index in range(count)]
+
+
+async def _replay(arrivals: list, wait) -> dict:
+    """
+    按到达时间提交消息
+    :param wait: 协程函数, 参数为级别, 返回排队秒数
+    :return: {级别: [排队秒数, ...]}
+    """
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    waits = collections.defaultdict(list)
+
+    async def one(at: float, level: str):
+        await asyncio.sleep(max(0.0, start + at - loop.time()))
+        waits[level].append(await wait(level))
+
+    await asyncio.gather(*[one(at, level) for at, level in arrivals])
+    return waits
+
+
+def _percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _report(name: str, waits: dict):
+    print(name)
+    for level in LANES:
+        values = waits.get(level)
+        if not values:
+            continue
+        print("  {:<9} n={:<4} p50 {:>6.3f}s  p95 {:>6.3f}s  max {:>6.3f}s".format(
+            level, len(values), _percentile(values, 0.5), _percentile(values, 0.95), max(values)))
+
+
+def _run_limiter(name: str, limiter: SlidingWindowLimiter, arrivals: list):
+    async def wait(level: str) -> float:
+        return await limiter.acquire(asyncio.sleep, level=level)
+    _report(name, asyncio.run(_replay(arrivals, wait)))
+
+
+def _run_semaphore(name: str, priority: bool, arrivals: list):
+    async def main() -> dict:
+        loop = asyncio.get_event_loop()
+        if priority:
+            semaphore = PrioritySemaphore(EMAIL_CONCURRENCY, aging_seconds=AGING_SECONDS)
+        else:
+            semaphore = asyncio.Semaphore(EMAIL_CONCURRENCY)
+
+        async def wait(level: str) -> float:
+            start = loop.time()
+            if priority:
+                await semaphore.acquire(level)
+            else:
+                await semaphore.acquire()
+            waited = loop.time() - start
+            await asyncio.sleep(EMAIL_SECONDS)
+            semaphore.release()
+            return waited
+
+        return await _replay(arrivals, wait)
+    _report(name, asyncio.run(main()))
+
+
+def main():
+    arrivals = _arrivals()
+    print("{} alerts in {}s, dingding limit {}/{}s, email concurrency {} x {}s".format(
+        len(arrivals), DURATION, LIMIT, PERIOD, EMAIL_CONCURRENCY, EMAIL_SECONDS))
+    _run_limiter("dingding fifo", SlidingWindowLimiter(limit=LIMIT, period=PERIOD), arrivals)
+    _run_limiter("dingding priority", PriorityLimiter(limit=LIMIT, period=PERIOD, aging_seconds=AGING_SECONDS),
+                 arrivals)
+    # 邮件的发送能力为每秒80封, 到达速度同样提高到两倍
+    email_arrivals = [(at / 4, level) for at, level in arrivals + [(at + DURATION, level) for at, level in arrivals]]
+    _run_semaphore("email fifo", False, email_arrivals)
+    _run_semaphore("email priority", True, email_arrivals)
+
+
+if __name__ == '__main__':
+    main()
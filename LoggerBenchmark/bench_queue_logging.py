@@ -0,0 +1,125 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_queue_logging
+队列模式与同步模式下调用方写日志延迟的对比
+"""
+# Python内置库
+import os
+import time
+import logging
+import tempfile
+import logging.config
+
+# 项目内部库
+from DataVision.LoggerHandler.queue_handler import start_queue_logging, stop_queue_logging
+
+# 单轮写入条数
+RECORDS = 20000
+
+
+class SlowStream(object):
+    """
+    模拟较慢的终端输出, 每次写入耗时delay秒
+    """
+
+    def __init__(self, delay: float = 0.00005):
+        self.delay = delay
+
+    def write(self, data):
+        time.sleep(self.delay)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def _config(log_dir: str, stream) -> dict:
+    """
+    与logger_config.yaml一致的Handler配置, 终端输出重定向到stream
+    """
+    return {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {
+            "simple": {
+                "format": "%(asctime)s - File:%(filename)s - Line:%(lineno)d - "
+                          "Mode:%(levelname)s - Message:%(message)s",
+                "datefmt": "%F %T"
+            }
+        },
+        "handlers": {
+            "console": {
+                "class": "logging.StreamHandler",
+                "level": "DEBUG",
+                "formatter": "simple",
+                "stream": stream
+            },
+            "info_file_handler": {
+                "class": "logging.handlers.TimedRotatingFileHandler",
+                "level": "DEBUG",
+                "formatter": "simple",
+                "filename": os.path.join(log_dir, "vision_log.log"),
+                "interval": 1,
+                "backupCount": 2,
+                "encoding": "utf8",
+                "when": "H"
+            }
+        },
+        "root": {"level": "DEBUG", "handlers": ["console", "info_file_handler"]}
+    }
+
+
+def _run(logger: logging.Logger) -> list:
+    latencies = []
+    for i in range(RECORDS):
+        start = time.perf_counter()
+        logger.info("benchmark record %d", i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _report(name: str, latencies: list):
+    latencies.sort()
+    count = len(latencies)
+    print("{:<12} mean={:>8.2f}us  p50={:>8.2f}us  p99={:>8.2f}us  max={:>9.2f}us".format(
+        name,
+        sum(latencies) / count * 1e6,
+        latencies[count // 2] * 1e6,
+        latencies[int(count * 0.99)] * 1e6,
+        latencies[-1] * 1e6
+    ))
+
+
+def main():
+    logger = logging.getLogger()
+    with tempfile.TemporaryDirectory() as log_dir, \
+            open(os.devnull, 'w') as stream:
+        print("== console -> os.devnull")
+        _bench(logger, log_dir, stream)
+        print("== console -> slow terminal (50us/write)")
+        _bench(logger, log_dir, SlowStream())
+    logging.config.dictConfig({"version": 1, "disable_existing_loggers": False})
+
+
+def _bench(logger: logging.Logger, log_dir: str, stream):
+    logging.config.dictConfig(_config(log_dir, stream))
+    _report("sync", _run(logger))
+
+    logging.config.dictConfig(_config(log_dir, stream))
+    start_queue_logging(logger, {"maxsize": RECORDS * 2, "overflow": "block"})
+    _report("queue", _run(logger))
+    flush_start = time.perf_counter()
+    stop_queue_logging()
+    print("queue drain on shutdown: {:.2f}ms".format((time.perf_counter() - flush_start) * 1e3))
+
+    logging.config.dictConfig(_config(log_dir, stream))
+    handler = start_queue_logging(logger, {"maxsize": 1000, "overflow": "drop_oldest"})
+    _report("drop_oldest", _run(logger))
+    stop_queue_logging()
+    print("drop_oldest dropped: {}".format(handler.dropped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_rotation
+按大小切分日志文件时写日志调用的耗时, 重点是切分时的最大耗时(max):
+    RotatingFileHandler - 切分时在调用线程中依次改名所有历史文件;
+    RotatingFileHandler + gzip rotator - 常见做法, 切分时在调用线程中压缩;
+    VisionRotatingFileHandler - 调用线程只改名, 压缩和清理在后台线程.
+"""
+# Python内置库
+import os
+import gzip
+import shutil
+import logging
+import tempfile
+import logging.handlers
+
+# 项目内部库
+from DataVision.LoggerBenchmark.harness import measure
+from DataVision.LoggerHandler.rotating_handler import VisionRotatingFileHandler
+
+# 单轮写入条数(约切分5次)
+RECORDS = 40000
+ROUNDS = 3
+MAX_BYTES = 1024 * 1024
+BACKUP_COUNT = 50
+MESSAGE = "benchmark record %d " + "x" * 100
+
+
+def _gzip_rotator(source: str, dest: str):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def _stdlib(path: str) -> logging.Handler:
+    return logging.handlers.RotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT,
+                                                encoding="utf8")
+
+
+def _stdlib_gzip(path: str) -> logging.Handler:
+    handler = _stdlib(path)
+    handler.namer = lambda name: name + ".gz"
+    handler.rotator = _gzip_rotator
+    return handler
+
+
+def _vision(path: str) -> logging.Handler:
+    return VisionRotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT, encoding="utf8")
+
+
+CASES = (
+    ("RotatingFileHandler", _stdlib),
+    ("RotatingFileHandler + gzip rotator", _stdlib_gzip),
+    ("VisionRotatingFileHandler (gzip)", _vision),
+)
+
+
+def run(scale: float = 1.0) -> dict:
+    """
+    :return: {"rotation/名称": 统计}
+    """
+    results = {}
+    number = int(RECORDS * scale)
+    for name, factory in CASES:
+        with tempfile.TemporaryDirectory() as directory:
+            handler = factory(os.path.join(directory, "vision_log.log"))
+            handler.setFormatter(logging.Formatter("%(asctime)s - Mode:%(levelname)s - Message:%(message)s"))
+            logger = logging.getLogger("DataVision.bench_rotation")
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            logger.addHandler(handler)
+            try:
+                results["rotation/{}".format(name)] = measure(lambda i: logger.info(MESSAGE, i), number, ROUNDS)
+            finally:
+                logger.removeHandler(handler)
+                handler.close()
+    return results
+
+
+def main():
+    for name, result in run().items():
+        print("{:<48} {:>9.0f} records/s  p99 {:>6.1f}us  max {:>9.1f}us".format(
+            name, result["ops_per_sec"], result["p99_us"], result["max_us"]))
+
+
+if __name__ == '__main__':
+    main()
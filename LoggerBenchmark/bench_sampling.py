@@ -0,0 +1,125 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_sampling
+采样Filter的开销: 单条记录的判断耗时(不采样的等级/同一调用位置的风暴/大量调用位置/超出max_keys时的淘汰),
+以及同一行ERROR日志风暴写文件时, 开启采样前后每秒处理的记录数和写入的字节数
+"""
+# Python内置库
+import os
+import json
+import logging
+import tempfile
+import contextlib
+import logging.config
+
+# 项目内部库
+from DataVision.LoggerBenchmark.harness import measure
+from DataVision.LoggerHandler.logger import VisionLogger
+from DataVision.LoggerHandler.sampling import SamplingFilter
+
+# 单轮的判断次数和风暴中的记录数
+DECISIONS = 100000
+STORM = 50000
+ROUNDS = 5
+CALLSITES = 1000
+# 判断耗时用例的记录使用单独的logger, 退出时输出的汇总日志不会打印到终端
+BENCH_LOGGER = "DataVision.bench_sampling"
+
+
+def _records(count: int, levelno: int = logging.ERROR) -> list:
+    return [logging.makeLogRecord({"name": BENCH_LOGGER, "msg": "连接失败: %s", "args": ("timeout",),
+                                   "levelno": levelno, "levelname": logging.getLevelName(levelno),
+                                   "pathname": "/srv/app/worker.py", "filename": "worker.py",
+                                   "lineno": 100 + i, "funcName": "run"}) for i in range(count)]
+
+
+def bench_decisions(scale: float = 1.0) -> dict:
+    """
+    :return: {"sampling/名称": 统计}
+    """
+    number = int(DECISIONS * scale)
+    logger = logging.getLogger(BENCH_LOGGER)
+    logger.propagate = False
+    logger.addHandler(logging.NullHandler())
+    hot = _records(1)[0]
+    info = _records(1, logging.INFO)[0]
+    callsites = _records(CALLSITES)
+    overflow = _records(CALLSITES * 2)
+    cases = (
+        # (名称, Filter, 记录列表)
+        ("level not sampled", SamplingFilter(levels=["ERROR"]), [info]),
+        ("callsite storm", SamplingFilter(), [hot]),
+        ("template storm", SamplingFilter(key="template"), [hot]),
+        ("logger+level storm", SamplingFilter(key=["logger", "level"]), [hot]),
+        ("token_bucket storm", SamplingFilter(policy="token_bucket", rate=100), [hot]),
+        ("1000 callsites", SamplingFilter(max_keys=CALLSITES), callsites),
+        ("2000 callsites, max_keys 1000", SamplingFilter(max_keys=CALLSITES), overflow),
+    )
+    results = {}
+    for name, sampling_filter, records in cases:
+        count = len(records)
+        results["sampling/{}".format(name)] = measure(
+            lambda i: sampling_filter.filter(records[i % count]), number, ROUNDS)
+    return results
+
+
+def _storm_config(directory: str, sampling: bool) -> str:
+    config = {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {"simple": {"format": "%(asctime)s - File:%(filename)s - Line:%(lineno)d - "
+                                            "Mode:%(levelname)s - Message:%(message)s", "datefmt": "%F %T"}},
+        "handlers": {"file": {"class": "logging.FileHandler", "level": "DEBUG", "formatter": "simple",
+                              "filename": os.path.join(directory, "storm_{}.log".format(sampling))}},
+        "root": {"level": "DEBUG", "handlers": ["file"]},
+    }
+    if sampling:
+        config["filters"] = {"sampling": {"()": "DataVision.LoggerHandler.sampling.SamplingFilter",
+                                          "levels": ["ERROR", "CRITICAL"]}}
+        config["root"]["filters"] = ["sampling"]
+    path = os.path.join(directory, "logger_{}.yaml".format(sampling))
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return path
+
+
+def bench_storm(scale: float = 1.0) -> dict:
+    """
+    :return: {"sampling/storm 名称": 统计(附加写入的字节数bytes)}
+    """
+    number = int(STORM * scale)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as devnull:
+        for sampling in (False, True):
+            with contextlib.redirect_stdout(devnull):
+                vision = VisionLogger(_storm_config(directory, sampling))
+            result = measure(lambda i: vision.vision_logger("ERROR", "连接失败: %s", "timeout"), number, ROUNDS)
+            root = logging.getLogger()
+            for sampling_filter in list(root.filters):
+                sampling_filter.flush_summaries()
+                root.removeFilter(sampling_filter)
+            logging.config.dictConfig({"version": 1, "disable_existing_loggers": False, "root": {"handlers": []}})
+            result["bytes"] = os.path.getsize(os.path.join(directory, "storm_{}.log".format(sampling)))
+            results["sampling/storm {}".format("sampled" if sampling else "unsampled")] = result
+    return results
+
+
+def run(scale: float = 1.0) -> dict:
+    results = bench_decisions(scale)
+    results.update(bench_storm(scale))
+    return results
+
+
+def main():
+    for name, result in run().items():
+        line = "{:<44} {:>10.0f} ops/s  p50 {:>6.2f}us  p99 {:>6.2f}us".format(
+            name, result["ops_per_sec"], result["p50_us"], result["p99_us"])
+        if "bytes" in result:
+            line += "  {:>10} bytes".format(result["bytes"])
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_smtp_pool
+本地SMTP替身服务器(aiosmtpd)上, 每封邮件新建连接与连接池的吞吐对比
+"""
+# Python内置库
+import time
+import socket
+import asyncio
+from email.mime.text import MIMEText
+
+# Python第三方库
+import aiosmtplib
+from aiosmtpd.controller import Controller
+
+# 项目内部库
+from DataVision.LoggerNotification.smtp_pool import SMTPConnectionPool
+
+# 发送的邮件数量
+MESSAGES = 200
+# 建立连接时注入的延迟, 模拟TLS握手和登录的耗时
+HANDSHAKE_DELAY = 0.02
+
+
+class SinkHandler(object):
+    """
+    只计数不投递的SMTP处理器
+    """
+
+    def __init__(self):
+        self.received = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        await asyncio.sleep(HANDSHAKE_DELAY)
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return '250 OK'
+
+
+def _message(index: int) -> MIMEText:
+    message = MIMEText("benchmark body {}".format(index))
+    message['From'] = "vision@localhost"
+    message['To'] = "alert@localhost"
+    message['Subject'] = "benchmark {}".format(index)
+    return message
+
+
+async def _send_fresh(hostname: str, port: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send_one(index: int):
+        async with semaphore:
+            smtp = aiosmtplib.SMTP(hostname=hostname, port=port)
+            await smtp.connect()
+            await smtp.send_message(_message(index))
+            await smtp.quit()
+
+    await asyncio.gather(*[send_one(i) for i in range(MESSAGES)])
+
+
+async def _send_pooled(hostname: str, port: int, pool_size: int):
+    async with SMTPConnectionPool(hostname=hostname, port=port,
+                                  use_tls=False, pool_size=pool_size) as pool:
+        await asyncio.gather(*[pool.send_message(_message(i)) for i in range(MESSAGES)])
+
+
+def _report(name: str, loop, coro):
+    start = time.perf_counter()
+    loop.run_until_complete(coro)
+    elapsed = time.perf_counter() - start
+    print("{:<24} {:>8.1f} msg/s  ({:.3f}s for {} messages)".format(
+        name, MESSAGES / elapsed, elapsed, MESSAGES))
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    handler = SinkHandler()
+    hostname, port = "127.0.0.1", _free_port()
+    controller = Controller(handler, hostname=hostname, port=port)
+    controller.start()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        for size in (1, 4):
+            _report("fresh connection x{}".format(size), loop, _send_fresh(hostname, port, size))
+            _report("pool size {}".format(size), loop, _send_pooled(hostname, port, size))
+    finally:
+        loop.close()
+        controller.stop()
+    print("server received: {}".format(handler.received))
+
+
+if __name__ == '__main__':
+    main()
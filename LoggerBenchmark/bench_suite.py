@@ -0,0 +1,393 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: bench_suite
+可重复的离线基准测试套件:
+    vision_logger各级别在各Handler下的吞吐和延迟;
+    make_message在不同附件大小下的耗时(使用/不使用编码缓存);
+    DingDingSender.make_message六种消息类型的构造耗时;
+    EmailSender和DingDingSender在本地SMTP/HTTP替身服务器(注入延迟)上的端到端发送吞吐;
+    发送指标(计数器/直方图)的写入开销;
+    各日志格式(simple/fast/json)每秒输出的记录数(见bench_formatters);
+    按大小切分日志文件时写日志调用的耗时(见bench_rotation);
+    采样Filter的判断耗时和日志风暴下的吞吐(见bench_sampling);
+    日志采集器的写入开销、每条日志的内存和快照耗时(见bench_collector).
+结果保存为JSON, 指定--compare时与之前的结果对比, 有退化时返回非0.
+    python -m DataVision.LoggerBenchmark.bench_suite --output base.json
+    python -m DataVision.LoggerBenchmark.bench_suite --compare base.json --threshold 0.2
+"""
+# Python内置库
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import contextlib
+import logging.config
+
+# 项目内部库
+from DataVision.LoggerBenchmark.harness import (
+    DEFAULT_THRESHOLD,
+    StandInServer,
+    compare,
+    load_results,
+    measure,
+    best_round,
+    save_results,
+    summarize
+)
+
+# 各组用例的单轮操作数(--quick时缩小为1/10)
+LOG_RECORDS = 5000
+MESSAGE_BUILDS = 20000
+METRIC_WRITES = 100000
+SENDS = 200
+# 计时轮数, 结果取吞吐最高的一轮
+ROUNDS = 5
+# 随机数据的种子, 保证每次运行的附件内容相同
+SEED = 20181115
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+# 附件用例: (名称, 字节数, 单轮构造次数)
+ATTACHMENT_SIZES = (("none", 0, 2000), ("10KB", 10 * 1024, 1000), ("100KB", 100 * 1024, 200),
+                    ("1MB", 1024 * 1024, 20))
+# 替身服务器注入的延迟: 建立连接(握手/登录)和每个请求的处理耗时
+CONNECT_DELAY = 0.02
+REPLY_DELAY = 0.002
+# 端到端发送的并发数(与发送器的默认连接数一致)
+SEND_CONCURRENCY = 4
+
+_FORMATTER = {
+    "format": "%(asctime)s - File:%(filename)s - Line:%(lineno)d - Mode:%(levelname)s - Message:%(message)s",
+    "datefmt": "%F %T"
+}
+
+_DINGDING_MESSAGES = {
+    "text": {"content": "benchmark alert", "at_mobiles": ["13800000000"], "is_at_all": False},
+    "link": {"title": "benchmark", "text": "benchmark alert", "message_url": "https://example.com/alert",
+             "pic_url": "https://example.com/alert.png"},
+    "markdown": {"title": "benchmark", "text": "### benchmark\n> alert\n- host: localhost",
+                 "at_mobiles": ["13800000000"]},
+    "single_actionCard": {"title": "benchmark", "text": "### benchmark alert", "single_title": "detail",
+                          "single_url": "https://example.com/alert"},
+    "multiple_actionCard": {"title": "benchmark", "text": "### benchmark alert", "btn_orientation": "1",
+                            "btns": [{"title": "ack", "actionURL": "https://example.com/ack"},
+                                     {"title": "mute", "actionURL": "https://example.com/mute"}]},
+    "feedCard": {"links": [{"title": "alert {}".format(i), "messageURL": "https://example.com/{}".format(i),
+                            "picURL": "https://example.com/{}.png".format(i)} for i in range(3)]},
+}
+
+
+def _notification_config(directory: str, smtp_port: int, http_port: int) -> str:
+    """
+    :return: 指向替身服务器的通知配置文件路径
+    """
+    path = os.path.join(directory, "notification.json")
+    with open(path, 'w') as f:
+        json.dump({
+            "Email": {"mail_host": "127.0.0.1", "mail_port": str(smtp_port), "mail_user": "vision",
+                      "mail_password": "", "mail_suffix": "localhost", "mail_use_tls": False},
+            "DingDing": {"robot_url": "http://127.0.0.1:{}/robot/send?access_token=".format(http_port),
+                         "robot_token": "benchmark"}
+        }, f)
+    # 基准测试不受钉钉每分钟20条的限流影响
+    from DataVision.LoggerNotification.rate_limiter import get_limiter
+    get_limiter("http://127.0.0.1:{}/robot/send?access_token=benchmark".format(http_port), limit=10 ** 9, period=1)
+    return path
+
+
+def _logger_configs(directory: str, notification_path: str) -> dict:
+    """
+    :return: {Handler名称: logger_config.yaml格式的配置}
+    """
+    file_handler = {
+        "class": "logging.handlers.TimedRotatingFileHandler",
+        "level": "DEBUG",
+        "formatter": "simple",
+        "filename": os.path.join(directory, "vision", "vision_log.log"),
+        "interval": 1,
+        "backupCount": 2,
+        "encoding": "utf8",
+        "when": "H"
+    }
+    handlers = {
+        "console": {"class": "logging.StreamHandler", "level": "DEBUG", "formatter": "simple",
+                    "stream": "ext://sys.stdout"},
+        "file": file_handler,
+        # 默认配置(终端+文件)开启队列模式
+        "queue": None,
+        # 只转发ERROR及以上的报警, 调用方只复制记录并提交给分发器
+        "notification": {"class": "DataVision.LoggerNotification.notification_handler.NotificationHandler",
+                         "level": "ERROR", "formatter": "simple", "config_path": notification_path,
+                         "suppress_window": 0},
+    }
+    configs = {}
+    for name, handler in handlers.items():
+        config = {"version": 1, "disable_existing_loggers": False, "formatters": {"simple": dict(_FORMATTER)},
+                  "root": {"level": "DEBUG"}}
+        if handler is None:
+            config["handlers"] = {"console": handlers["console"], "file": file_handler}
+            config["root"]["handlers"] = ["console", "file"]
+            config["vision"] = {"queue": {"enabled": True, "maxsize": LOG_RECORDS * 2, "overflow": "block"}}
+        else:
+            config["handlers"] = {name: handler}
+            config["root"]["handlers"] = [name]
+        configs[name] = config
+    return configs
+
+
+def bench_vision_logger(directory: str, notification_path: str, scale: float) -> dict:
+    from DataVision.LoggerHandler.logger import VisionLogger
+    results = {}
+    number = int(LOG_RECORDS * scale)
+    with open(os.devnull, 'w') as devnull:
+        for name, config in _logger_configs(directory, notification_path).items():
+            path = os.path.join(directory, "logger_{}.yaml".format(name))
+            # JSON是YAML的子集
+            with open(path, 'w') as f:
+                json.dump(config, f)
+            # 终端输出(ext://sys.stdout)在配置时解析, 重定向到os.devnull
+            with contextlib.redirect_stdout(devnull):
+                logger = VisionLogger(path)
+            for level in LEVELS:
+                def log(i: int, level=level):
+                    logger.vision_logger(level, "benchmark record %d", i)
+                results["vision_logger/{}/{}".format(name, level)] = measure(log, number, ROUNDS)
+    # 关闭队列线程和分发器, 恢复为没有Handler的root
+    from DataVision.LoggerHandler.queue_handler import stop_queue_logging
+    stop_queue_logging()
+    logging.config.dictConfig({"version": 1, "disable_existing_loggers": False, "root": {"handlers": []}})
+    return results
+
+
+def _attachment(size: int) -> bytes:
+    return random.Random(SEED).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def bench_make_message(scale: float) -> dict:
+    from DataVision.LoggerNotification.EmailNotification import EncodedPartCache, make_message
+    results = {}
+    for name, size, number in ATTACHMENT_SIZES:
+        attachments = {"report.bin": _attachment(size)} if size else None
+        for cache_name, cache in (("uncached", None), ("cached", EncodedPartCache())):
+            def build(i: int, attachments=attachments, cache=cache):
+                make_message(sender="vision@localhost", targets="ops@localhost", subject="benchmark {}".format(i),
+                             content="benchmark body", attachments=attachments, part_cache=cache)
+            results["make_message/{}/{}".format(name, cache_name)] = measure(
+                build, max(1, int(number * scale)), ROUNDS, warmup=min(number, 10))
+    return results
+
+
+class _NullSession(object):
+    """
+    只构造消息时不需要HTTP会话
+    """
+
+    async def post(self, *args, **kwargs):
+        raise RuntimeError("基准测试中不发送消息")
+
+
+async def _no_sleep(seconds: float):
+    pass
+
+
+def bench_dingding_make_message(notification_path: str, scale: float) -> dict:
+    from DataVision.LoggerNotification.DingDingNotification import DingDingSender
+    dingding = DingDingSender(config_path=notification_path, sleep=_no_sleep, session=_NullSession())
+    results = {}
+    for msg_type, kwargs in _DINGDING_MESSAGES.items():
+        def build(i: int, msg_type=msg_type, kwargs=kwargs):
+            if dingding.make_message(msg_type, **kwargs) is None:
+                raise ValueError("消息构造失败: {}".format(msg_type))
+        results["dingding_make_message/{}".format(msg_type)] = measure(build, int(MESSAGE_BUILDS * scale), ROUNDS)
+    return results
+
+
+def _send_workers(send, number: int) -> tuple:
+    """
+    多个worker共用一个序号迭代器, 依次取序号并发送(asyncio和curio中都可以使用)
+    :param send: 协程函数, 参数为序号
+    :return: (每次发送的耗时列表, worker协程函数)
+    """
+    latencies = []
+    counter = iter(range(number))
+
+    async def worker():
+        for i in counter:
+            begin = time.perf_counter()
+            await send(i)
+            latencies.append(time.perf_counter() - begin)
+    return latencies, worker
+
+
+def bench_email_send(notification_path: str, smtp: StandInServer, scale: float) -> dict:
+    from DataVision.LoggerNotification.EmailNotification import EmailSender
+    results = {}
+    number = max(SEND_CONCURRENCY, int(SENDS * scale))
+    for name, size in (("plain", 0), ("100KB", 100 * 1024)):
+        attachments = {"report.bin": _attachment(size)} if size else None
+
+        async def run(attachments=attachments) -> list:
+            rounds = []
+            async with EmailSender(config_path=notification_path, pool_size=SEND_CONCURRENCY) as sender:
+                async def send(i: int):
+                    await sender.send_email(["ops@localhost"], "benchmark {}".format(i), "benchmark body",
+                                            attachments=attachments)
+                # 第一轮之前建立好连接池中的连接
+                await asyncio.gather(*[send(i) for i in range(SEND_CONCURRENCY)])
+                for _ in range(ROUNDS):
+                    latencies, worker = _send_workers(send, number)
+                    start = time.perf_counter()
+                    await asyncio.gather(*[worker() for _ in range(SEND_CONCURRENCY)])
+                    rounds.append(summarize(latencies, time.perf_counter() - start))
+            return rounds
+
+        received = smtp.received
+        rounds = asyncio.run(run())
+        if smtp.received - received != number * ROUNDS + SEND_CONCURRENCY:
+            raise RuntimeError("SMTP替身服务器收到的邮件数不正确")
+        results["email_send/{}".format(name)] = best_round(rounds)
+    return results
+
+
+def bench_dingding_send(notification_path: str, robot: StandInServer, scale: float) -> dict:
+    import curio
+    from DataVision.LoggerNotification.DingDingNotification import DingDingSender
+    number = max(SEND_CONCURRENCY, int(SENDS * scale))
+
+    async def run() -> list:
+        dingding = DingDingSender(config_path=notification_path, connections=SEND_CONCURRENCY)
+        rounds = []
+
+        async def send(i: int):
+            result = await dingding.send_message(msg_type="text", content="benchmark {}".format(i))
+            if result is not True:
+                raise RuntimeError("钉钉消息发送失败")
+        try:
+            async with curio.TaskGroup() as group:
+                for i in range(SEND_CONCURRENCY):
+                    await group.spawn(send, i)
+            for _ in range(ROUNDS):
+                latencies, worker = _send_workers(send, number)
+                start = time.perf_counter()
+                async with curio.TaskGroup() as group:
+                    for _ in range(SEND_CONCURRENCY):
+                        await group.spawn(worker)
+                rounds.append(summarize(latencies, time.perf_counter() - start))
+        finally:
+            await dingding.close()
+        return rounds
+
+    received = robot.received
+    rounds = curio.run(run)
+    if robot.received - received != number * ROUNDS + SEND_CONCURRENCY:
+        raise RuntimeError("HTTP替身服务器收到的请求数不正确")
+    return {"dingding_send/text": best_round(rounds)}
+
+
+def bench_metrics(scale: float) -> dict:
+    from DataVision.LoggerNotification.metrics import MetricsRegistry, NotificationMetrics
+    channel = NotificationMetrics(MetricsRegistry()).channel("dingding")
+    number = int(METRIC_WRITES * scale)
+    return {
+        "metrics/counter_inc": measure(lambda i: channel.sends.inc(), number, ROUNDS),
+        "metrics/histogram_observe": measure(lambda i: channel.send_seconds.observe(0.042), number, ROUNDS),
+        "metrics/record_send": measure(lambda i: channel.record(True, 0, 0.042, 512), number, ROUNDS),
+    }
+
+
+def run_suite(groups: list, scale: float) -> dict:
+    """
+    :param groups: 运行的用例组
+    :param scale: 操作数的缩放比例
+    :return: {用例: 统计}
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, \
+            StandInServer.smtp(CONNECT_DELAY, REPLY_DELAY) as smtp, \
+            StandInServer.http(CONNECT_DELAY, REPLY_DELAY) as robot:
+        notification_path = _notification_config(directory, smtp.port, robot.port)
+        for group in groups:
+            print("== {}".format(group), file=sys.stderr)
+            if group == "vision_logger":
+                results.update(bench_vision_logger(directory, notification_path, scale))
+            elif group == "make_message":
+                results.update(bench_make_message(scale))
+            elif group == "dingding_make_message":
+                results.update(bench_dingding_make_message(notification_path, scale))
+            elif group == "email_send":
+                results.update(bench_email_send(notification_path, smtp, scale))
+            elif group == "dingding_send":
+                results.update(bench_dingding_send(notification_path, robot, scale))
+            elif group == "metrics":
+                results.update(bench_metrics(scale))
+            elif group == "formatters":
+                from DataVision.LoggerBenchmark import bench_formatters
+                results.update(bench_formatters.run(scale))
+            elif group == "rotation":
+                from DataVision.LoggerBenchmark import bench_rotation
+                results.update(bench_rotation.run(scale))
+            elif group == "sampling":
+                from DataVision.LoggerBenchmark import bench_sampling
+                results.update(bench_sampling.run(scale))
+            elif group == "collector":
+                from DataVision.LoggerBenchmark import bench_collector
+                results.update(bench_collector.run(scale))
+    return results
+
+
+GROUPS = ("vision_logger", "make_message", "dingding_make_message", "email_send", "dingding_send", "metrics",
+          "formatters", "rotation", "sampling", "collector")
+
+
+def _report(results: dict):
+    print("{:<44} {:>12} {:>10} {:>10} {:>10}".format("case", "ops/s", "p50 us", "p95 us", "p99 us"))
+    for name in sorted(results):
+        result = results[name]
+        print("{:<44} {:>12.1f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            name, result["ops_per_sec"], result["p50_us"], result["p95_us"], result["p99_us"]))
+
+
+def _report_comparison(rows: list) -> int:
+    """
+    :return: 退化的用例数
+    """
+    print("{:<44} {:>12} {:>12} {:>9} {:>9}".format("case", "base ops/s", "ops/s", "ops", "p50"))
+    for name, before, after, throughput, latency, regressed in rows:
+        print("{:<44} {:>12.1f} {:>12.1f} {:>+8.1%} {:>+8.1%}{}".format(
+            name, before, after, throughput, latency, "  REGRESSION" if regressed else ""))
+    return sum(1 for row in rows if row[-1])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="DataVision benchmark suite")
+    parser.add_argument("--output", help="结果JSON的保存路径")
+    parser.add_argument("--compare", help="作为基准的结果JSON")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="吞吐下降或p50延迟上升超过该比例视为退化")
+    parser.add_argument("--group", action="append", choices=GROUPS, help="只运行指定的用例组(可以重复)")
+    parser.add_argument("--quick", action="store_true", help="操作数缩小为1/10, 用于快速检查")
+    args = parser.parse_args(argv)
+
+    baseline = load_results(args.compare) if args.compare else None
+    scale = 0.1 if args.quick else 1.0
+    groups = args.group or list(GROUPS)
+    results = run_suite(groups, scale)
+    _report(results)
+    if args.output:
+        save_results(args.output, results, {"groups": groups, "scale": scale, "rounds": ROUNDS})
+    if baseline is None:
+        return 0
+    if baseline.get("options", {}).get("scale") != scale:
+        print("warning: baseline was recorded with scale {}".format(baseline.get("options", {}).get("scale")))
+    regressions = _report_comparison(compare(baseline["results"], results, args.threshold))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
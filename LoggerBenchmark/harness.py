@@ -0,0 +1,246 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: harness
+基准测试的公共部分: 计时统计、结果保存与对比、本地SMTP/HTTP替身服务器
+"""
+# Python内置库
+import gc
+import json
+import time
+import socket
+import platform
+import threading
+import socketserver
+import http.server
+from typing import Callable, Optional
+
+# 结果文件的格式版本
+RESULT_VERSION = 1
+# 对比时吞吐下降超过该比例视为退化
+DEFAULT_THRESHOLD = 0.2
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    :param values: 已排序的数值
+    """
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(latencies: list, elapsed: float) -> dict:
+    """
+    :param latencies: 每次操作的耗时(秒)
+    :param elapsed: 所有操作的总耗时(秒), 并发时小于latencies之和
+    :return: 吞吐(次/秒)和延迟分布(微秒)
+    """
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "ops": count,
+        "ops_per_sec": round(count / elapsed, 2) if elapsed > 0 else 0.0,
+        "mean_us": round(sum(latencies) / count * 1e6, 2),
+        "p50_us": round(percentile(latencies, 0.5) * 1e6, 2),
+        "p95_us": round(percentile(latencies, 0.95) * 1e6, 2),
+        "p99_us": round(percentile(latencies, 0.99) * 1e6, 2),
+        "max_us": round(latencies[-1] * 1e6, 2),
+    }
+
+
+def measure(func: Callable[[int], object], number: int, rounds: int = 3, warmup: int = 100) -> dict:
+    """
+    同步操作的计时: 每轮调用func(i) number次, 取吞吐最高的一轮
+    :param func: 被测操作, 参数为序号
+    :param number: 每轮的调用次数
+    :param rounds: 轮数
+    :param warmup: 正式计时前的调用次数(填充缓存)
+    """
+    for i in range(warmup):
+        func(i)
+    results = []
+    clock = time.perf_counter
+    for _ in range(rounds):
+        latencies = []
+        append = latencies.append
+        # 避免上一轮的垃圾回收落在本轮的计时中
+        gc.collect()
+        start = clock()
+        for i in range(number):
+            begin = clock()
+            func(i)
+            append(clock() - begin)
+        results.append(summarize(latencies, clock() - start))
+    return best_round(results)
+
+
+def best_round(results: list) -> dict:
+    """
+    :return: 吞吐最高的一轮的统计结果(其他轮次的差异主要来自机器上的其他负载, 与timeit取最小值相同)
+    """
+    result = dict(max(results, key=lambda result: result["ops_per_sec"]))
+    result["rounds"] = len(results)
+    return result
+
+
+def environment() -> dict:
+    """
+    :return: 运行环境, 只有相同环境下的结果才适合直接对比
+    """
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def save_results(path: str, results: dict, options: Optional[dict] = None):
+    with open(path, 'w') as f:
+        json.dump({"version": RESULT_VERSION,
+                   "environment": environment(),
+                   "options": options or {},
+                   "results": results}, f, indent=2, sort_keys=True, ensure_ascii=False)
+
+
+def load_results(path: str) -> dict:
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if data.get("version") != RESULT_VERSION:
+        raise ValueError("结果文件版本不一致: {}".format(path))
+    return data
+
+
+def compare(baseline: dict, current: dict, threshold: float = DEFAULT_THRESHOLD) -> list:
+    """
+    对比两次运行的结果, 只对比两边都有的用例
+    :param baseline: 基准结果{用例: 统计}
+    :param current: 本次结果{用例: 统计}
+    :param threshold: 吞吐下降或p50延迟上升超过该比例视为退化
+    :return: [(用例, 基准吞吐, 本次吞吐, 吞吐变化比例, p50变化比例, 是否退化), ...]
+    """
+    rows = []
+    for name in sorted(set(baseline) & set(current)):
+        before, after = baseline[name], current[name]
+        if not before.get("ops_per_sec") or not after.get("ops_per_sec"):
+            continue
+        throughput = after["ops_per_sec"] / before["ops_per_sec"] - 1
+        latency = after["p50_us"] / before["p50_us"] - 1 if before.get("p50_us") else 0.0
+        regressed = throughput < -threshold or latency > threshold
+        rows.append((name, before["ops_per_sec"], after["ops_per_sec"], throughput, latency, regressed))
+    return rows
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    最小的SMTP服务端会话: 只计数不投递
+    """
+
+    def handle(self):
+        server = self.server
+        time.sleep(server.connect_delay)
+        self._reply("220 localhost DataVision benchmark")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self._reply("250-localhost\r\n250-PIPELINING\r\n250-8BITMIME\r\n250 SIZE 104857600")
+            elif command in (b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+                self._reply("250 OK")
+            elif command == b"DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data in iter(self.rfile.readline, b""):
+                    if data == b".\r\n":
+                        break
+                    size += len(data)
+                time.sleep(server.reply_delay)
+                with server.lock:
+                    server.received += 1
+                    server.received_bytes += size
+                self._reply("250 OK")
+            elif command == b"QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Command not implemented")
+
+    def _reply(self, text: str):
+        self.wfile.write(text.encode('ascii') + b"\r\n")
+
+
+class _HTTPHandler(http.server.BaseHTTPRequestHandler):
+    """
+    钉钉机器人替身: 支持keep-alive, 总是返回发送成功
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        time.sleep(self.server.connect_delay)
+        super().setup()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        time.sleep(server.reply_delay)
+        with server.lock:
+            server.received += 1
+            server.received_bytes += len(body)
+        reply = b'{"errcode": 0, "errmsg": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(object):
+    """
+    在后台线程中运行的本地替身服务器, 每个连接一个线程;
+    connect_delay模拟建立连接(TLS握手/登录)的耗时, reply_delay模拟服务端处理每个请求的耗时.
+    可以用with管理生命周期.
+    """
+
+    def __init__(self, handler, connect_delay: float = 0.0, reply_delay: float = 0.0) -> None:
+        self.port = free_port()
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", self.port), handler)
+        self._server.daemon_threads = True
+        self._server.connect_delay = connect_delay
+        self._server.reply_delay = reply_delay
+        self._server.lock = threading.Lock()
+        self._server.received = 0
+        self._server.received_bytes = 0
+        self._thread = threading.Thread(target=self._server.serve_forever, name="vision-stand-in", daemon=True)
+
+    @classmethod
+    def smtp(cls, connect_delay: float = 0.0, reply_delay: float = 0.0) -> "StandInServer":
+        return cls(_SMTPHandler, connect_delay, reply_delay)
+
+    @classmethod
+    def http(cls, connect_delay: float = 0.0, reply_delay: float = 0.0) -> "StandInServer":
+        return cls(_HTTPHandler, connect_delay, reply_delay)
+
+    @property
+    def received(self) -> int:
+        return self._server.received
+
+    def __enter__(self) -> "StandInServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._server.shutdown()
+        self._server.server_close()
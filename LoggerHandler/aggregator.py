@@ -0,0 +1,514 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: aggregator
+多进程日志汇总: 工作进程把日志记录批量发送到本地socket, 由一个汇总进程统一写文件(包括切分)
+    python -m DataVision.LoggerHandler.aggregator ./LoggerConfig/logger_config.yaml
+"""
+# Python内置库
+import os
+import re
+import sys
+import time
+import errno
+import struct
+import socket
+import logging
+import weakref
+import threading
+from typing import List, Optional
+
+# 连接建立后客户端先发送的协议标识(格式变化时修改版本号)
+PROTOCOL_MAGIC = b"DVL1"
+# 帧: 4字节长度(网络字节序) + 若干条记录
+FRAME_HEADER = struct.Struct("!I")
+# 记录: created, levelno, process, thread, lineno, 字符串部分的字节数, 8个字符串的字符数, 再接UTF-8编码的字符串
+#   name, message, pathname, funcName, threadName, processName, exc_text, stack_info
+# 字符串拼接后整体编码/解码一次, 再按字符数切分
+RECORD_HEADER = struct.Struct("!dBIQII8I")
+# 单帧的最大字节数, 超过视为协议错误
+MAX_FRAME = 64 * 1024 * 1024
+# 默认的socket地址(Unix socket路径, 或者host:port形式的TCP地址)
+DEFAULT_ADDRESS = "./vision/vision_log.sock"
+
+_TCP_ADDRESS = re.compile(r"^([\w.-]+):(\d+)$")
+# 把异常格式化为文本(工作进程中格式化, 汇总进程无法还原traceback对象)
+_exception_formatter = logging.Formatter()
+# 汇总进程中pathname -> (filename, module)的缓存
+_path_cache = {}
+
+
+def _parse_address(address: str):
+    """
+    :return: (socket族, 地址)
+    """
+    match = _TCP_ADDRESS.match(address)
+    if match is not None:
+        return socket.AF_INET, (match.group(1), int(match.group(2)))
+    return socket.AF_UNIX, os.path.abspath(address)
+
+
+# 单独的代理字符按原样编码, 保证解码后字符数不变
+_ERRORS = 'surrogatepass'
+
+
+def encode_record(record: logging.LogRecord) -> bytes:
+    """
+    :param record: 日志记录
+    :return: 二进制编码的记录(消息已经格式化, 异常已经转为文本)
+    """
+    if record.exc_info and not record.exc_text:
+        record.exc_text = _exception_formatter.formatException(record.exc_info)
+    strings = (record.name, record.getMessage(), record.pathname, record.funcName, record.threadName,
+               record.processName, record.exc_text, record.stack_info)
+    strings = [value if value.__class__ is str else ("" if value is None else str(value)) for value in strings]
+    data = "".join(strings).encode('utf-8', _ERRORS)
+    return RECORD_HEADER.pack(record.created, record.levelno, record.process or 0, record.thread or 0,
+                              record.lineno or 0, len(data), *map(len, strings)) + data
+
+
+def decode_records(payload: bytes) -> List[logging.LogRecord]:
+    """
+    :param payload: 一帧的内容
+    :return: 日志记录列表
+    """
+    records = []
+    append = records.append
+    offset, end = 0, len(payload)
+    unpack_from, header_size = RECORD_HEADER.unpack_from, RECORD_HEADER.size
+    start_time = logging._startTime
+    new_record = logging.LogRecord.__new__
+    record_class = logging.LogRecord
+    level_names = {}
+    while offset < end:
+        created, levelno, process, thread, lineno, size, *lengths = unpack_from(payload, offset)
+        offset += header_size
+        text = payload[offset:offset + size].decode('utf-8', _ERRORS)
+        offset += size
+        strings = []
+        position = 0
+        for length in lengths:
+            strings.append(text[position:position + length] or None)
+            position += length
+        name, message, pathname, func_name, thread_name, process_name, exc_text, stack_info = strings
+        names = _path_cache.get(pathname)
+        if names is None:
+            filename = os.path.basename(pathname or "")
+            names = _path_cache[pathname] = (filename, os.path.splitext(filename)[0])
+        levelname = level_names.get(levelno)
+        if levelname is None:
+            levelname = level_names[levelno] = logging.getLevelName(levelno)
+        # 不经过LogRecord.__init__(会重新取时间/进程/线程), 直接填入工作进程中的值
+        record = new_record(record_class)
+        record.__dict__ = {
+            "name": name, "msg": message or "", "args": None,
+            "levelno": levelno, "levelname": levelname,
+            "pathname": pathname, "filename": names[0], "module": names[1],
+            "lineno": lineno, "funcName": func_name,
+            "exc_info": None, "exc_text": exc_text, "stack_info": stack_info,
+            "created": created, "msecs": int((created - int(created)) * 1000) + 0.0,
+            "relativeCreated": (created - start_time) * 1000,
+            "thread": thread, "threadName": thread_name, "processName": process_name, "process": process,
+            "taskName": None,
+        }
+        append(record)
+    return records
+
+
+# 所有工作进程Handler, fork后在子进程中重置连接和缓冲
+_handlers = weakref.WeakSet()
+
+
+def _after_fork():
+    for handler in list(_handlers):
+        handler._reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class AggregatorHandler(logging.Handler):
+    """
+    工作进程使用的Handler: 把记录编码后攒成批, 按帧发送给汇总进程.
+        缓冲满batch_size条或每隔flush_interval秒发送一次;
+        汇总进程处理不过来时, socket发送缓冲区满后会阻塞写日志的线程(不丢日志);
+        汇总进程未启动或连接断开时先保留在缓冲中, 超过max_pending条后丢弃最旧的记录(计入dropped).
+    由config_loader在vision.multiprocess.enabled为True时替换文件Handler, 一般不需要直接配置.
+    """
+
+    def __init__(self,
+                 address: str = DEFAULT_ADDRESS,
+                 batch_size: int = 256,
+                 flush_interval: float = 0.05,
+                 max_pending: int = 100000,
+                 retry_interval: float = 1.0) -> None:
+        """
+        :param address: 汇总进程的地址(Unix socket路径, 或者host:port)
+        :param batch_size: 每批的记录条数
+        :param flush_interval: 不满一批时的发送间隔(秒)
+        :param max_pending: 无法发送时缓冲的最大记录条数
+        :param retry_interval: 连接失败后的重试间隔(秒)
+        """
+        logging.Handler.__init__(self)
+        self.address = address
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retry_interval = retry_interval
+        # 无法发送而被丢弃的记录条数
+        self.dropped = 0
+        self._family, self._address = _parse_address(address)
+        self._reset()
+        _handlers.add(self)
+
+    def _reset(self):
+        """
+        初始化连接和缓冲; fork后的子进程中丢弃父进程的缓冲(父进程会自己发送)
+        """
+        self._sock = None
+        self._pending = []
+        self._retry_at = 0.0
+        self._flusher = None
+        self._stop_event = threading.Event()
+
+    def _connect(self) -> bool:
+        if self._sock is not None:
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        sock = socket.socket(self._family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.retry_interval)
+            sock.connect(self._address)
+            sock.settimeout(None)
+            sock.sendall(PROTOCOL_MAGIC)
+        except OSError:
+            sock.close()
+            self._retry_at = time.monotonic() + self.retry_interval
+            return False
+        self._sock = sock
+        return True
+
+    def _send_pending(self):
+        """
+        发送缓冲中的记录(调用方持有Handler的锁)
+        """
+        if not self._pending:
+            return
+        if self._connect():
+            batch = b"".join(self._pending)
+            try:
+                self._sock.sendall(FRAME_HEADER.pack(len(batch)) + batch)
+                self._pending = []
+                return
+            except OSError:
+                # 汇总进程退出: 这一帧可能只发送了一部分, 重连后整帧重发
+                self._sock.close()
+                self._sock = None
+                self._retry_at = time.monotonic() + self.retry_interval
+        overflow = len(self._pending) - self.max_pending
+        if overflow > 0:
+            del self._pending[:overflow]
+            self.dropped += overflow
+
+    def _start_flusher(self):
+        self._flusher = threading.Thread(target=self._flush_loop, name="VisionLogForwarder", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        stop_event = self._stop_event
+        while stop_event.wait(self.flush_interval) is not True:
+            self.flush()
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self._pending.append(encode_record(record))
+            if self._flusher is None:
+                self._start_flusher()
+            if len(self._pending) >= self.batch_size:
+                self._send_pending()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._send_pending()
+        finally:
+            self.release()
+
+    def close(self):
+        """
+        发送剩余的记录后关闭连接
+        """
+        self._stop_event.set()
+        self.acquire()
+        try:
+            # 最后一次发送不等待重试间隔
+            self._retry_at = 0.0
+            self._send_pending()
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+def forwarded_names(config: dict, options: dict) -> list:
+    """
+    :param config: dictConfig格式的配置
+    :param options: vision.multiprocess配置
+    :return: 交给汇总进程的Handler名称, 默认为所有文件Handler(配置了filename)
+    """
+    handlers = config.get('handlers') or {}
+    names = options.get('handlers')
+    if names is None:
+        names = [name for name, handler_config in handlers.items() if handler_config.get('filename')]
+    return [name for name in names if name in handlers]
+
+
+def forward_handlers(config: dict, options: dict):
+    """
+    工作进程: 把需要汇总的Handler替换为一个AggregatorHandler(工作进程不再打开日志文件)
+    :param config: dictConfig格式的配置(原地修改)
+    :param options: vision.multiprocess配置
+    """
+    names = forwarded_names(config, options)
+    if not names:
+        return
+    handlers = config['handlers']
+    levels = [logging._checkLevel(handlers[name].get('level', logging.NOTSET)) for name in names]
+    forward_config = {
+        'class': 'DataVision.LoggerHandler.aggregator.AggregatorHandler',
+        'level': min(levels),
+        'address': options.get('address', DEFAULT_ADDRESS),
+    }
+    for key in ('batch_size', 'flush_interval', 'max_pending', 'retry_interval'):
+        if key in options:
+            forward_config[key] = options[key]
+    for name in names:
+        del handlers[name]
+    handlers['aggregator'] = forward_config
+    # root和其他logger上的这些Handler替换为aggregator(只保留一个)
+    logger_configs = list((config.get('loggers') or {}).values())
+    if config.get('root'):
+        logger_configs.append(config['root'])
+    for logger_config in logger_configs:
+        logger_handlers = logger_config.get('handlers') or []
+        if any(name in names for name in logger_handlers):
+            kept = []
+            for name in logger_handlers:
+                name = 'aggregator' if name in names else name
+                if name not in kept:
+                    kept.append(name)
+            logger_config['handlers'] = kept
+
+
+class LogAggregator(object):
+    """
+    汇总进程: 监听本地socket, 把工作进程发来的记录交给配置文件中被汇总的Handler.
+    每个连接一个线程; Handler自身的锁保证每条记录完整写入, 不同进程的日志不会交错;
+    文件只由本进程打开和切分, 不会出现多个进程同时切分的竞争.
+    可以用with管理生命周期.
+    """
+
+    def __init__(self, config_path: str, address: Optional[str] = None) -> None:
+        """
+        :param config_path: 日志配置路径(与工作进程相同)
+        :param address: 监听地址, 默认为配置中vision.multiprocess.address
+        """
+        from DataVision.LoggerHandler.config_loader import _make_log_dirs, build_handlers, load_config
+        config = load_config(config_path)
+        options = (config.pop('vision', None) or {}).get('multiprocess') or {}
+        names = forwarded_names(config, options)
+        _make_log_dirs({'handlers': {name: config['handlers'][name] for name in names}})
+        self.handlers = build_handlers(config, names)
+        self.address = address or options.get('address', DEFAULT_ADDRESS)
+        # 收到的记录条数和连接数
+        self.received = 0
+        self.connections = 0
+        self._family, self._address = _parse_address(self.address)
+        self._server = None
+        self._accept_thread = None
+        self._threads = []
+        self._clients = set()
+        self._lock = threading.Lock()
+
+    def _bind(self) -> socket.socket:
+        server = socket.socket(self._family, socket.SOCK_STREAM)
+        if self._family == socket.AF_UNIX:
+            directory = os.path.dirname(self._address)
+            if directory and os.path.exists(directory) is not True:
+                os.makedirs(directory)
+            if os.path.exists(self._address):
+                # 能连上说明已经有汇总进程在运行, 连不上则是上次退出时残留的socket文件
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    probe.connect(self._address)
+                except OSError:
+                    os.remove(self._address)
+                else:
+                    server.close()
+                    raise RuntimeError("汇总进程已经在运行: {}".format(self.address))
+                finally:
+                    probe.close()
+        else:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(self._address)
+        server.listen(128)
+        return server
+
+    def start(self) -> "LogAggregator":
+        self._server = self._bind()
+        self._accept_thread = threading.Thread(target=self._accept_loop, name="VisionLogAggregator", daemon=True)
+        self._accept_thread.start()
+        return self
+
+    def _accept_loop(self):
+        while True:
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                # stop()关闭了监听socket
+                return
+            thread = threading.Thread(target=self._serve, args=(client,), name="VisionLogAggregatorClient",
+                                      daemon=True)
+            with self._lock:
+                self.connections += 1
+                self._clients.add(client)
+                self._threads = [t for t in self._threads if t.is_alive()]
+                self._threads.append(thread)
+            thread.start()
+
+    @staticmethod
+    def _read_exactly(reader, size: int) -> Optional[bytes]:
+        data = reader.read(size)
+        if len(data) < size:
+            return None
+        return data
+
+    def _serve(self, client: socket.socket):
+        handlers = self.handlers
+        try:
+            with client.makefile('rb') as reader:
+                if self._read_exactly(reader, len(PROTOCOL_MAGIC)) != PROTOCOL_MAGIC:
+                    return
+                while True:
+                    header = self._read_exactly(reader, FRAME_HEADER.size)
+                    if header is None:
+                        return
+                    size = FRAME_HEADER.unpack(header)[0]
+                    if size > MAX_FRAME:
+                        return
+                    payload = self._read_exactly(reader, size)
+                    if payload is None:
+                        # 工作进程在发送途中退出, 不完整的帧直接丢弃
+                        return
+                    records = decode_records(payload)
+                    for record in records:
+                        for handler in handlers:
+                            if record.levelno >= handler.level:
+                                handler.handle(record)
+                    with self._lock:
+                        self.received += len(records)
+        except (struct.error, UnicodeDecodeError):
+            # 协议错误(不是本模块的客户端), 断开连接
+            return
+        except OSError as err:
+            if err.errno not in (errno.EBADF, errno.ECONNRESET):
+                raise
+        finally:
+            with self._lock:
+                self._clients.discard(client)
+            client.close()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        停止监听, 等待已连接的工作进程断开(最多timeout秒)后写完剩余日志并关闭Handler
+        """
+        if self._server is not None:
+            # 只close不能唤醒阻塞在accept中的线程
+            try:
+                self._server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._server.close()
+            self._accept_thread.join()
+            self._server = None
+            if self._family == socket.AF_UNIX and os.path.exists(self._address):
+                os.remove(self._address)
+        deadline = time.monotonic() + timeout
+        for thread in list(self._threads):
+            thread.join(max(0.0, deadline - time.monotonic()))
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for thread in list(self._threads):
+            thread.join()
+        for handler in self.handlers:
+            handler.flush()
+            handler.close()
+
+    def __enter__(self) -> "LogAggregator":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+def _run(config_path: str, address: Optional[str], ready=None, stop=None):
+    """
+    汇总进程的入口
+    :param ready: 开始监听后set的事件
+    :param stop: set后退出的事件, None时一直运行到收到SIGTERM/SIGINT
+    """
+    import signal
+    stop = stop or threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stop.set())
+    with LogAggregator(config_path, address):
+        if ready is not None:
+            ready.set()
+        while stop.wait(1) is not True:
+            pass
+
+
+def start_aggregator(config_path: str, address: Optional[str] = None, timeout: float = 10.0):
+    """
+    在子进程中启动汇总进程(一般在启动工作进程之前由主进程调用), 退出时调用terminate()后join()
+    :param config_path: 日志配置路径
+    :param address: 监听地址, 默认为配置中vision.multiprocess.address
+    :param timeout: 等待开始监听的超时时间(秒)
+    :return: multiprocessing.Process
+    """
+    import multiprocessing
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=_run, args=(config_path, address, ready),
+                                      name="VisionLogAggregator", daemon=False)
+    process.start()
+    if ready.wait(timeout) is not True:
+        process.terminate()
+        raise RuntimeError("汇总进程启动失败: {}".format(config_path))
+    return process
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="DataVision多进程日志汇总进程")
+    parser.add_argument("config", help="日志配置路径")
+    parser.add_argument("--address", help="监听地址, 默认为配置中的vision.multiprocess.address")
+    args = parser.parse_args(argv)
+    _run(args.config, args.address)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: collector
+日志采集器: 在内存中按固定容量保存最近的日志(环形缓冲), 报警时可以取出报警之前的日志
+"""
+# Python内置库
+import time
+import array
+import logging
+import weakref
+import itertools
+import collections
+from typing import List, Optional
+
+# 单条消息保存的最大字符数(超出时截断), 保证内存占用可预期
+DEFAULT_MAX_MESSAGE = 1000
+# 异常保存的最大字符数(超出时保留末尾, 末尾是抛出异常的位置)
+DEFAULT_MAX_EXCEPTION = 4000
+# levelno按无符号短整型保存
+_MAX_LEVEL = 0xFFFF
+
+# 把异常格式化为文本(之前的Handler没有格式化过时使用)
+_exception_formatter = logging.Formatter()
+
+
+class LogEntry(collections.namedtuple("LogEntry", ("created", "levelno", "logger", "message", "exc_text"))):
+    """
+    快照中的一条日志
+    """
+    __slots__ = ()
+
+    @property
+    def levelname(self) -> str:
+        return logging.getLevelName(self.levelno)
+
+    def format(self) -> str:
+        """
+        :return: 时间(精确到毫秒) 等级 logger - 消息[ + 异常]
+        """
+        text = "{}.{:03d} {} {} - {}".format(time.strftime("%H:%M:%S", time.localtime(self.created)),
+                                            int(self.created * 1000) % 1000, self.levelname, self.logger,
+                                            self.message)
+        if self.exc_text:
+            text = "{}\n{}".format(text, self.exc_text)
+        return text
+
+
+_new_tuple = tuple.__new__
+
+# 所有未关闭的采集器, 按创建顺序排列(热加载时新建的排在后面)
+_collectors = []
+
+
+def get_collector(name: Optional[str] = None) -> Optional["RingBufferHandler"]:
+    """
+    :param name: Handler名称(yaml中handlers下的名称), 默认为最后创建的采集器
+    :return: 采集器, 没有配置时为None
+    """
+    for reference in reversed(_collectors):
+        collector = reference()
+        if collector is not None and (name is None or collector.name == name):
+            return collector
+    return None
+
+
+def _to_level(level) -> int:
+    if level is None:
+        return logging.NOTSET
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).upper())
+    if isinstance(value, int) is not True:
+        raise ValueError("日志级别不存在: {}".format(level))
+    return value
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    最近日志的环形缓冲, 作为Handler挂在root上即可采集vision_logger的所有日志:
+        按列保存(时间和等级为array, logger/消息/异常为预先分配的列表), 不为每条日志保存LogRecord或字典;
+        容量固定, 写满后覆盖最旧的日志, 消息和异常超长时截断, 内存占用不超过
+            capacity * (max_message + max_exception) 个字符加上固定的列开销;
+        前面的Handler已经格式化过消息时直接复用(record.message), 不重复格式化.
+    可以在logger_config.yaml中配置:
+        collector:
+            class: DataVision.LoggerHandler.collector.RingBufferHandler
+            level: DEBUG
+            capacity: 500
+    取出日志: get_collector().snapshot(level="WARNING", since=time.time() - 60, limit=100)
+    """
+
+    def __init__(self,
+                 capacity: int = 500,
+                 max_message: int = DEFAULT_MAX_MESSAGE,
+                 max_exception: int = DEFAULT_MAX_EXCEPTION,
+                 level=logging.NOTSET) -> None:
+        """
+        :param capacity: 保存的日志条数
+        :param max_message: 单条消息保存的最大字符数
+        :param max_exception: 单条异常保存的最大字符数
+        :param level: Handler的级别
+        """
+        if capacity < 1:
+            raise ValueError("采集器容量必须大于0: {}".format(capacity))
+        logging.Handler.__init__(self, level=_to_level(level))
+        self.capacity = capacity
+        self.max_message = max_message
+        self.max_exception = max_exception
+        self._created = array.array('d', [0.0]) * capacity
+        self._levelno = array.array('H', [0]) * capacity
+        self._logger = [None] * capacity
+        self._message = [None] * capacity
+        self._exc_text = [None] * capacity
+        # 写入过的总条数, 下一条写入的位置为count % capacity
+        self.count = 0
+        _collectors.append(weakref.ref(self))
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            # 前面的Handler格式化时已经设置了record.message
+            message = record.__dict__.get('message')
+            if message is None:
+                message = record.getMessage()
+            if len(message) > self.max_message:
+                message = message[:self.max_message]
+            exc_text = record.exc_text
+            if record.exc_info and not exc_text:
+                exc_text = record.exc_text = _exception_formatter.formatException(record.exc_info)
+            if exc_text and len(exc_text) > self.max_exception:
+                exc_text = exc_text[-self.max_exception:]
+            # 调用方(Handler.handle)已经持有锁
+            slot = self.count % self.capacity
+            self._created[slot] = record.created
+            self._levelno[slot] = min(record.levelno, _MAX_LEVEL)
+            self._logger[slot] = record.name
+            self._message[slot] = message
+            self._exc_text[slot] = exc_text
+            self.count += 1
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def snapshot(self, level=None, since: Optional[float] = None, limit: Optional[int] = None) -> List[LogEntry]:
+        """
+        取出缓冲中的日志(线程安全, 只复制符合条件的条目)
+        :param level: 最低等级(名称或数值), 默认为所有等级
+        :param since: 只取该时间戳(time.time())之后的日志
+        :param limit: 最多取最近的多少条
+        :return: 按写入顺序(从旧到新)排列的日志
+        """
+        levelno = _to_level(level)
+        entries = []
+        if limit is not None and limit <= 0:
+            return entries
+        if limit is None:
+            limit = self.capacity
+        self.acquire()
+        try:
+            created, levels = self._created, self._levelno
+            loggers, messages, exc_texts = self._logger, self._message, self._exc_text
+            # 从最新的一条往前找(先是写入位置之前的部分, 写满时再从末尾往前), 满足limit或者早于since时停止
+            position = self.count % self.capacity
+            slots = range(position - 1, -1, -1)
+            if self.count >= self.capacity:
+                slots = itertools.chain(slots, range(self.capacity - 1, position - 1, -1))
+            for slot in slots:
+                if since is not None and created[slot] < since:
+                    break
+                if levels[slot] < levelno:
+                    continue
+                # 跳过namedtuple的__new__参数解析
+                entries.append(_new_tuple(LogEntry, (created[slot], levels[slot], loggers[slot], messages[slot],
+                                                     exc_texts[slot])))
+                if len(entries) >= limit:
+                    break
+        finally:
+            self.release()
+        entries.reverse()
+        return entries
+
+    def clear(self):
+        self.acquire()
+        try:
+            self.count = 0
+            for column in (self._logger, self._message, self._exc_text):
+                column[:] = [None] * self.capacity
+        finally:
+            self.release()
+
+    def close(self):
+        for reference in list(_collectors):
+            if reference() is self or reference() is None:
+                _collectors.remove(reference)
+        logging.Handler.close(self)
@@ -0,0 +1,316 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: config_loader
+日志配置加载模块(进程内缓存和热加载)
+"""
+# Python内置库
+import os
+import copy
+import logging
+import threading
+import logging.config
+
+# Python第三方库
+import yaml
+
+# 项目内部库
+from DataVision.LoggerHandler.aggregator import forward_handlers
+from DataVision.LoggerHandler.formatters import format_uses_caller
+from DataVision.LoggerHandler.queue_handler import (
+    start_queue_logging,
+    stop_queue_logging,
+    swap_queue_handlers
+)
+
+# YAML解析器, 优先使用libyaml的C加速版本
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# 解析后的配置缓存 {绝对路径: ((mtime, size), 配置)}
+_config_cache = {}
+# 当前生效的配置 (绝对路径, mtime, size)
+_applied_key = None
+# 当前生效的vision扩展配置
+_applied_vision = {}
+# 当前由配置文件创建的root Handler名称
+_root_handler_names = set()
+# 热加载线程
+_watcher = None
+_config_lock = threading.RLock()
+
+# vision.caller: 查找调用位置(文件名/行号/函数名)的方式
+#   auto - 只有Formatter或Handler用到调用位置时vision_logger才查找
+#   always - vision_logger总是查找
+#   never - 都不查找, 同时关闭logging模块自身的查找(logging._srcfile), 对所有logger生效
+CALLER_MODES = ("auto", "always", "never")
+# vision_logger是否需要查找调用位置
+caller_info = True
+_logging_srcfile = logging._srcfile
+
+
+def _file_key(path: str) -> tuple:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_config(path: str) -> dict:
+    """
+    读取并解析yaml配置, 文件未修改时直接返回缓存
+    :param path: 配置路径
+    :return: 配置的副本(dictConfig会修改传入的配置)
+    """
+    path = os.path.abspath(path)
+    with _config_lock:
+        key = _file_key(path)
+        cached = _config_cache.get(path)
+        if cached is None or cached[0] != key:
+            with open(path, 'rt') as f:
+                config = yaml.load(f.read(), Loader=YAML_LOADER)
+            cached = (key, config)
+            _config_cache[path] = cached
+        return copy.deepcopy(cached[1])
+
+
+def _make_log_dirs(config: dict):
+    """
+    创建文件Handler所需的日志目录
+    """
+    for handler_config in (config.get('handlers') or {}).values():
+        filename = handler_config.get('filename')
+        if filename:
+            directory = os.path.dirname(filename)
+            if directory and os.path.exists(directory) is not True:
+                os.makedirs(directory)
+
+
+def _resolve(name: str):
+    try:
+        return logging.config.BaseConfigurator({}).resolve(name)
+    except (ImportError, ValueError):
+        return None
+
+
+def needs_caller(config: dict) -> bool:
+    """
+    :param config: dictConfig格式的配置
+    :return: 配置的Handler、Formatter或Filter(如按调用位置采样)是否用到调用位置
+    """
+    for filter_config in (config.get('filters') or {}).values():
+        factory = filter_config.get('()')
+        if isinstance(factory, str):
+            factory = _resolve(factory)
+        uses_caller = getattr(factory, 'config_uses_caller', None)
+        if uses_caller is not None and uses_caller(filter_config):
+            return True
+    formatters = config.get('formatters') or {}
+    for handler_config in (config.get('handlers') or {}).values():
+        handler_class = handler_config.get('class') or handler_config.get('()')
+        if isinstance(handler_class, str):
+            handler_class = _resolve(handler_class)
+        if getattr(handler_class, 'uses_caller', False):
+            return True
+        formatter_config = formatters.get(handler_config.get('formatter'))
+        if formatter_config is None:
+            continue
+        if formatter_config.get('caller') or \
+                format_uses_caller(formatter_config.get('format') or formatter_config.get('fmt')):
+            return True
+    return False
+
+
+def _apply_caller(config: dict, vision_config: dict):
+    """
+    按vision.caller设置是否查找调用位置
+    """
+    global caller_info
+    mode = vision_config.get('caller', 'auto')
+    if mode not in CALLER_MODES:
+        raise ValueError("vision.caller只能是{}".format("/".join(CALLER_MODES)))
+    if mode == 'auto':
+        caller_info = needs_caller(config)
+    else:
+        caller_info = mode == 'always'
+    logging._srcfile = None if mode == 'never' else _logging_srcfile
+
+
+def _apply_multiprocess(config: dict, vision_config: dict):
+    """
+    vision.multiprocess开启时, 文件Handler替换为发送给汇总进程的AggregatorHandler
+    (汇总进程见DataVision.LoggerHandler.aggregator)
+    """
+    options = vision_config.get('multiprocess') or {}
+    if options.get('enabled'):
+        forward_handlers(config, options)
+
+
+def _apply_config(config: dict):
+    """
+    完整地应用配置(会关闭并重建所有Handler)
+    """
+    global _applied_vision, _root_handler_names
+    # vision为本项目的扩展配置, 不属于dictConfig的字段
+    vision_config = config.pop('vision', None) or {}
+    _apply_caller(config, vision_config)
+    _apply_multiprocess(config, vision_config)
+    _root_handler_names = set((config.get('root') or {}).get('handlers') or [])
+    _make_log_dirs(config)
+    # 重新配置前先把队列中的日志写完, 避免Handler被关闭后丢日志
+    stop_queue_logging()
+    # dictConfig只会给root追加Filter, 不会移除之前配置的Filter(如采样)
+    root = logging.getLogger()
+    for old_filter in list(root.filters):
+        root.removeFilter(old_filter)
+    logging.config.dictConfig(config)
+    queue_config = vision_config.get('queue') or {}
+    if queue_config.get('enabled'):
+        start_queue_logging(logging.getLogger(), queue_config)
+    _applied_vision = vision_config
+
+
+def configure(path: str, force: bool = False) -> bool:
+    """
+    按配置文件配置日志, 同一个文件未修改时不会重复配置
+    :param path: 配置路径
+    :param force: 是否强制重新配置
+    :return: 是否进行了配置
+    """
+    global _applied_key
+    path = os.path.abspath(path)
+    with _config_lock:
+        key = (path,) + _file_key(path)
+        if key == _applied_key and force is not True:
+            return False
+        config = load_config(path)
+        _apply_config(config)
+        _applied_key = key
+        _start_watcher(path, _applied_vision.get('reload') or {})
+        return True
+
+
+def build_handlers(config: dict, names: list) -> list:
+    """
+    按配置新建指定名称的Handler(及其Formatter/Filter), 不影响当前正在使用的Handler
+    :param config: dictConfig格式的配置
+    :param names: Handler名称列表
+    :return: Handler列表
+    """
+    configurator = logging.config.DictConfigurator(config)
+    config = configurator.config
+    formatters = config.get('formatters', {})
+    for name in formatters:
+        formatters[name] = configurator.configure_formatter(formatters[name])
+    filters = config.get('filters', {})
+    for name in filters:
+        filters[name] = configurator.configure_filter(filters[name])
+    handlers_config = config.get('handlers', {})
+    handlers = []
+    for name in names:
+        handler = configurator.configure_handler(handlers_config[name])
+        handler.name = name
+        handlers.append(handler)
+    return handlers
+
+
+def _build_root_handlers(config: dict) -> tuple:
+    """
+    按配置新建root使用的Handler, 不影响当前正在使用的Handler
+    :return: (Handler列表, root等级)
+    """
+    root_config = config.get('root') or {}
+    return build_handlers(config, list(root_config.get('handlers') or [])), root_config.get('level')
+
+
+def reload_config(path: str) -> bool:
+    """
+    热加载配置: 先建好新的Handler再原子替换, 替换过程中的日志不会丢失.
+    vision扩展配置或者非root的logger配置发生变化时退化为完整的重新配置.
+    :param path: 配置路径
+    :return: 是否进行了配置
+    """
+    global _applied_key, _applied_vision, _root_handler_names
+    path = os.path.abspath(path)
+    with _config_lock:
+        key = (path,) + _file_key(path)
+        if key == _applied_key:
+            return False
+        config = load_config(path)
+        vision_config = config.pop('vision', None) or {}
+        if vision_config.get('reload') != _applied_vision.get('reload'):
+            _start_watcher(path, vision_config.get('reload') or {})
+        # root的Filter只能在完整的重新配置中替换
+        if config.get('loggers') or (config.get('root') or {}).get('filters') or logging.getLogger().filters or \
+                vision_config.get('queue') != _applied_vision.get('queue') or \
+                vision_config.get('multiprocess') != _applied_vision.get('multiprocess') or \
+                _applied_key is None or _applied_key[0] != path:
+            config['vision'] = vision_config
+            _apply_config(config)
+            _applied_key = key
+            return True
+        _apply_caller(config, vision_config)
+        _apply_multiprocess(config, vision_config)
+        _make_log_dirs(config)
+        handlers, level = _build_root_handlers(config)
+        root = logging.getLogger()
+        old_handlers = swap_queue_handlers(handlers)
+        if old_handlers is None:
+            old_handlers = [h for h in root.handlers if h.name in _root_handler_names]
+            kept = [h for h in root.handlers if h not in old_handlers]
+            # 列表赋值是原子操作, 正在输出的日志继续使用旧的Handler
+            root.handlers = kept + handlers
+        if level is not None:
+            root.setLevel(level)
+        for handler in old_handlers:
+            # 替换前开始输出的日志可能还在使用旧的Handler(handle期间持有它的锁), 获取锁后再关闭
+            handler.acquire()
+            try:
+                handler.flush()
+                handler.close()
+            finally:
+                handler.release()
+        _root_handler_names = set(h.name for h in handlers)
+        _applied_vision = vision_config
+        _applied_key = key
+        return True
+
+
+class ConfigWatcher(threading.Thread):
+    """
+    轮询配置文件的修改时间, 文件变化后热加载配置
+    """
+
+    def __init__(self, path: str, interval: float = 5):
+        """
+        :param path: 配置路径
+        :param interval: 轮询间隔(秒)
+        """
+        threading.Thread.__init__(self, name="VisionConfigWatcher", daemon=True)
+        self.path = path
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while self._stop_event.wait(self.interval) is not True:
+            try:
+                reload_config(self.path)
+            except Exception as err:
+                # 配置写到一半或者格式错误时保留旧的配置
+                logging.getLogger().error("日志配置热加载失败: %s", err)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def _start_watcher(path: str, options: dict):
+    """
+    按vision.reload配置启动或停止热加载线程
+    :param path: 配置路径
+    :param options: vision.reload配置
+    """
+    global _watcher
+    if _watcher is not None:
+        _watcher.stop()
+        _watcher = None
+    if options.get('enabled'):
+        _watcher = ConfigWatcher(path, options.get('interval', 5))
+        _watcher.start()
@@ -0,0 +1,173 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: formatters
+日志格式: 缓存时间格式化结果的文本格式和结构化的JSON行格式
+"""
+# Python内置库
+import re
+import json
+import time
+import logging
+from typing import List, Optional
+
+# 需要调用位置的LogRecord字段(查找调用位置需要遍历调用栈)
+CALLER_FIELDS = ("pathname", "filename", "module", "lineno", "funcName")
+# %、{}和$三种格式中引用调用位置字段的写法
+_CALLER_REGEX = re.compile(r"(?:%\(|\{|\$\{?)(?:" + "|".join(CALLER_FIELDS) + r")\b")
+
+# JSON序列化后端
+JSON_BACKENDS = ("auto", "orjson", "json")
+
+
+def format_uses_caller(fmt: Optional[str]) -> bool:
+    """
+    :param fmt: 日志格式
+    :return: 格式中是否使用了调用位置(文件名/行号/函数名)
+    """
+    return bool(fmt) and _CALLER_REGEX.search(fmt) is not None
+
+
+class FastFormatter(logging.Formatter):
+    """
+    输出与logging.Formatter相同的文本格式:
+        指定了datefmt时, 同一秒内的asctime只调用一次strftime;
+        是否使用asctime在创建时判断一次, 不在每条日志上重复判断.
+    可以在logger_config.yaml中替换simple:
+        fast:
+            class: DataVision.LoggerHandler.formatters.FastFormatter
+            format: "%(asctime)s - Mode:%(levelname)s - Message:%(message)s"
+            datefmt: '%F %T'
+    格式中没有文件名/行号等调用位置字段时, vision_logger不再查找调用位置(见vision.caller).
+    """
+
+    def __init__(self, fmt: Optional[str] = None, datefmt: Optional[str] = None, style: str = '%', **kwargs):
+        super().__init__(fmt, datefmt, style, **kwargs)
+        self._uses_time = super().usesTime()
+        self.uses_caller = format_uses_caller(self._fmt)
+        # (秒, 格式化结果), 作为一个整体替换, 多线程下不会读到不一致的缓存
+        self._cached_time = (None, None)
+
+    def usesTime(self) -> bool:
+        return self._uses_time
+
+    def formatTime(self, record: logging.LogRecord, datefmt: Optional[str] = None) -> str:
+        # %f等秒以下的格式不能按秒缓存, 没有datefmt时默认格式带毫秒, 交给logging处理
+        if datefmt is None or "%f" in datefmt:
+            return super().formatTime(record, datefmt)
+        second = int(record.created)
+        cached_second, text = self._cached_time
+        if cached_second != second:
+            text = time.strftime(datefmt, self.converter(record.created))
+            self._cached_time = (second, text)
+        return text
+
+
+def _load_backend(backend: str):
+    """
+    :return: (序列化函数(返回str), 后端名称)
+    """
+    if backend not in JSON_BACKENDS:
+        raise ValueError("JSON序列化后端不存在: {}".format(backend))
+    if backend in ("auto", "orjson"):
+        try:
+            import orjson
+        except ImportError:
+            if backend == "orjson":
+                raise
+        else:
+            dumps = orjson.dumps
+
+            def encode(value: dict) -> str:
+                return dumps(value, default=str).decode('utf-8')
+            return encode, "orjson"
+    # json.dumps每次调用都会按参数新建编码器, 预先建好直接使用
+    return json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=str).encode, "json"
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    JSON行格式, 每条日志输出一行JSON对象, 日志采集端不需要再用正则解析:
+        {"time": "...", "level": "ERROR", "logger": "root", "message": "...", "pid": 1234,
+         "host": "...", "service": "...", "file": "...", "line": 10, "function": "...", "exc_info": "..."}
+    host、service和static中的字段在创建时序列化一次, 每条日志只序列化变化的字段;
+    caller为True时才输出调用位置(file/line/function), 为False时vision_logger不查找调用位置;
+    backend为auto时安装了orjson则使用orjson, 否则使用标准库json.
+    可以在logger_config.yaml中配置:
+        json:
+            (): DataVision.LoggerHandler.formatters.JsonFormatter
+            service: DataVision
+            fields: [threadName]
+            caller: False
+            backend: auto
+    """
+
+    def __init__(self,
+                 service: Optional[str] = None,
+                 static: Optional[dict] = None,
+                 fields: Optional[List[str]] = None,
+                 caller: bool = False,
+                 backend: str = "auto",
+                 datefmt: str = "%Y-%m-%dT%H:%M:%S",
+                 host: Optional[str] = None) -> None:
+        """
+        :param service: 服务名称
+        :param static: 其他固定字段
+        :param fields: 额外输出的LogRecord属性(如threadName、process)
+        :param caller: 是否输出调用位置
+        :param backend: JSON序列化后端 auto/orjson/json
+        :param datefmt: 时间格式(之后会加上毫秒和时区)
+        :param host: 主机名, 默认为当前主机名
+        """
+        super().__init__(datefmt=datefmt)
+        self.fields = list(fields or [])
+        self.uses_caller = caller
+        self._encode, self.backend = _load_backend(backend)
+        if host is None:
+            import socket
+            host = socket.gethostname()
+        static_fields = {"host": host}
+        if service:
+            static_fields["service"] = service
+        static_fields.update(static or {})
+        # 固定字段序列化后的片段: "host":"...","service":"..."
+        self._static = self._encode(static_fields)[1:-1]
+        self._cached_time = (None, None)
+
+    def formatTime(self, record: logging.LogRecord, datefmt: Optional[str] = None) -> str:
+        second = int(record.created)
+        cached_second, parts = self._cached_time
+        if cached_second != second:
+            struct_time = self.converter(record.created)
+            zone = time.strftime("%z", struct_time)
+            # (秒级时间, +08:00格式的时区)
+            parts = (time.strftime(self.datefmt, struct_time), zone[:3] + ":" + zone[3:] if zone else "")
+            self._cached_time = (second, parts)
+        return "{}.{:03d}{}".format(parts[0], int(record.msecs), parts[1])
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+        }
+        if self.uses_caller:
+            data["file"] = record.pathname
+            data["line"] = record.lineno
+            data["function"] = record.funcName
+        for field in self.fields:
+            data[field] = getattr(record, field, None)
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc_info"] = record.exc_text
+        if record.stack_info:
+            data["stack_info"] = self.formatStack(record.stack_info)
+        line = self._encode(data)
+        if self._static:
+            line = line[:-1] + "," + self._static + "}"
+        return line
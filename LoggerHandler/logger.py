@@ -7,10 +7,39 @@ Created on 2018年11月15日
 """
 # Python内置库
 import os
-import logging.config
+import sys
+import logging
 
-# Python第三方库
-import yaml
+# 项目内部库
+from DataVision.LoggerHandler import config_loader
+from DataVision.LoggerHandler.collector import get_collector
+from DataVision.LoggerHandler.config_loader import configure
+
+# 日志等级对照表(兼容WARN的写法)
+LEVEL_TABLE = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARN": logging.WARNING,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+    "CRITICAL": logging.CRITICAL
+}
+
+
+class LazyMessage(object):
+    """
+    延迟生成的日志内容, 只有Handler真正输出时才会调用func
+    """
+    __slots__ = ('_func', '_text')
+
+    def __init__(self, func):
+        self._func = func
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = str(self._func())
+        return self._text
 
 
 class VisionLogger(object):
@@ -23,17 +52,16 @@ class VisionLogger(object):
         :param default_path: Logger Yaml的默认路径
         :param default_level: Logger默认等级
         """
-        if os.path.exists('vision') is not True:
-            os.mkdir('vision')
         # 获取配置路径
         path = default_path
         if os.path.exists(path):
-            with open(path, 'rt') as f:
-                config = yaml.load(f.read())
-                logging.config.dictConfig(config)
+            # 同一个配置文件未修改时不会重复解析和配置
+            configure(path)
         else:
             logging.basicConfig(level=default_level)
             logging.error('路径不存在!')
+        # root logger在进程内是唯一的, 缓存后不用每次调用都去获取
+        self._logger = logging.getLogger()
 
     @staticmethod
     def get_logger():
@@ -43,23 +71,62 @@ class VisionLogger(object):
         """
         return logging.getLogger()
 
-    def vision_logger(self, level='INFO', log_msg: str = ""):
+    @staticmethod
+    def get_collector(name=None):
+        """
+        日志采集器(yaml中配置的RingBufferHandler), vision_logger的日志经由root的Handler写入采集器
+        :param name: Handler名称, 默认为最后创建的采集器
+        :return: 采集器, 没有配置时为None
+        """
+        return get_collector(name)
+
+    def recent_logs(self, level=None, since=None, limit=None) -> list:
+        """
+        最近的日志(从旧到新), 没有配置采集器时为空列表
+        :param level: 最低等级
+        :param since: 只取该时间戳(time.time())之后的日志
+        :param limit: 最多取最近的多少条
+        :return: [LogEntry, ...], LogEntry.format()为单行文本
+        """
+        collector = get_collector()
+        if collector is None:
+            return []
+        return collector.snapshot(level=level, since=since, limit=limit)
+
+    def is_enabled(self, level='INFO') -> bool:
+        """
+        判断该等级的日志是否会被输出, 用于调用方跳过昂贵的日志内容构造
+        :param level: 日志等级
+        :return: 会输出 - True, 不会输出 - False
+        """
+        levelno = LEVEL_TABLE.get(level)
+        if levelno is None:
+            raise ValueError("日志等级不存在或者拼写错误!")
+        return self._logger.isEnabledFor(levelno)
+
+    def vision_logger(self, level='INFO', log_msg="", *args):
         """
         带采集功能的日志
+        :param level: 日志等级
+        :param log_msg: 日志内容, 可以是%格式的模板(配合args使用), 也可以是返回日志内容的callable
+        :param args: %格式的参数, 只有日志真正输出时才会格式化
         """
-        # 获取默认的logger
-        logger = self.get_logger()
-        # 分级输出
-        if level == "DEBUG":
-            logger.debug(log_msg)
-        elif level == 'INFO':
-            logger.info(log_msg)
-        elif level == 'WARN':
-            logger.warning(log_msg)
-        elif level == 'ERROR':
-            logger.error(log_msg)
-        elif level == 'CRITICAL':
-            logger.critical(log_msg)
-        else:
+        levelno = LEVEL_TABLE.get(level)
+        if levelno is None:
             raise ValueError("日志等级不存在或者拼写错误!")
-        # TODO 日志采集器的加载方法
+        # 等级未开启时不做任何格式化
+        logger = self._logger
+        if not logger.isEnabledFor(levelno):
+            return
+        if callable(log_msg):
+            log_msg = LazyMessage(log_msg)
+        if config_loader.caller_info:
+            # 调用方就是上一层栈帧, 不需要像logging那样逐层遍历调用栈
+            frame = sys._getframe(1)
+            code = frame.f_code
+            record = logger.makeRecord(logger.name, levelno, code.co_filename, frame.f_lineno,
+                                       log_msg, args, None, code.co_name)
+        else:
+            record = logger.makeRecord(logger.name, levelno, "(unknown file)", 0,
+                                       log_msg, args, None, "(unknown function)")
+        logger.handle(record)
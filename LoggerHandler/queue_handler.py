@@ -0,0 +1,215 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: queue_handler
+队列日志模块(非阻塞写日志)
+"""
+# Python内置库
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+# 队列满时的处理策略
+OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_below_level")
+# 停止时等待后台线程写完剩余日志的最长秒数
+STOP_TIMEOUT = 10
+# 后台线程检查停止标志的间隔(秒), 唤醒用的哨兵被溢出策略丢弃时也能退出
+STOP_POLL_INTERVAL = 0.5
+
+
+class VisionQueueHandler(logging.handlers.QueueHandler):
+    """
+    有界队列Handler, 调用方只负责把日志放入内存队列,
+    真正的磁盘/终端IO交给后台的QueueListener线程完成.
+    """
+
+    def __init__(self,
+                 maxsize: int = 10000,
+                 overflow: str = "block",
+                 drop_level=logging.WARNING,
+                 block_timeout=None):
+        """
+        :param maxsize: 队列最大长度
+        :param overflow: 队列满时的策略
+            block - 阻塞等待(超过block_timeout则丢弃)
+            drop_oldest - 丢弃队列中最旧的一条日志
+            drop_below_level - 低于drop_level的日志直接丢弃, 其余阻塞等待
+        :param drop_level: drop_below_level策略下的分界等级
+        :param block_timeout: 阻塞等待的超时时间(秒), None为一直等待
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("队列溢出策略不存在: {}".format(overflow))
+        logging.handlers.QueueHandler.__init__(self, queue.Queue(maxsize=maxsize))
+        self.overflow = overflow
+        self.drop_level = logging._checkLevel(drop_level)
+        self.block_timeout = block_timeout
+        # 被丢弃的日志条数
+        self.dropped = 0
+        self._drop_lock = threading.Lock()
+
+    def _count_drop(self):
+        with self._drop_lock:
+            self.dropped += 1
+
+    def _put_blocking(self, record):
+        try:
+            self.queue.put(record, block=True, timeout=self.block_timeout)
+        except queue.Full:
+            self._count_drop()
+
+    def enqueue(self, record):
+        """
+        按溢出策略把日志放入队列
+        :param record: 日志记录
+        """
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        if self.overflow == "drop_oldest":
+            while True:
+                try:
+                    self.queue.get_nowait()
+                    self._count_drop()
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(record)
+                    return
+                except queue.Full:
+                    continue
+        elif self.overflow == "drop_below_level" and record.levelno < self.drop_level:
+            self._count_drop()
+        else:
+            self._put_blocking(record)
+
+
+class VisionQueueListener(logging.handlers.QueueListener):
+    """
+    用停止标志结束的QueueListener:
+        标准的QueueListener只在取到哨兵时退出, 而drop_oldest策略可能把哨兵当作最旧的日志丢弃, 使stop一直等待;
+        这里哨兵只用于唤醒, 设置停止标志后后台线程写完队列中剩余的日志就退出, stop的等待也有超时.
+    """
+
+    def __init__(self, record_queue, *handlers, respect_handler_level: bool = False) -> None:
+        logging.handlers.QueueListener.__init__(self, record_queue, *handlers,
+                                                respect_handler_level=respect_handler_level)
+        self._stopping = threading.Event()
+
+    def _monitor(self):
+        q = self.queue
+        while True:
+            stopping = self._stopping.is_set()
+            try:
+                # 停止后不再等待新的日志, 队列取空即退出
+                record = q.get_nowait() if stopping else q.get(timeout=STOP_POLL_INTERVAL)
+            except queue.Empty:
+                if stopping:
+                    break
+                continue
+            if record is self._sentinel:
+                self._stopping.set()
+            else:
+                self.handle(record)
+            q.task_done()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        停止后台线程, 队列满时不等待哨兵放入队列
+        :param timeout: 等待后台线程写完剩余日志的最长秒数, None为一直等待
+        :return: 后台线程是否已经退出
+        """
+        self._stopping.set()
+        try:
+            self.queue.put_nowait(self._sentinel)
+        except queue.Full:
+            pass
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return True
+        thread.join(timeout)
+        return thread.is_alive() is not True
+
+
+# 当前生效的队列Handler、后台监听线程以及对应的logger
+_queue_handler = None
+_listener = None
+_queue_logger = None
+_state_lock = threading.RLock()
+
+
+def start_queue_logging(logger: logging.Logger, queue_config: dict) -> VisionQueueHandler:
+    """
+    把logger上已配置的Handler挪到后台线程, 并用队列Handler替代
+    :param logger: 需要开启队列模式的logger(一般为root)
+    :param queue_config: yaml中vision.queue的配置
+    :return: 队列Handler
+    """
+    global _queue_handler, _listener, _queue_logger
+    with _state_lock:
+        stop_queue_logging()
+        handlers = [h for h in logger.handlers if not isinstance(h, VisionQueueHandler)]
+        queue_handler = VisionQueueHandler(
+            maxsize=queue_config.get('maxsize', 10000),
+            overflow=queue_config.get('overflow', 'block'),
+            drop_level=queue_config.get('drop_level', logging.WARNING),
+            block_timeout=queue_config.get('block_timeout')
+        )
+        listener = VisionQueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        listener.start()
+        _queue_handler, _listener, _queue_logger = queue_handler, listener, logger
+        return queue_handler
+
+
+def stop_queue_logging(timeout=STOP_TIMEOUT):
+    """
+    停止后台监听线程, 退出前会把队列中剩余的日志全部写完,
+    并把原来的Handler还给logger
+    :param timeout: 等待后台线程写完剩余日志的最长秒数(Handler卡住时不会一直等待), None为一直等待
+    """
+    global _queue_handler, _listener, _queue_logger
+    with _state_lock:
+        if _listener is None:
+            return
+        # 先把Handler还给logger, 之后的日志不再进入队列
+        for handler in _listener.handlers:
+            _queue_logger.addHandler(handler)
+        _queue_logger.removeHandler(_queue_handler)
+        # 超时后后台线程仍会继续写剩余的日志, Handler自身的锁保证与调用方线程的写入不会交错
+        _listener.stop(timeout)
+        for handler in _listener.handlers:
+            handler.flush()
+        _queue_handler, _listener, _queue_logger = None, None, None
+
+
+def swap_queue_handlers(handlers: list):
+    """
+    替换后台线程使用的Handler(热加载时使用), 队列中的日志不会丢失
+    :param handlers: 新的Handler列表
+    :return: 被替换下来的Handler列表, 未开启队列模式时为None
+    """
+    with _state_lock:
+        if _listener is None:
+            return None
+        old_handlers = list(_listener.handlers)
+        # 元组赋值是原子操作, 后台线程下一条日志开始使用新的Handler
+        _listener.handlers = tuple(handlers)
+        return old_handlers
+
+
+def get_queue_handler():
+    """
+    :return: 当前生效的队列Handler, 未开启队列模式时为None
+    """
+    return _queue_handler
+
+
+# 进程退出时刷新队列(先于logging.shutdown执行)
+atexit.register(stop_queue_logging)
@@ -0,0 +1,354 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: rotating_handler
+按大小和/或时间切分的日志文件Handler, 切分出的文件由后台线程压缩并按数量和总大小清理
+"""
+# Python内置库
+import os
+import re
+import sys
+import time
+import shutil
+import logging
+import threading
+import traceback
+import logging.handlers
+from typing import Optional, Union
+
+# 压缩格式及其扩展名
+COMPRESS_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+# 时间切分的单位(秒), midnight为每天本地时间0点
+WHEN_SECONDS = {"S": 1, "M": 60, "H": 3600, "D": 86400, "MIDNIGHT": 86400}
+# 大小单位
+SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024 ** 2, "MB": 1024 ** 2, "G": 1024 ** 3, "GB": 1024 ** 3}
+# 切分出的文件名: 原文件名.开始时间[.序号][.gz|.zst]
+SEGMENT_TIME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+# 超过该时间未修改的压缩临时文件视为进程中断后的残留
+STALE_TMP_SECONDS = 3600
+# 压缩时每次读取的字节数
+COPY_CHUNK = 1024 * 1024
+
+_SIZE_REGEX = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([A-Za-z]*)\s*$")
+
+
+def parse_size(size: Union[int, str, None]) -> int:
+    """
+    :param size: 字节数, 或带单位的字符串(如"100MB"、"2GB")
+    :return: 字节数, 未设置时为0
+    """
+    if not size:
+        return 0
+    if isinstance(size, int):
+        return size
+    match = _SIZE_REGEX.match(str(size))
+    if match is None or match.group(2).upper() not in SIZE_UNITS:
+        raise ValueError("大小格式错误: {}".format(size))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def _compress_gzip(source: str, target: str, level: int):
+    import gzip
+    with open(source, 'rb') as src, gzip.open(target, 'wb', compresslevel=level) as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK)
+
+
+def _zstd_compressor():
+    """
+    zstd需要Python 3.14的compression.zstd或者zstandard库, 在创建Handler时导入, 而不是在后台线程压缩时才报错
+    :return: 压缩函数(源文件, 目标文件, 压缩等级)
+    """
+    try:
+        from compression import zstd
+    except ImportError:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd压缩需要安装zstandard: pip install zstandard")
+
+        def compress(source: str, target: str, level: int):
+            with open(source, 'rb') as src, open(target, 'wb') as f:
+                with zstandard.ZstdCompressor(level=level).stream_writer(f) as dst:
+                    shutil.copyfileobj(src, dst, COPY_CHUNK)
+        return compress
+
+    def compress(source: str, target: str, level: int):
+        with open(source, 'rb') as src, zstd.open(target, 'wb', level=level) as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK)
+    return compress
+
+
+class VisionRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """
+    按大小(maxBytes)和/或时间(when/interval)切分日志文件:
+        写日志的线程在切分时只关闭文件并改名, 压缩和清理旧文件交给后台线程;
+        切分出的文件按gzip/zstd压缩, 可以保留更多的历史文件;
+        backupCount限制保留的文件个数, max_total_bytes限制当前文件和历史文件的总大小, 超出时删除最旧的文件.
+    时间切分按本地时间对齐(when: H时在每个整点切分), 文件名带该段日志的开始时间:
+        vision_log.log.2018-11-15_10-00-00.gz
+    可以在logger_config.yaml中替换TimedRotatingFileHandler:
+        info_file_handler:
+            class: DataVision.LoggerHandler.rotating_handler.VisionRotatingFileHandler
+            filename: ./vision/vision_log.log
+            when: H
+            maxBytes: 100MB
+            compress: gzip
+            max_total_bytes: 2GB
+    """
+
+    def __init__(self,
+                 filename: str,
+                 mode: str = 'a',
+                 maxBytes: Union[int, str] = 0,
+                 when: Optional[str] = None,
+                 interval: int = 1,
+                 backupCount: int = 0,
+                 encoding: Optional[str] = None,
+                 delay: bool = False,
+                 utc: bool = False,
+                 compress: Optional[str] = "gzip",
+                 compress_level: Optional[int] = None,
+                 max_total_bytes: Union[int, str] = 0) -> None:
+        """
+        :param filename: 日志路径
+        :param mode: 打开模式
+        :param maxBytes: 单个文件的最大字节数(可以带单位), 0为不按大小切分
+        :param when: 时间切分的单位 S/M/H/D/midnight, None为不按时间切分
+        :param interval: 时间切分的间隔(单位个数)
+        :param backupCount: 最多保留的历史文件个数, 0为不限制
+        :param encoding: 文件编码
+        :param delay: 是否在第一条日志时才打开文件
+        :param utc: 时间切分和文件名是否使用UTC时间
+        :param compress: 历史文件的压缩格式 gzip/zstd, None为不压缩
+        :param compress_level: 压缩等级, 默认gzip为6、zstd为3
+        :param max_total_bytes: 当前文件和历史文件的总大小上限(可以带单位), 0为不限制
+        """
+        if compress is not None and compress not in COMPRESS_SUFFIXES:
+            raise ValueError("压缩格式不存在: {}".format(compress))
+        if when is not None and when.upper() not in WHEN_SECONDS:
+            raise ValueError("时间切分单位不存在: {}".format(when))
+        if interval < 1:
+            raise ValueError("时间切分间隔必须大于0: {}".format(interval))
+        logging.handlers.BaseRotatingHandler.__init__(self, filename, mode, encoding=encoding, delay=delay)
+        self.maxBytes = parse_size(maxBytes)
+        self.when = when.upper() if when is not None else None
+        self.interval = interval
+        self.backupCount = backupCount
+        self.utc = utc
+        self.compress = compress
+        if compress_level is None:
+            compress_level = 3 if compress == "zstd" else 6
+        self.compress_level = compress_level
+        self.max_total_bytes = parse_size(max_total_bytes)
+        self._suffix = COMPRESS_SUFFIXES.get(compress, "")
+        self._compressor = _zstd_compressor() if compress == "zstd" else _compress_gzip
+        # 历史文件名: 原文件名.开始时间[.序号][.gz|.zst][.tmp]
+        self._segment_regex = re.compile(
+            r"^" + re.escape(os.path.basename(self.baseFilename)) +
+            r"\.(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})(?:\.(\d+))?(\.gz|\.zst)?(\.tmp)?$")
+        # 当前这段日志的开始时间和下次按时间切分的时间
+        if os.path.exists(self.baseFilename):
+            self._segment_start = os.stat(self.baseFilename).st_mtime
+        else:
+            self._segment_start = time.time()
+        self._rollover_at = self._compute_rollover(self._segment_start)
+        # 后台线程: 压缩历史文件并按数量和总大小清理
+        self._worker = None
+        self._pending = False
+        self._closing = False
+        self._condition = threading.Condition()
+        # 最新一个历史文件的(开始时间, 序号), 序号只增不减, 删除旧文件后不会复用
+        self._last_segment = (None, 0)
+        segments = self._segments()
+        if segments:
+            self._last_segment = segments[-1][0]
+            # 上次运行中断时留下的未压缩/超出上限的历史文件
+            self._schedule()
+
+    def _compute_rollover(self, current: float) -> float:
+        """
+        :param current: 当前这段日志的开始时间
+        :return: 下次按时间切分的时间戳, 不按时间切分时为inf
+        """
+        if self.when is None:
+            return float("inf")
+        period = WHEN_SECONDS[self.when] * self.interval
+        # 按本地时间(或UTC)对齐到整点/整天
+        offset = 0 if self.utc else time.localtime(current).tm_gmtoff
+        local = current + offset
+        return (local - local % WHEN_SECONDS[self.when]) + period - offset
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        """
+        只判断时间, 大小在emit中用格式化后的内容判断(避免像RotatingFileHandler那样格式化两次)
+        """
+        return record.created >= self._rollover_at
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            msg = self.format(record) + self.terminator
+            if self.stream is None:
+                self.stream = self._open()
+            rollover = record.created >= self._rollover_at
+            if self.maxBytes > 0 and rollover is not True:
+                # 单条日志超过maxBytes时不切分空文件
+                size = self.stream.tell()
+                rollover = size > 0 and size + len(msg) >= self.maxBytes
+            if rollover:
+                self.doRollover(record.created)
+                self.stream = self._open()
+            self.stream.write(msg)
+            self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def _segment_name(self) -> str:
+        """
+        :return: 当前这段日志改名后的路径, 同一开始时间的多段日志按序号区分
+        """
+        # 按时间切分时用对齐后的开始时间(整点/整天), 否则用实际的开始时间
+        start = self._segment_start
+        if self.when is not None:
+            start = self._rollover_at - WHEN_SECONDS[self.when] * self.interval
+        stamp = time.strftime(SEGMENT_TIME_FORMAT, time.gmtime(start) if self.utc else time.localtime(start))
+        last_stamp, sequence = self._last_segment
+        # 多个进程的日志汇总写入时记录的时间不是单调的, 开始时间不早于上一个历史文件, 保证文件名按切分顺序排列
+        if last_stamp is not None and stamp < last_stamp:
+            stamp = last_stamp
+        name = "{}.{}".format(self.baseFilename, stamp)
+        sequence = sequence + 1 if stamp == last_stamp else 0
+        while True:
+            candidate = name if sequence == 0 else "{}.{}".format(name, sequence)
+            if not os.path.exists(candidate) and not os.path.exists(candidate + self._suffix):
+                self._last_segment = (stamp, sequence)
+                return candidate
+            sequence += 1
+
+    def doRollover(self, now: Optional[float] = None):
+        """
+        切分当前文件: 在调用线程中只做关闭和改名, 压缩和清理由后台线程完成
+        :param now: 切分时间, 默认为当前时间
+        """
+        if now is None:
+            now = time.time()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            os.rename(self.baseFilename, self._segment_name())
+            self._schedule()
+        self._segment_start = now
+        self._rollover_at = self._compute_rollover(now)
+
+    def _schedule(self):
+        """
+        通知后台线程处理历史文件, 多次切分只需要处理一次
+        """
+        with self._condition:
+            self._pending = True
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="VisionLogCompressor", daemon=True)
+                self._worker.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closing:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                self._pending = False
+            try:
+                self._maintain()
+            except Exception:
+                if logging.raiseExceptions:
+                    sys.stderr.write("--- Logging error in VisionRotatingFileHandler ---\n")
+                    traceback.print_exc(file=sys.stderr)
+
+    def _segments(self) -> list:
+        """
+        :return: [(排序键, 路径, 是否已压缩, 是否为临时文件), ...], 按时间从旧到新排序
+        """
+        directory = os.path.dirname(self.baseFilename)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        segments = []
+        for name in names:
+            match = self._segment_regex.match(name)
+            if match is None:
+                continue
+            stamp, sequence, suffix, tmp = match.groups()
+            segments.append(((stamp, int(sequence or 0)), os.path.join(directory, name), suffix is not None,
+                             tmp is not None))
+        segments.sort()
+        return segments
+
+    def _compress_file(self, path: str):
+        """
+        压缩到临时文件后再改名, 进程中断时不会留下不完整的压缩文件
+        """
+        target = path + self._suffix
+        tmp = "{}.{}-{}.tmp".format(target, os.getpid(), threading.get_ident())
+        try:
+            self._compressor(path, tmp, self.compress_level)
+            shutil.copystat(path, tmp)
+            os.replace(tmp, target)
+            os.remove(path)
+        except FileNotFoundError:
+            # 热加载时新旧Handler的后台线程可能同时处理同一个文件
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _maintain(self):
+        """
+        压缩未压缩的历史文件, 再按backupCount和max_total_bytes删除最旧的文件
+        """
+        now = time.time()
+        for _, path, compressed, tmp in self._segments():
+            if tmp:
+                # 只清理进程中断后残留的临时文件(正在写的临时文件会持续更新修改时间)
+                try:
+                    if now - os.stat(path).st_mtime > STALE_TMP_SECONDS:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+            elif self.compress is not None and not compressed:
+                self._compress_file(path)
+        segments = [(path, os.stat(path).st_size) for _, path, _, tmp in self._segments() if not tmp]
+        remove = 0
+        if self.backupCount > 0:
+            remove = max(0, len(segments) - self.backupCount)
+        if self.max_total_bytes > 0:
+            try:
+                total = os.path.getsize(self.baseFilename)
+            except FileNotFoundError:
+                total = 0
+            # 当前文件在下次切分前还会继续增长, 按大小切分时按maxBytes预留, 保证任何时候都不超过上限
+            total = max(total, self.maxBytes)
+            total += sum(size for _, size in segments[remove:])
+            while remove < len(segments) and total > self.max_total_bytes:
+                total -= segments[remove][1]
+                remove += 1
+        for path, _ in segments[:remove]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """
+        关闭文件, 并等待后台线程处理完已经切分出的文件
+        """
+        logging.handlers.BaseRotatingHandler.close(self)
+        with self._condition:
+            self._closing = True
+            worker = self._worker
+            self._condition.notify()
+        if worker is not None and worker is not threading.current_thread():
+            worker.join()
@@ -0,0 +1,336 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: sampling
+日志采样/限流Filter: 同一调用位置(或模板/logger/等级)的日志在短时间内大量重复时只保留一部分, 并定期输出被抑制的条数
+"""
+# Python内置库
+import time
+import atexit
+import logging
+import weakref
+import threading
+import collections
+from typing import List, Optional, Union
+
+# 采样策略
+#   first_then_every - 每个period秒内前first条全部保留, 之后每every条保留1条(every为0时全部丢弃)
+#   token_bucket - 每秒补充rate个令牌, 最多积攒burst个, 有令牌时保留
+POLICIES = ("first_then_every", "token_bucket")
+# 分组方式, 可以组合使用(如[logger, level])
+#   callsite - 调用位置(文件+行号, 没有调用位置时退化为template)
+#   template - 日志模板(格式化之前的msg)
+#   logger - logger名称
+#   level - 日志等级
+KEY_FIELDS = ("callsite", "template", "logger", "level")
+# 汇总日志的标记属性, 带有该属性的记录不参与采样
+SUMMARY_ATTRIBUTE = "vision_sampling_summary"
+# 待汇总表中合并被淘汰分组的键
+_OTHER = object()
+
+
+def _template(record: logging.LogRecord):
+    """
+    :return: 日志模板; vision_logger的延迟日志(LazyMessage)用生成函数的代码对象区分
+    """
+    msg = record.msg
+    if msg.__class__ is str:
+        return msg
+    func = getattr(msg, '_func', None)
+    return getattr(func, '__code__', msg.__class__)
+
+
+def _callsite(record: logging.LogRecord):
+    # vision.caller为never(或auto但没有Handler用到)时没有调用位置
+    if record.lineno:
+        return record.pathname, record.lineno
+    return _template(record)
+
+
+_KEY_GETTERS = {
+    "callsite": _callsite,
+    "template": _template,
+    "logger": lambda record: record.name,
+    "level": lambda record: record.levelno,
+}
+
+
+class _State(object):
+    """
+    一个分组的采样状态
+    """
+    __slots__ = ('window_start', 'count', 'tokens', 'updated', 'suppressed', 'suppressed_since', 'levelno',
+                 'logger', 'sample')
+
+    def __init__(self, created: float, tokens: float):
+        self.window_start = created
+        self.count = 0
+        self.tokens = tokens
+        self.updated = created
+        # 上次汇总之后被抑制的条数和第一条被抑制的时间
+        self.suppressed = 0
+        self.suppressed_since = created
+        # 最后一条被抑制的记录的等级和logger, 上次汇总之后第一条被抑制的记录的
+        # (pathname, filename, lineno, funcName, 消息模板), 只保存汇总日志用到的字段, 不持有记录本身
+        self.levelno = logging.NOTSET
+        self.logger = None
+        self.sample = None
+
+
+# 所有采样Filter, 进程退出前输出剩余的汇总
+_filters = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all():
+    for sampling_filter in list(_filters):
+        sampling_filter.flush_summaries()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    采样/限流Filter, 可以挂在logger或Handler上:
+        按key分组(调用位置/模板/logger/等级), 每组按policy决定是否保留;
+        分组状态保存在最多max_keys个条目的LRU表中, 每条记录只有常数次字典操作;
+        每隔summary_interval秒(在下一条日志到来时, 没有新日志时由后台定时器)为有抑制的分组输出一条汇总日志:
+            [采样] 12.0秒内抑制了35210条日志: file.py:42 "连接失败: %s"
+        汇总日志通过被抑制记录的logger输出, 挂在Handler上时也会经过该logger的其他Handler.
+    可以在logger_config.yaml中配置:
+        filters:
+            sampling:
+                (): DataVision.LoggerHandler.sampling.SamplingFilter
+                key: callsite
+                policy: first_then_every
+                first: 10
+                every: 100
+                levels: [ERROR, CRITICAL]
+        root:
+            filters: [sampling]
+    注意: logger上的Filter只对直接在该logger上输出的记录生效(vision_logger使用root),
+    子logger的记录需要把Filter挂在Handler上.
+    """
+
+    def __init__(self,
+                 key: Union[str, List[str]] = "callsite",
+                 policy: str = "first_then_every",
+                 first: int = 10,
+                 every: int = 100,
+                 period: float = 1.0,
+                 rate: float = 10.0,
+                 burst: Optional[float] = None,
+                 levels: Optional[List[str]] = None,
+                 loggers: Optional[List[str]] = None,
+                 max_keys: int = 1000,
+                 summary_interval: float = 10.0) -> None:
+        """
+        :param key: 分组方式 callsite/template/logger/level, 或者它们的列表
+        :param policy: 采样策略 first_then_every/token_bucket
+        :param first: first_then_every - 每个周期内全部保留的条数
+        :param every: first_then_every - 超过first条之后每every条保留1条, 0为全部丢弃
+        :param period: first_then_every - 周期(秒)
+        :param rate: token_bucket - 每秒保留的条数
+        :param burst: token_bucket - 允许的突发条数, 默认与rate相同
+        :param levels: 只对这些等级采样, 默认为所有等级
+        :param loggers: 只对这些logger(名称前缀)采样, 默认为所有logger
+        :param max_keys: 分组状态表的最大条目数(超出时淘汰最久未出现的分组)
+        :param summary_interval: 输出汇总日志的间隔(秒), 0为不输出
+        """
+        logging.Filter.__init__(self)
+        fields = [key] if isinstance(key, str) else list(key)
+        for field in fields:
+            if field not in KEY_FIELDS:
+                raise ValueError("采样分组方式不存在: {}".format(field))
+        if policy not in POLICIES:
+            raise ValueError("采样策略不存在: {}".format(policy))
+        if max_keys < 1:
+            raise ValueError("max_keys必须大于0: {}".format(max_keys))
+        self.key = fields
+        self.policy = policy
+        self.first = first
+        self.every = every
+        self.period = period
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.levels = frozenset(logging._checkLevel(level) for level in levels) if levels else None
+        self.loggers = tuple(loggers or ())
+        self.max_keys = max_keys
+        self.summary_interval = summary_interval
+        # 被抑制的总条数
+        self.suppressed = 0
+        if len(fields) == 1:
+            self._key_of = _KEY_GETTERS[fields[0]]
+        else:
+            getters = tuple(_KEY_GETTERS[field] for field in fields)
+            self._key_of = lambda record: tuple(getter(record) for getter in getters)
+        self._decide = self._first_then_every if policy == "first_then_every" else self._token_bucket
+        # 分组状态(LRU) 和 有待汇总的分组
+        self._states = collections.OrderedDict()
+        self._dirty = {}
+        self._next_summary = None
+        # 输出汇总的后台定时器, 有抑制的分组但之后没有日志到来时也能输出汇总
+        self._timer = None
+        self._lock = threading.Lock()
+        _filters.add(self)
+
+    @staticmethod
+    def config_uses_caller(config: dict) -> bool:
+        """
+        config_loader.needs_caller使用: 按调用位置分组时vision_logger需要查找调用位置
+        :param config: 该Filter在dictConfig中的配置
+        """
+        key = config.get('key', 'callsite')
+        return 'callsite' in ([key] if isinstance(key, str) else key)
+
+    def _first_then_every(self, state: _State, created: float) -> bool:
+        if created - state.window_start >= self.period:
+            state.window_start = created
+            state.count = 0
+        state.count += 1
+        extra = state.count - self.first
+        return extra <= 0 or (self.every > 0 and extra % self.every == 0)
+
+    def _token_bucket(self, state: _State, created: float) -> bool:
+        tokens = min(self.burst, state.tokens + (created - state.updated) * self.rate)
+        state.updated = created
+        if tokens >= 1.0:
+            state.tokens = tokens - 1.0
+            return True
+        state.tokens = tokens
+        return False
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.__dict__.get(SUMMARY_ATTRIBUTE):
+            return True
+        if self.levels is not None and record.levelno not in self.levels:
+            return True
+        if self.loggers:
+            name = record.name
+            if not any(name == prefix or name.startswith(prefix + ".") for prefix in self.loggers):
+                return True
+        key = self._key_of(record)
+        created = record.created
+        summaries = None
+        with self._lock:
+            states = self._states
+            state = states.get(key)
+            if state is None:
+                if len(states) >= self.max_keys:
+                    self._evict()
+                state = states[key] = _State(created, self.burst)
+            else:
+                states.move_to_end(key)
+            keep = self._decide(state, created)
+            if keep is not True:
+                if state.suppressed == 0 and self.summary_interval > 0:
+                    state.suppressed_since = created
+                    self._dirty[key] = state
+                state.suppressed += 1
+                state.levelno = record.levelno
+                state.logger = record.name
+                if state.sample is None:
+                    state.sample = (record.pathname, record.filename, record.lineno, record.funcName,
+                                    str(record.msg))
+                self.suppressed += 1
+            if self.summary_interval > 0:
+                if self._next_summary is None:
+                    self._next_summary = created + self.summary_interval
+                elif created >= self._next_summary and self._dirty:
+                    self._next_summary = created + self.summary_interval
+                    summaries = self._take_summaries(created)
+                if keep is not True and (self._timer is None or self._timer.is_alive() is not True):
+                    # fork出的子进程中定时器线程已经不存在, 需要重新启动
+                    self._start_timer(self.summary_interval)
+        if summaries:
+            self._emit(summaries)
+        return keep
+
+    def _start_timer(self, delay: float):
+        """
+        启动汇总定时器(调用方持有锁)
+        """
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        """
+        定时器到期: 之后还有日志到来时汇总已经由filter输出, 否则在定时器线程中输出
+        """
+        with self._lock:
+            self._timer = None
+            if not self._dirty:
+                return
+            now = time.time()
+            if self._next_summary is not None and now < self._next_summary:
+                self._start_timer(self._next_summary - now)
+                return
+            self._next_summary = now + self.summary_interval
+            summaries = self._take_summaries(now)
+        self._emit(summaries)
+
+    def _evict(self):
+        """
+        淘汰最久未出现的分组, 有抑制的条数时留到下次汇总输出(调用方持有锁)
+        """
+        key, state = self._states.popitem(last=False)
+        # 不输出汇总(summary_interval为0)时分组不会进入待汇总表
+        if not state.suppressed or self.summary_interval <= 0:
+            return
+        dirty = self._dirty
+        dirty.pop(key, None)
+        if len(dirty) < 2 * self.max_keys:
+            # 用一个不会与分组键冲突的键保存, 汇总后丢弃
+            dirty[object()] = state
+            return
+        # 待汇总的分组过多时合并为一条"其他分组", 内存占用不超过max_keys的常数倍
+        other = dirty.get(_OTHER)
+        if other is None:
+            other = dirty[_OTHER] = _State(state.suppressed_since, 0.0)
+        other.suppressed += state.suppressed
+        other.suppressed_since = min(other.suppressed_since, state.suppressed_since)
+        other.levelno = max(other.levelno, state.levelno)
+        other.logger = state.logger
+
+    def _take_summaries(self, now: float) -> list:
+        """
+        取出待汇总的分组并清零(调用方持有锁)
+        :return: [(被抑制的条数, 持续时间, 等级, logger, 样例(调用位置和模板)), ...]
+        """
+        summaries = []
+        for state in self._dirty.values():
+            summaries.append((state.suppressed, max(0.0, now - state.suppressed_since), state.levelno,
+                              state.logger, state.sample))
+            state.suppressed = 0
+            state.sample = None
+        self._dirty = {}
+        return summaries
+
+    @staticmethod
+    def _emit(summaries: list):
+        """
+        通过被抑制记录的logger输出汇总日志(不持有锁, 汇总日志会再次经过本Filter)
+        """
+        for count, seconds, levelno, logger_name, sample in summaries:
+            logger = logging.getLogger(logger_name if logger_name != "root" else None)
+            if sample is None:
+                record = logger.makeRecord(logger.name, levelno, "(unknown file)", 0,
+                                           "[采样] %.1f秒内抑制了%d条日志: (其他分组)", (seconds, count),
+                                           None, None, extra={SUMMARY_ATTRIBUTE: True})
+                logger.handle(record)
+                continue
+            pathname, filename, lineno, func_name, template = sample
+            where = "{}:{} ".format(filename, lineno) if lineno else ""
+            record = logger.makeRecord(logger.name, levelno, pathname, lineno,
+                                       "[采样] %.1f秒内抑制了%d条日志: %s%r", (seconds, count, where, template),
+                                       None, func_name, extra={SUMMARY_ATTRIBUTE: True})
+            logger.handle(record)
+
+    def flush_summaries(self):
+        """
+        立即输出所有待汇总的分组(进程退出前自动调用)
+        """
+        with self._lock:
+            summaries = self._take_summaries(time.time())
+        if summaries:
+            self._emit(summaries)
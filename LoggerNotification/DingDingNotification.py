@@ -7,16 +7,17 @@ Created on 2018年11月15日
 # Python内置库
 import json
 import time
-
-# Python第三方库
-import asks
-import curio
+import atexit
+import threading
 
 # 项目内部库
 from DataVision.LoggerHandler.logger import VisionLogger
+from DataVision.LoggerNotification.robot_pool import RobotPool
+from DataVision.LoggerNotification.metrics import NotificationMetrics, error_code, notification_metrics
 
-# asks配置
-asks.init('curio')
+# asks和curio在第一次使用时才导入, 导入本模块没有副作用
+_asks_ready = False
+_asks_lock = threading.Lock()
 
 # 日志路径
 LOGGER_PATH = '../../DataVision/LoggerConfig/logger_config.yaml'
@@ -25,13 +26,75 @@ LOGGER_PATH = '../../DataVision/LoggerConfig/logger_config.yaml'
 MSG_TYPE_LIST = \
             ["text", "link", "markdown", "single_actionCard", "multiple_actionCard", "feedCard"]
 
+# 钉钉返回的发送太快错误码
+MSG_TOO_MUCH = 130101
+# 钉钉返回的参数错误/内容太长/内容不合法错误码, 本地消息格式错误时也返回PARAM_ERROR
+PARAM_ERROR = 300001
+MSG_TOO_LONG = 101002
+MSG_CONTENT_FORBID = 300004
+# 消息内容本身的错误, 重发或者换机器人都不会成功
+CONTENT_ERRORS = frozenset((PARAM_ERROR, MSG_TOO_LONG, MSG_CONTENT_FORBID))
+# 网关拦截(机器人被拉黑)时返回的HTTP状态码
+BLACKLIST_STATUS = 302
+
+
+class DingDingError(RuntimeError):
+    """
+    钉钉报警发送失败: 钉钉拒绝了消息或消息格式错误时由send_message抛出, NotificationDispatcher也用于其他发送失败
+    """
+
+    def __init__(self, errcode=None) -> None:
+        """
+        :param errcode: 钉钉返回的错误码(消息格式错误时为PARAM_ERROR), 网络错误或机器人被拉黑时为None
+        """
+        message = "钉钉报警消息发送失败"
+        if errcode is not None:
+            message = "{}: errcode {}".format(message, errcode)
+        RuntimeError.__init__(self, message)
+        self.errcode = errcode
+
+    @property
+    def permanent(self) -> bool:
+        """
+        :return: 是否为消息内容本身的错误(不重试, 不计入熔断, 不转移渠道)
+        """
+        return self.errcode in CONTENT_ERRORS
+
+
+def load_asks():
+    """
+    :return: 已经按curio初始化的asks模块
+    """
+    global _asks_ready
+    import asks
+    with _asks_lock:
+        if _asks_ready is not True:
+            asks.init('curio')
+            _asks_ready = True
+    return asks
+
 
 class DingDingSender(object):
 
-    def __init__(self, config_path: str = ""):
+    def __init__(self,
+                 config_path: str = "",
+                 sleep=None,
+                 retries: int = 1,
+                 strategy: str = None,
+                 session=None,
+                 connections: int = 4,
+                 metrics: NotificationMetrics = None):
         """
         钉钉监控消息发布
         :param config_path: 配置文件目录 默认在LoggerConfig中
+        :param sleep: 限流等待使用的异步sleep函数, 默认为curio.sleep
+        :param retries: 钉钉返回发送太快(130101)或机器人被拉黑时的重发次数
+        :param strategy: 多个机器人时的选择策略(round_robin/least_recently_used/hash),
+                         默认读取配置中的robot_strategy, 没有配置时为round_robin
+        :param session: HTTP会话, 需要提供post(url, data=, headers=, follow_redirects=)协程,
+                        默认为asks.Session(长连接, 连接在多次发送之间复用)
+        :param connections: 默认会话的最大连接数
+        :param metrics: 发送指标, 默认使用进程内共用的注册表
         """
         # 日志
         self._logger = VisionLogger(LOGGER_PATH)
@@ -41,17 +104,44 @@ class DingDingSender(object):
         if self._path == "":
             self._path = ".././LoggerConfig/logger_notification_config.json"
 
-        # 加载配置文件
+        # 加载配置文件, robot_token可以是单个token或token列表
         dingding_config = self._load_config_from_json()
-        self._req_url = dingding_config['robot_url'] + dingding_config['robot_token']
+        tokens = dingding_config['robot_token']
+        if isinstance(tokens, str):
+            tokens = [tokens]
+        strategy = strategy or dingding_config.get('robot_strategy', 'round_robin')
 
-        # 默认请求
-        self._header = {"Content-Type": "application/json;charset=utf-8"}
+        # 机器人池: 每个机器人有独立的限流器(进程内按地址共用)和健康状态
+        self._robots = RobotPool(dingding_config['robot_url'], tokens, strategy=strategy)
+        self._req_url = self._robots.robots[0].url
+
+        # 默认请求(asks默认发送Connection: close, 需要显式声明keep-alive才会复用连接)
+        self._header = {"Content-Type": "application/json;charset=utf-8", "Connection": "keep-alive"}
 
         # 统计发送次数和频率
         self.times = 0
         self.start_time = time.time()
 
+        if sleep is None:
+            import curio
+            sleep = curio.sleep
+        self._sleep = sleep
+        self._retries = retries
+
+        # 长连接会话, 避免每条报警都重新建立TCP连接和TLS握手
+        self._session = session if session is not None else load_asks().Session(connections=connections)
+
+        # 发送次数/结果/耗时/字节数和限流等待时间
+        self._metrics = (metrics or notification_metrics()).channel("dingding")
+
+    async def close(self):
+        """
+        关闭HTTP会话中的连接
+        """
+        close = getattr(self._session, 'close', None)
+        if close is not None:
+            await close()
+
     def _load_config_from_json(self) -> dict:
         return json.load(open(self._path, 'r'))['DingDing']
 
@@ -67,12 +157,15 @@ class DingDingSender(object):
         else:
             return False
 
-    async def send_message(self, msg_type: str, **msg_kwargs):
+    async def send_message(self, msg_type: str, alert_key: str = None, level=None, **msg_kwargs):
         """
         发送消息
         :param msg_type 消息类型
+        :param alert_key: 报警的key, hash策略下相同key的报警固定由同一个机器人按顺序发送
+        :param level: 报警级别, 限流排队时级别高的先发送(CRITICAL还有保留的名额), 默认按INFO排队
         :param msg_kwargs: 其他参数
-        :return: 接口返回的结果
+        :return: 发送成功时为True, 网络错误或机器人被拉黑时为None
+        :raise DingDingError: 钉钉返回错误(errcode为钉钉的错误码)或消息格式错误(errcode为PARAM_ERROR)
         一、http(s)请求返回302，被网关层给拦截，一分钟只能发送20条，超过被加入黑名单5分钟。
         二、http(s)请求返回200，需要根据http body中的json字符，其中errorCode和errorMsg细分如下：
         String PARAM_ERROR = _300001_;   参数错误_
@@ -83,27 +176,70 @@ class DingDingSender(object):
         """
         message = self.make_message(msgtype=msg_type, **msg_kwargs)
         if message is not None:
-            print(json.dumps(message, ensure_ascii=False, indent=4))
+            # 只序列化一次, 重发时直接使用
+            body = json.dumps(message, ensure_ascii=False).encode('utf-8')
             try:
                 self.times += 1
-                if self.times % 20 == 0:
-                    if time.time() - self.start_time < 60:
-                        self._logger.vision_logger(level="DEBUG",
-                                                   log_msg="钉钉官方限制每个机器人每分钟最多发送20条，当前消息发送频率已达到限制条件，休眠一分钟")
-                        time.sleep(60)
-                    self.start_time = time.time()
-                # 发送
-                response = await asks.post(self._req_url, headers=self._header, json=message)
-                json_response = json.loads(response.content.decode("UTF-8"))
-                if json_response['errcode'] == 0:
-                    return True
-                else:
-                    print(json_response)
-            except BaseException as err:
+                attempt = 0
+                while True:
+                    robot = self._robots.choose(alert_key)
+                    # 所有机器人都被拉黑时, 等待最早恢复的机器人
+                    blocked = robot.unavailable_for()
+                    if blocked > 0:
+                        self._logger.vision_logger("WARN", "所有钉钉机器人都被拉黑, 等待%.1f秒后发送", blocked)
+                        await self._sleep(blocked)
+                    # 超过每分钟20条时在这里排队等待, 不会阻塞事件循环
+                    waited = await robot.limiter.acquire(self._sleep, level=level)
+                    self._metrics.limiter_wait.observe(waited)
+                    if waited > 0:
+                        self._logger.vision_logger("DEBUG", "钉钉官方限制每个机器人每分钟最多发送20条, 本条消息排队%.1f秒",
+                                                   waited)
+                    # 发送
+                    start = time.perf_counter()
+                    try:
+                        response = await self._session.post(robot.url, data=body, headers=self._header,
+                                                            follow_redirects=False)
+                    except Exception as err:
+                        self._metrics.record(False, error_code(err), time.perf_counter() - start)
+                        if isinstance(err, OSError):
+                            robot.mark_failure()
+                        raise
+                    seconds = time.perf_counter() - start
+                    if response.status_code == BLACKLIST_STATUS:
+                        self._metrics.record(False, BLACKLIST_STATUS, seconds, len(body))
+                        # 被网关拉黑, 摘除该机器人并换一个机器人重发
+                        robot.mark_blacklisted()
+                        self._logger.vision_logger("WARN", "钉钉机器人被拉黑, 暂停使用5分钟, 剩余可用机器人%s个",
+                                                   self._robots.healthy_count())
+                        if attempt < self._retries:
+                            attempt += 1
+                            continue
+                        break
+                    robot.mark_success()
+                    json_response = json.loads(response.content.decode("UTF-8"))
+                    self._metrics.record(json_response['errcode'] == 0, json_response['errcode'], seconds, len(body))
+                    if json_response['errcode'] == 0:
+                        robot.limiter.reward()
+                        return True
+                    elif json_response['errcode'] == MSG_TOO_MUCH and attempt < self._retries:
+                        # 服务端认为发送太快, 该机器人进入冷却后重发
+                        cooldown = robot.limiter.penalize()
+                        self._logger.vision_logger("WARN", "钉钉返回发送太快, 冷却%s秒后重发", cooldown)
+                        attempt += 1
+                    else:
+                        if json_response['errcode'] == MSG_TOO_MUCH:
+                            robot.limiter.penalize()
+                        self._logger.vision_logger("ERROR", "钉钉报警消息发送失败: %s", json_response)
+                        raise DingDingError(json_response['errcode'])
+            except DingDingError:
+                raise
+            except Exception as err:
                 self._logger.vision_logger(level="ERROR", log_msg=str(err))
-                # TODO 当钉钉报警消息无法发送时 则同时发送到Redis和邮箱(邮箱地址通过配置文件进行配置)
+                # 无法发送时返回None, 通过NotificationDispatcher发送的报警会按故障转移链
+                # 转到邮件/本地文件/Redis(见failover.FailoverChain, 收件人等在配置文件的Failover中配置)
         else:
             self._logger.vision_logger(level="ERROR", log_msg="报警消息发送失败!请检查消息格式后重新发送!")
+            raise DingDingError(PARAM_ERROR)
 
     def make_message(self, msgtype: str, **msg_kwargs) -> dict:
         """
@@ -373,14 +509,50 @@ class DingDingSender(object):
         return msg_json
 
 
-def send(msg_type: str, **msg_kwargs):
+# 每个线程一个发送器和curio内核(curio内核不是线程安全的, 也不能重入), 同一线程多次调用send时复用配置和长连接,
+# 限流器在进程内按机器人共用
+_local = threading.local()
+# 所有线程创建的(发送器, curio内核), 进程退出时关闭
+_default_senders = []
+_default_lock = threading.Lock()
+
+
+def _get_default_sender() -> tuple:
+    """
+    :return: 当前线程的(发送器, curio内核)
+    """
+    default = getattr(_local, 'default', None)
+    if default is None:
+        import curio
+        default = (DingDingSender(), curio.Kernel())
+        _local.default = default
+        with _default_lock:
+            _default_senders.append(default)
+    return default
+
+
+@atexit.register
+def _close_default_sender():
+    with _default_lock:
+        defaults = list(_default_senders)
+        del _default_senders[:]
+    for sender, kernel in defaults:
+        try:
+            kernel.run(sender.close)
+        finally:
+            kernel.run(shutdown=True)
+
+
+def send(msg_type: str, alert_key: str = None, **msg_kwargs):
     """
+    在当前线程的curio内核中发送一条消息(不能在正在运行的curio内核中调用)
     :param msg_type 消息类型
+    :param alert_key: 报警的key
     :param msg_kwargs: 其他参数
-    :return:
+    :return: 同DingDingSender.send_message
     """
-    dingding = DingDingSender()
-    curio.run(dingding.send_message(msg_type=msg_type, **msg_kwargs))
+    dingding, kernel = _get_default_sender()
+    return kernel.run(dingding.send_message(msg_type=msg_type, alert_key=alert_key, **msg_kwargs))
 
 
 if __name__ == '__main__':
@@ -6,14 +6,20 @@ Created on 2018年11月15日
 """
 # Python内置库
 import json
+import time
+import atexit
 import socket
 import asyncio
+import functools
 import mimetypes
+import collections
 from typing import (
     Union,
     Optional,
     Dict,
     List,
+    Iterable,
+    AsyncIterator,
     Any
 )
 from email import encoders
@@ -24,16 +30,36 @@ from email.utils import parseaddr, formataddr
 from email.mime.multipart import MIMEMultipart
 from email.mime.nonmultipart import MIMENonMultipart
 
-
-# Python第三方库
-import aiosmtplib
-
 # 项目内部库
 from DataVision.LoggerHandler.logger import VisionLogger
+from DataVision.LoggerNotification.smtp_pool import SMTPConnectionPool
+from DataVision.LoggerNotification.mime_cache import EncodedPartCache
+from DataVision.LoggerNotification.metrics import NotificationMetrics, error_code, notification_metrics
+from DataVision.LoggerNotification.mime_stream import (
+    StreamingMessage,
+    is_streamable,
+    make_stream_part,
+    split_streams
+)
 
 # 日志路径
 LOGGER_PATH = '../../DataVision/LoggerConfig/logger_config.yaml'
 
+# 批量发送中单封邮件的结果
+# index - 邮件在输入中的序号, spec - 邮件参数, success - 是否成功,
+# response - 服务器返回, error - 异常, code - SMTP错误码, elapsed - 发送耗时(秒)
+SendResult = collections.namedtuple(
+    'SendResult', ['index', 'spec', 'success', 'response', 'error', 'code', 'elapsed'])
+
+# 批量发送的工作协程结束标记
+_WORKER_DONE = object()
+
+# 进程内共用的附件/内嵌图片编码缓存
+PART_CACHE = EncodedPartCache()
+
+# SMTP投递成功的应答码
+SMTP_COMPLETED = 250
+
 
 def get_current_ip() -> str:
     """
@@ -50,13 +76,19 @@ class EmailSender(object):
     使用后发送邮件会被绑定在`app对象`上,支持协程`send_email`,
     也支持方法`send_email_nowait`,其中`send_email_nowait`意为将任务交给协程发送而不等待发送完毕,
     会返回发送的task.
+    邮件通过SMTP连接池发送, 连接在第一次发送时才建立并在之后复用,
+    建议整个进程只创建一个发送器, 用`async with`管理其生命周期.
     """
 
-    def __init__(self, loop, config_path: str = "") -> None:
+    def __init__(self, loop=None, config_path: str = "", pool_size: int = 4,
+                 metrics: NotificationMetrics = None) -> None:
         """
         异步邮件发送器
-        :param loop: 事件循环 [Windows下显示 <class 'asyncio.windows_events._WindowsSelectorEventLoop'>]
+        :param loop: 事件循环 [Windows下显示 <class 'asyncio.windows_events._WindowsSelectorEventLoop'>],
+                     SMTP连接总是建立在发送时正在运行的事件循环中
         :param config_path: 配置文件目录 默认在LoggerConfig中
+        :param pool_size: SMTP连接池大小(同时发送的最大连接数)
+        :param metrics: 发送指标, 默认使用进程内共用的注册表
         """
         # 日志
         self._logger = VisionLogger(LOGGER_PATH)
@@ -73,34 +105,43 @@ class EmailSender(object):
         self._mail_user = mail_config['mail_user']
         self._mail_password = mail_config['mail_password']
         self._mail_suffix = mail_config['mail_suffix']
+        self._mail_use_tls = mail_config.get('mail_use_tls', True)
 
         # 基本变量
-        self.smtp = None
         self.loop = loop
-        self.loop.run_until_complete(self.stmp_connection())
+        self.pool = SMTPConnectionPool(
+            hostname=self._mail_host,
+            port=self._mail_port,
+            username=self._mail_user,
+            password=self._mail_password,
+            use_tls=self._mail_use_tls,
+            pool_size=pool_size
+        )
+        # 发送次数/结果(SMTP应答码)/耗时/字节数
+        self._metrics = (metrics or notification_metrics()).channel("email")
 
     def _load_config_from_json(self) -> dict:
         return json.load(open(self._path, 'r'))['Email']
 
     async def stmp_connection(self):
-        self.smtp = aiosmtplib.SMTP(
-            loop=self.loop,
-            hostname=self._mail_host,
-            port=self._mail_port,
-            use_tls=True
-        )
-        await self.smtp.connect()
-        await self.smtp.login(
-            self._mail_user, self._mail_password
-        )
+        """
+        预先建立一个连接(可选, 不调用时在第一次发送时建立)
+        """
+        async with self.pool.connection():
+            pass
         self._logger.vision_logger(level="INFO", log_msg="邮件服务器连接成功!")
 
     async def stmp_close(self):
-        self.smtp.close()
-        self.smtp = None
+        await self.pool.close()
         self._logger.vision_logger(level="INFO", log_msg="邮件服务器关闭成功!")
         return True
 
+    async def __aenter__(self) -> "EmailSender":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stmp_close()
+
     async def send_email(self,
                          target_list: Union[List[str], str],
                          subject: str,
@@ -121,6 +162,76 @@ class EmailSender(object):
             msgimgs (Optional[Dict[str, str]]): - html格式的文本中插入的图片
             attachments (Optional[Dict[str, str]]): - 附件中的文件,默认为None
         """
+        sender, targets, c_c = self._make_addresses(target_list, c_c_list, sender_name)
+        if any(is_streamable(v) for v in list((msgimgs or {}).values()) + list((attachments or {}).values())):
+            # 文件附件在写入SMTP DATA时才分块读取和编码
+            message = make_streaming_message(sender=sender,
+                                             targets=targets,
+                                             subject=subject,
+                                             content=content,
+                                             html=html,
+                                             c_c=c_c,
+                                             msgimgs=msgimgs,
+                                             attachments=attachments)
+        elif msgimgs or attachments:
+            # 附件的编码比较耗CPU, 放到线程池中进行, 避免阻塞事件循环
+            message = await make_message_async(sender=sender,
+                                               targets=targets,
+                                               subject=subject,
+                                               content=content,
+                                               html=html,
+                                               c_c=c_c,
+                                               msgimgs=msgimgs,
+                                               attachments=attachments)
+        else:
+            message = make_message(sender=sender,
+                                   targets=targets,
+                                   subject=subject,
+                                   content=content,
+                                   html=html,
+                                   c_c=c_c)
+        return await self._deliver(message)
+
+    async def send_template(self,
+                            template: "MessageTemplate",
+                            target_list: Union[List[str], str],
+                            subject: str,
+                            sender_name: Optional[str]=None,
+                            c_c_list: Union[List[str], str, None]=None)->Any:
+        """使用预先构造好的邮件模板发送, 只生成新的邮件头, 正文和附件不再重复编码.
+        Parameters:
+            template (MessageTemplate): - 邮件模板
+            target_list (Union[List[str], str]): - 接受者的信息列表,也可以是单独的一条信息
+            subject (str): - 邮件主题
+            sender_name (Optinal[str]): - 发送者的发送名,默认为None
+            c_c_list (Optional[List[str], str]): - 抄送者的信息列表,也可以是单独的一条信息
+        """
+        sender, targets, c_c = self._make_addresses(target_list, c_c_list, sender_name)
+        message = template.stamp(sender=sender, targets=targets, subject=subject, c_c=c_c)
+        return await self._deliver(message)
+
+    async def _deliver(self, message):
+        """
+        通过连接池发送, 并记录发送指标
+        """
+        start = time.perf_counter()
+        try:
+            result = await self.pool.send_message(message)
+        except Exception as err:
+            code = smtp_error_code(err)
+            self._metrics.record(False, error_code(err) if code is None else code, time.perf_counter() - start)
+            raise
+        self._metrics.record(True, getattr(result, 'code', SMTP_COMPLETED), time.perf_counter() - start,
+                             message_size(message))
+        return result
+
+    def _make_addresses(self,
+                        target_list: Union[List[str], str],
+                        c_c_list: Union[List[str], str, None],
+                        sender_name: Optional[str]) -> tuple:
+        """
+        :return: (发送者, 接受者, 抄送者)
+        """
         if sender_name:
             sender = sender_name + "<" + "{}@{}".format(self._mail_user, self._mail_suffix) + ">"
         else:
@@ -143,15 +254,7 @@ class EmailSender(object):
                 raise AttributeError("unsupport type for Cclist")
         else:
             c_c = None
-        message = make_message(sender=sender,
-                               targets=targets,
-                               subject=subject,
-                               content=content,
-                               html=html,
-                               c_c=c_c,
-                               msgimgs=msgimgs,
-                               attachments=attachments)
-        return await self.smtp.send_message(message)
+        return sender, targets, c_c
 
     def send_email_no_wait(self,
                            target_list: Union[List[str], str],
@@ -189,6 +292,127 @@ class EmailSender(object):
         )
         return task
 
+    async def _send_spec(self, index: int, spec: dict) -> SendResult:
+        start = time.monotonic()
+        try:
+            if 'template' in spec:
+                response = await self.send_template(**spec)
+            else:
+                response = await self.send_email(**spec)
+        except Exception as err:
+            return SendResult(index=index, spec=spec, success=False, response=None, error=err,
+                              code=smtp_error_code(err), elapsed=time.monotonic() - start)
+        return SendResult(index=index, spec=spec, success=True, response=response, error=None,
+                          code=None, elapsed=time.monotonic() - start)
+
+    async def send_many(self,
+                        message_specs: Union[Iterable[dict], AsyncIterator[dict]],
+                        concurrency: Optional[int]=None) -> AsyncIterator[SendResult]:
+        """批量发送邮件, 按完成顺序逐个返回结果.
+        邮件参数按需从输入中读取, 同时发送的邮件数不超过concurrency,
+        因此超大批量的邮件也不会全部驻留在内存中.
+        Parameters:
+            message_specs (Union[Iterable[dict], AsyncIterator[dict]]): - 邮件参数(同send_email的参数,
+                带template键时同send_template的参数)的可迭代对象或异步迭代器
+            concurrency (Optional[int]): - 最大并发数, 默认为连接池大小
+        Yields:
+            (SendResult): - 单封邮件的发送结果, 失败时不会抛出异常而是记录在结果中
+        Raises:
+            读取message_specs时抛出的异常: - 在已经取得的结果之后重新抛出, 其余邮件不再发送
+        """
+        concurrency = concurrency or self.pool.pool_size
+        if hasattr(message_specs, '__aiter__'):
+            specs = message_specs.__aiter__()
+        else:
+            specs = iter(message_specs)
+        # 异步迭代器不能被多个协程同时推进, 读取时需要加锁
+        specs_lock = asyncio.Lock()
+        counter = [0]
+        results = asyncio.Queue(maxsize=concurrency)
+        # 读取邮件参数时的异常, 由调用方所在的协程重新抛出
+        errors = []
+
+        async def next_spec():
+            async with specs_lock:
+                try:
+                    if hasattr(specs, '__anext__'):
+                        spec = await specs.__anext__()
+                    else:
+                        spec = next(specs)
+                except (StopIteration, StopAsyncIteration):
+                    return None, None
+                index = counter[0]
+                counter[0] += 1
+                return index, spec
+
+        async def worker():
+            try:
+                while True:
+                    index, spec = await next_spec()
+                    if spec is None:
+                        break
+                    await results.put(await self._send_spec(index, spec))
+            except Exception as err:
+                errors.append(err)
+            finally:
+                await results.put(_WORKER_DONE)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+        finished = 0
+        try:
+            while finished < concurrency:
+                result = await results.get()
+                if result is _WORKER_DONE:
+                    if errors:
+                        raise errors[0]
+                    finished += 1
+                    continue
+                yield result
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def send_bulk(self,
+                        message_specs: Union[Iterable[dict], AsyncIterator[dict]],
+                        concurrency: Optional[int]=None) -> List[SendResult]:
+        """批量发送邮件, 全部完成后按输入顺序返回结果.
+        Parameters:
+            message_specs (Union[Iterable[dict], AsyncIterator[dict]]): - 邮件参数(同send_email的参数)的可迭代对象或异步迭代器
+            concurrency (Optional[int]): - 最大并发数, 默认为连接池大小
+        Return:
+            (List[SendResult]): - 每封邮件的发送结果
+        """
+        results = [result async for result in self.send_many(message_specs, concurrency)]
+        results.sort(key=lambda result: result.index)
+        return results
+
+
+def smtp_error_code(error: BaseException) -> Optional[int]:
+    """
+    :return: 发送异常中的SMTP应答码, 没有应答(如连接断开)时为None
+    """
+    code = getattr(error, 'code', None)
+    # 所有收件人都被拒绝时, 错误码在每个收件人的异常里
+    refused = getattr(error, 'recipients', None)
+    if code is None and refused:
+        code = getattr(refused[0], 'code', None)
+    return code
+
+
+def message_size(message) -> int:
+    """
+    :return: 邮件的字节数, 内存中的邮件按各MIME块编码后的内容和邮件头估算(不重新序列化整封邮件)
+    """
+    if isinstance(message, StreamingMessage):
+        return message.size
+    size = 0
+    for part in message.walk():
+        size += sum(len(name) + len(str(value)) + 4 for name, value in part.items())
+        payload = part.get_payload()
+        if isinstance(payload, str):
+            size += len(payload)
+    return size
+
 
 def format_addr(s: str)->str:
     """将地址信息格式化为`名字<地址>`的形式."""
@@ -204,7 +428,8 @@ def make_message(
         html: bool=False,
         c_c: str=None,
         msgimgs: Optional[Dict[str, str]]=None,
-        attachments: Optional[Dict[str, str]]=None)-> MIMEMultipart:
+        attachments: Optional[Dict[str, str]]=None,
+        part_cache: Optional[EncodedPartCache]=PART_CACHE)-> MIMEMultipart:
     """创建信息.
     创建信息通过html标志指定内容是html的富文本还是普通文本.默认为普通文本.
     如果是html形式,可以用以下形式插入图片:
@@ -221,43 +446,161 @@ def make_message(
         html (bool): - 又见文本是否是html形式的富文本,默认为False
         msgimgs (Optional[Dict[str, str]]): - html格式的文本中插入的图片
         attachments (Optional[Dict[str, str]]): - 附件中的文件,默认为None
+        part_cache (Optional[EncodedPartCache]): - 附件和图片的编码缓存,为None时不使用缓存
     Returns:
         (MIMEMultipart): - 没有设置发送者和收件者的邮件内容对象
     """
-    msg = MIMEMultipart()
-    msg['Subject'] = Header(subject, "utf-8").encode()
-    msg['From'] = format_addr(sender)
-    msg['To'] = targets
-    if c_c:
-        msg['Cc'] = c_c
+    parts = make_parts(content=content,
+                       html=html,
+                       msgimgs=msgimgs,
+                       attachments=attachments,
+                       part_cache=part_cache)
+    return _stamp_message(parts, sender=sender, targets=targets, subject=subject, c_c=c_c)
+
+
+def make_streaming_message(
+        sender: str,
+        targets: str,
+        subject: str,
+        content: str,
+        html: bool=False,
+        c_c: str=None,
+        msgimgs: Optional[Dict[str, Any]]=None,
+        attachments: Optional[Dict[str, Any]]=None,
+        part_cache: Optional[EncodedPartCache]=PART_CACHE) -> StreamingMessage:
+    """创建流式发送的信息.
+    参数同`make_message`, 但是`msgimgs`和`attachments`的值除了字节序列以外,
+    还可以是文件路径(os.PathLike)、二进制文件对象或者`FileAttachment`,
+    这些文件在发送时才分块读取和编码, 发送占用的内存与文件大小无关.
+    Returns:
+        (StreamingMessage): - 可以交给`SMTPConnectionPool.send_message`发送的流式邮件
+    """
+    memory_imgs, stream_imgs = split_streams(msgimgs if html else None)
+    memory_files, stream_files = split_streams(attachments)
+    parts = make_parts(content=content,
+                       html=html,
+                       msgimgs=memory_imgs,
+                       attachments=memory_files,
+                       part_cache=part_cache)
+    streams = {}
+    for kind, files in (('image', stream_imgs), ('attachment', stream_files)):
+        for name, stream in files.items():
+            part, token = make_stream_part(name, kind)
+            parts.append(part)
+            streams[token] = stream
+    message = _stamp_message(parts, sender=sender, targets=targets, subject=subject, c_c=c_c)
+    return StreamingMessage(message, streams)
+
+
+async def make_message_async(**kwargs) -> MIMEMultipart:
+    """在默认线程池中执行`make_message`, 参数同`make_message`."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(make_message, **kwargs))
+
+
+def make_parts(content: str,
+               html: bool=False,
+               msgimgs: Optional[Dict[str, str]]=None,
+               attachments: Optional[Dict[str, str]]=None,
+               part_cache: Optional[EncodedPartCache]=PART_CACHE) -> list:
+    """创建邮件正文、内嵌图片和附件的MIME块(参数同`make_message`)."""
+    parts = []
     if html:
-        text = MIMEText(content, 'html', 'utf-8')
-        msg.attach(text)
+        parts.append(MIMEText(content, 'html', 'utf-8'))
         if msgimgs:
             for i, v in msgimgs.items():
-                c_type, encoding = mimetypes.guess_type(i)
-                _maintype, _subtype = c_type.split('/', 1)
-                msg_image = MIMEImage(v, _subtype)
-                msg_image.add_header('Content-ID', '<{}>'.format(i.split(".")[0]))
-                msg_image.add_header('Content-Disposition', 'inline')
-                msg.attach(msg_image)
+                if part_cache is None:
+                    parts.append(_make_image_part(i, v))
+                else:
+                    parts.append(part_cache.get_or_build('image', i, v, _make_image_part))
     else:
-        text = MIMEText(content, 'plain')
-        msg.attach(text)
+        parts.append(MIMEText(content, 'plain'))
     if attachments:
         for name, file in attachments.items():
-            attachment = MIMEAttachment(name, file)
-            attachment.add_header('Content-Disposition', 'attachment', filename=name)
-            msg.attach(attachment)
+            if part_cache is None:
+                parts.append(_make_attachment_part(name, file))
+            else:
+                parts.append(part_cache.get_or_build('attachment', name, file, _make_attachment_part))
+    return parts
+
+
+def _stamp_message(parts: list, sender: str, targets: str, subject: str, c_c: str=None) -> MIMEMultipart:
+    """用已经编码好的MIME块和新的邮件头组成一封邮件."""
+    msg = MIMEMultipart()
+    msg['Subject'] = Header(subject, "utf-8").encode()
+    msg['From'] = format_addr(sender)
+    msg['To'] = targets
+    if c_c:
+        msg['Cc'] = c_c
+    for part in parts:
+        msg.attach(part)
     return msg
 
 
+@functools.lru_cache(maxsize=256)
+def _guess_type(name: str) -> tuple:
+    return mimetypes.guess_type(name)
+
+
+def _make_image_part(name: str, data: bytes) -> MIMEImage:
+    c_type, encoding = _guess_type(name)
+    _maintype, _subtype = c_type.split('/', 1)
+    msg_image = MIMEImage(data, _subtype)
+    msg_image.add_header('Content-ID', '<{}>'.format(name.split(".")[0]))
+    msg_image.add_header('Content-Disposition', 'inline')
+    return msg_image
+
+
+def _make_attachment_part(name: str, data: bytes) -> "MIMEAttachment":
+    attachment = MIMEAttachment(name, data)
+    attachment.add_header('Content-Disposition', 'attachment', filename=name)
+    return attachment
+
+
+class MessageTemplate(object):
+    """
+    邮件模板: 正文、内嵌图片和附件只编码一次,
+    每个收件人通过`stamp`得到只有邮件头不同的新邮件.
+    """
+
+    def __init__(self,
+                 content: str,
+                 html: bool=False,
+                 msgimgs: Optional[Dict[str, str]]=None,
+                 attachments: Optional[Dict[str, str]]=None,
+                 part_cache: Optional[EncodedPartCache]=PART_CACHE) -> None:
+        """
+        参数同`make_message`
+        """
+        self.parts = make_parts(content=content,
+                                html=html,
+                                msgimgs=msgimgs,
+                                attachments=attachments,
+                                part_cache=part_cache)
+
+    @classmethod
+    async def build_async(cls, **kwargs) -> "MessageTemplate":
+        """在默认线程池中构造模板, 参数同`MessageTemplate`."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(cls, **kwargs))
+
+    def stamp(self, sender: str, targets: str, subject: str, c_c: str=None) -> MIMEMultipart:
+        """
+        :param sender: 发送者的信息
+        :param targets: 接受者的信息
+        :param subject: 邮件主题
+        :param c_c: 抄送者的信息
+        :return: 邮件对象
+        """
+        return _stamp_message(self.parts, sender=sender, targets=targets, subject=subject, c_c=c_c)
+
+
 class MIMEAttachment(MIMENonMultipart):
     def __init__(self, attache_name, _attachement_data,
                  _encoder=encoders.encode_base64, *, policy=None, **_params):
         """
         """
-        ctype, encoding = mimetypes.guess_type(attache_name)
+        ctype, encoding = _guess_type(attache_name)
         if ctype is None or encoding is not None:
             ctype = 'application/octet-stream'
         _maintype, _subtype = ctype.split('/', 1)
@@ -269,6 +612,26 @@ class MIMEAttachment(MIMENonMultipart):
         _encoder(self)
 
 
+# 进程内共用的发送器和事件循环
+_default_sender = None
+_default_loop = None
+
+
+def _get_default_sender() -> EmailSender:
+    global _default_sender, _default_loop
+    loop = asyncio.get_event_loop()
+    if _default_sender is None or _default_loop is not loop:
+        _default_sender = EmailSender(loop=loop)
+        _default_loop = loop
+    return _default_sender
+
+
+@atexit.register
+def _close_default_sender():
+    if _default_sender is not None and _default_loop.is_closed() is not True:
+        _default_loop.run_until_complete(_default_sender.pool.close())
+
+
 # 异步发送邮件
 def send(target_list: Union[List[str], str],
          subject: str,
@@ -279,6 +642,7 @@ def send(target_list: Union[List[str], str],
          msgimgs: Optional[Dict[str, str]]=None,
          attachments: Optional[Dict[str, str]]=None):
     """
+    使用进程内共用的发送器发送邮件, 多次调用会复用同一个SMTP连接
     Parameters:
             target_list (Union[List[str], str]): - 接受者的信息列表,也可以是单独的一条信息
             c_c_list (Optional[List[str], str]): - 抄送者的信息列表,也可以是单独的一条信息
@@ -289,12 +653,10 @@ def send(target_list: Union[List[str], str],
             msgimgs (Optional[Dict[str, str]]): - html格式的文本中插入的图片
             attachments (Optional[Dict[str, str]]): - 附件中的文件,默认为None
     """
-    # 事件循环
-    loop = asyncio.get_event_loop()
-    s_m = EmailSender(loop=loop)
+    s_m = _get_default_sender()
     # 运行异步
-    loop.run_until_complete(
-        s_m.send_email_no_wait(
+    return s_m.loop.run_until_complete(
+        s_m.send_email(
             target_list=target_list,
             subject=subject,
             content=content,
@@ -305,7 +667,6 @@ def send(target_list: Union[List[str], str],
             attachments=attachments
         )
     )
-    loop.run_until_complete(s_m.stmp_close())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,50 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: __init__
+报警通知模块, 子模块在第一次访问对应的名称时才导入(asks/curio/aiosmtplib等依赖不会在导入包时加载)
+"""
+# Python内置库
+import importlib
+
+# 名称 -> 所在的子模块
+_LAZY_ATTRIBUTES = {
+    "EmailSender": "EmailNotification",
+    "DingDingSender": "DingDingNotification",
+    "NotificationDispatcher": "dispatcher",
+    "get_dispatcher": "dispatcher",
+    "NotificationHandler": "notification_handler",
+    "Route": "notification_handler",
+    "FailoverChain": "failover",
+    "CircuitBreaker": "circuit_breaker",
+    "CircuitOpenError": "circuit_breaker",
+    "Spool": "spool",
+    "AlertSuppressor": "suppression",
+    "SlidingWindowLimiter": "rate_limiter",
+    "PriorityLimiter": "rate_limiter",
+    "get_limiter": "rate_limiter",
+    "RobotPool": "robot_pool",
+    "get_health": "robot_pool",
+    "SMTPConnectionPool": "smtp_pool",
+    "AsyncHTTPSession": "http_session",
+    "MetricsRegistry": "metrics",
+    "NotificationMetrics": "metrics",
+    "REGISTRY": "metrics",
+}
+
+__all__ = sorted(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name: str):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module("." + module_name, __name__), name)
+    # 之后直接从模块字典中取, 不再经过__getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
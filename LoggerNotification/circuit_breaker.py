@@ -0,0 +1,178 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: circuit_breaker
+通知渠道的熔断器(关闭/打开/半开)
+"""
+# Python内置库
+import time
+import threading
+import collections
+from typing import Callable, Optional
+
+# 熔断器状态
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    熔断器打开时直接拒绝发送
+    """
+
+    def __init__(self, name: str, retry_after: float) -> None:
+        super().__init__("{}渠道已熔断, {:.1f}秒后重新探测".format(name, retry_after))
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """
+    熔断器:
+        关闭状态下记录最近window次调用的结果, 调用次数不少于min_calls且
+        失败率达到failure_rate或慢调用(耗时不少于slow_call_seconds)比例达到slow_call_rate时打开;
+        打开状态下直接拒绝调用, open_seconds秒后进入半开状态;
+        半开状态下最多同时放行half_open_calls次探测调用, 全部成功(且不慢)后关闭, 任意一次失败重新打开.
+    状态变化时调用listener(name, 原状态, 新状态).
+    耗时按调用方看到的时间计算(包括发送器内部的限流等待), slow_call_seconds不要小于正常的排队时间.
+    """
+
+    def __init__(self,
+                 name: str,
+                 failure_rate: float = 0.5,
+                 slow_call_rate: float = 0.5,
+                 slow_call_seconds: float = 10,
+                 window: int = 20,
+                 min_calls: int = 5,
+                 open_seconds: float = 30,
+                 half_open_calls: int = 1,
+                 listener: Optional[Callable[[str, str, str], None]] = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        """
+        :param name: 渠道名称
+        :param failure_rate: 打开熔断器的失败率
+        :param slow_call_rate: 打开熔断器的慢调用比例
+        :param slow_call_seconds: 耗时不少于该秒数的调用视为慢调用
+        :param window: 统计最近的调用次数
+        :param min_calls: 窗口内调用次数达到该值后才会打开
+        :param open_seconds: 打开后等待多少秒进入半开状态
+        :param half_open_calls: 半开状态下的探测调用次数
+        :param listener: 状态变化的回调
+        :param clock: 单调时钟
+        """
+        if window < 1 or min_calls < 1 or half_open_calls < 1:
+            raise ValueError("window、min_calls和half_open_calls必须大于0")
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.window = window
+        self.min_calls = min(min_calls, window)
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.listener = listener
+        self.clock = clock
+
+        self._state = CLOSED
+        # 最近的调用结果 (是否失败, 是否慢调用)
+        self._calls = collections.deque()
+        self._failures = 0
+        self._slow = 0
+        self._opened_at = 0.0
+        # 半开状态下已放行和已成功的探测次数
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._check_open(self.clock())
+            return self._state
+
+    def retry_after(self) -> float:
+        """
+        :return: 打开状态下距离进入半开状态的秒数, 其他状态为0
+        """
+        with self._lock:
+            if self._state != OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.open_seconds - self.clock())
+
+    def allow(self) -> bool:
+        """
+        :return: 是否可以调用(半开状态下会占用一次探测), 调用后需要用record记录结果
+        """
+        with self._lock:
+            self._check_open(self.clock())
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return True
+            return False
+
+    def record(self, success: bool, elapsed: float = 0.0):
+        """
+        :param success: 调用是否成功
+        :param elapsed: 调用耗时(秒)
+        """
+        failed = success is not True
+        slow = elapsed >= self.slow_call_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if failed or slow:
+                    self._transition(OPEN)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._transition(CLOSED)
+                return
+            if self._state == OPEN:
+                # 打开之前放行的调用, 结果不再统计
+                return
+            self._calls.append((failed, slow))
+            self._failures += failed
+            self._slow += slow
+            if len(self._calls) > self.window:
+                old_failed, old_slow = self._calls.popleft()
+                self._failures -= old_failed
+                self._slow -= old_slow
+            calls = len(self._calls)
+            if calls >= self.min_calls and (self._failures >= calls * self.failure_rate or
+                                            self._slow >= calls * self.slow_call_rate):
+                self._transition(OPEN)
+
+    def release(self):
+        """
+        放弃一次已放行的调用(调用被取消时使用, 半开状态下归还探测名额)
+        """
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > self._probe_successes:
+                self._probes -= 1
+
+    def reset(self):
+        """
+        手动关闭熔断器
+        """
+        with self._lock:
+            if self._state != CLOSED:
+                self._transition(CLOSED)
+
+    def _check_open(self, now: float):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+
+    def _transition(self, state: str):
+        previous, self._state = self._state, state
+        if state == OPEN:
+            self._opened_at = self.clock()
+        elif state == HALF_OPEN:
+            self._probes = self._probe_successes = 0
+        else:
+            self._calls.clear()
+            self._failures = self._slow = 0
+        if self.listener is not None:
+            self.listener(self.name, previous, state)
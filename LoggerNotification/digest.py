@@ -0,0 +1,176 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: digest
+把积压的钉钉报警合并为尽量少的markdown消息
+"""
+# Python内置库
+import collections
+from typing import Hashable, List, Optional
+
+# 单条markdown消息内容的最大字节数(超过后钉钉返回101002内容太长)
+MAX_MESSAGE_BYTES = 20000
+
+# 分节顺序(严重的在前)
+LEVELS = ("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG")
+# 级别的别名(logging同样接受WARN和FATAL)
+LEVEL_ALIASES = {"WARN": "WARNING", "FATAL": "CRITICAL"}
+
+# 可以合并的消息类型
+PACKABLE_TYPES = ("markdown", "text")
+
+_SEPARATOR = "\n\n---\n\n"
+# 消息标题、分节标题等固定内容预留的字节数
+_RESERVED_BYTES = 256
+
+
+class DigestItem(object):
+    """
+    一条待合并的报警
+    """
+    __slots__ = ('owner', 'level', 'text', 'at_mobiles', 'at_all', 'alert_key')
+
+    def __init__(self, owner: Hashable, level: str, text: str,
+                 at_mobiles: Optional[List[str]] = None, at_all: bool = False, alert_key=None) -> None:
+        """
+        :param owner: 报警所属的任务, 合并结果中用于对应回原任务
+        :param level: 级别(大写的名称, 可以是LEVEL_ALIASES中的别名)
+        :param text: markdown内容
+        :param at_mobiles: 需要@的手机号
+        :param at_all: 是否@所有人
+        :param alert_key: 报警的key
+        """
+        self.owner = owner
+        level = LEVEL_ALIASES.get(level, level)
+        self.level = level if level in LEVELS else "INFO"
+        self.text = text
+        self.at_mobiles = at_mobiles or []
+        self.at_all = at_all
+        self.alert_key = alert_key
+
+
+def to_item(owner: Hashable, kwargs: dict) -> Optional[DigestItem]:
+    """
+    :param owner: 报警所属的任务
+    :param kwargs: DingDingSender.send_message的参数
+    :return: 可以合并时返回DigestItem, 否则返回None
+    """
+    msg_type = kwargs.get("msg_type")
+    if msg_type not in PACKABLE_TYPES:
+        return None
+    text = kwargs.get("text") if msg_type == "markdown" else kwargs.get("content")
+    if not text or not str(text).strip():
+        return None
+    return DigestItem(owner=owner,
+                      level=str(kwargs.get("level") or "INFO").upper(),
+                      text=str(text),
+                      at_mobiles=kwargs.get("at_mobiles"),
+                      at_all=bool(kwargs.get("is_at_all")),
+                      alert_key=kwargs.get("alert_key"))
+
+
+def split_text(text: str, limit: int) -> List[str]:
+    """
+    把超长的内容按行切分, 每段不超过limit字节(单行超长时按字节切分, 不会切断UTF-8字符)
+    """
+    if len(text.encode('utf-8')) <= limit:
+        return [text]
+    parts, current, size = [], [], 0
+    for line in text.split("\n"):
+        encoded = line.encode('utf-8')
+        while len(encoded) > limit:
+            piece = encoded[:limit].decode('utf-8', 'ignore')
+            if current:
+                parts.append("\n".join(current))
+                current, size = [], 0
+            parts.append(piece)
+            encoded = encoded[len(piece.encode('utf-8')):]
+        line = encoded.decode('utf-8')
+        # 换行符占1字节
+        needed = len(encoded) + (1 if current else 0)
+        if size + needed > limit:
+            parts.append("\n".join(current))
+            current, size = [], 0
+            needed = len(encoded)
+        current.append(line)
+        size += needed
+    if current:
+        parts.append("\n".join(current))
+    return parts
+
+
+def pack(items: List[DigestItem], title: str = "DataVision报警汇总",
+         max_bytes: int = MAX_MESSAGE_BYTES) -> List[tuple]:
+    """
+    把报警合并为markdown消息:
+        报警按级别分节(严重的在前, 同级别保持原有顺序), 按顺序装入消息, 每条消息不超过max_bytes字节;
+        单条报警超过一条消息的容量时切分为多段, 依次装入.
+    :param items: 待合并的报警
+    :param title: 消息标题
+    :param max_bytes: 每条消息内容的最大字节数
+    :return: [(DingDingSender.send_message的参数, 包含的报警所属任务列表), ...]
+    """
+    if max_bytes <= _RESERVED_BYTES * 2:
+        raise ValueError("max_bytes太小")
+    budget = max_bytes - _RESERVED_BYTES
+    ordered = sorted(items, key=lambda item: LEVELS.index(item.level))
+
+    messages = []
+    builder = _MessageBuilder(title, max_bytes)
+    for item in ordered:
+        parts = split_text(item.text, budget)
+        for index, part in enumerate(parts):
+            if len(parts) > 1:
+                part = "{}\n\n(第{}/{}段)".format(part, index + 1, len(parts))
+            if builder.add(item, part) is not True:
+                messages.append(builder.build())
+                builder = _MessageBuilder(title, max_bytes)
+                builder.add(item, part)
+    if builder.items:
+        messages.append(builder.build())
+    return messages
+
+
+class _MessageBuilder(object):
+
+    def __init__(self, title: str, max_bytes: int) -> None:
+        self.title = title
+        self.max_bytes = max_bytes
+        self.items = []
+        self.lines = []
+        self.size = _RESERVED_BYTES
+        self.level = None
+
+    def add(self, item: DigestItem, text: str) -> bool:
+        chunk = text
+        if item.level != self.level:
+            chunk = "#### {}\n\n{}".format(item.level, text)
+        if self.lines:
+            chunk = _SEPARATOR + chunk
+        size = len(chunk.encode('utf-8'))
+        if self.lines and self.size + size > self.max_bytes:
+            return False
+        self.lines.append(chunk)
+        self.size += size
+        self.level = item.level
+        self.items.append(item)
+        return True
+
+    def build(self) -> tuple:
+        owners = list(collections.OrderedDict.fromkeys(item.owner for item in self.items))
+        # 消息的级别和alert_key(hash策略下决定由哪个机器人发送)取最严重的报警的, 同级别取最早的
+        top_item = min(self.items, key=lambda item: LEVELS.index(item.level))
+        top = top_item.level
+        mobiles = list(collections.OrderedDict.fromkeys(
+            mobile for item in self.items for mobile in item.at_mobiles))
+        kwargs = {
+            "msg_type": "markdown",
+            "title": "[{}] {} {}条".format(top, self.title, len(owners)),
+            "text": "### {} ({}条)\n\n{}".format(self.title, len(owners), "".join(self.lines)),
+            "at_mobiles": mobiles,
+            "is_at_all": any(item.at_all for item in self.items),
+            "alert_key": top_item.alert_key,
+            "level": top,
+        }
+        return kwargs, owners
@@ -0,0 +1,748 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: dispatcher
+通知分发器: 在后台事件循环线程中统一发送邮件和钉钉报警
+"""
+# Python内置库
+import atexit
+import random
+import asyncio
+import threading
+import collections
+import concurrent.futures
+from typing import Callable, Hashable, Optional
+
+# 项目内部库
+from DataVision.LoggerHandler.logger import VisionLogger
+from DataVision.LoggerNotification.http_session import AsyncHTTPSession
+from DataVision.LoggerNotification.digest import MAX_MESSAGE_BYTES, pack, to_item
+from DataVision.LoggerNotification.spool import Spool
+from DataVision.LoggerNotification.suppression import AlertSuppressor, Summary, fingerprint
+from DataVision.LoggerNotification.failover import FailoverChain
+from DataVision.LoggerNotification.circuit_breaker import CircuitOpenError
+from DataVision.LoggerNotification.priority import LANES, PrioritySemaphore, lane_of
+from DataVision.LoggerNotification.metrics import NotificationMetrics, export_from_config, notification_metrics
+
+# 日志路径
+LOGGER_PATH = '../../DataVision/LoggerConfig/logger_config.yaml'
+
+# 支持的通知渠道
+CHANNELS = ("email", "dingding")
+
+# 直接提交的通知参与重复报警指纹计算的参数
+FINGERPRINT_FIELDS = ("alert_key", "target_list", "title", "subject", "text", "content")
+
+
+class _Job(object):
+    __slots__ = ('channel', 'kwargs', 'future', 'build', 'spool_id', 'level')
+
+    def __init__(self, channel: str, kwargs: dict, future: concurrent.futures.Future,
+                 build: Optional[Callable[[], dict]] = None, level=None) -> None:
+        self.channel = channel
+        self.kwargs = kwargs
+        self.future = future
+        # 在事件循环线程中生成发送参数
+        self.build = build
+        self.spool_id = None
+        # 排队的优先级
+        self.level = level if level is not None else kwargs.get("level")
+
+
+class NotificationDispatcher(object):
+    """
+    通知分发器, 所有渠道共用一个后台线程中的asyncio事件循环:
+        submit是线程安全且不阻塞的, 返回concurrent.futures.Future, 调用方不需要等待网络IO;
+        提交的任务先进入线程安全的队列, 事件循环每次被唤醒时取走队列中的全部任务(跨线程唤醒按批合并),
+        同时发送的任务数由concurrency限制, 等待发送的任务按级别(level)分道排队(见priority.PrioritySemaphore);
+        发送失败(抛出异常或钉钉返回失败)时按retry_delay指数退避重试retries次;
+        shutdown时停止接收新任务, 等待已提交的任务发送完成后关闭连接和事件循环.
+    钉钉在该事件循环中使用asyncio的长连接会话(AsyncHTTPSession)和asyncio.sleep发送.
+    pack_dingding开启时, 钉钉任务进入积压队列, 由后台任务逐批发送:
+    上一批还在发送(或在限流中等待)时到达的text/markdown报警会合并为尽量少的markdown消息(见digest.pack),
+    积压越多合并越多, 没有积压时每条报警仍然单独发送; 比正在发送的报警更严重的报警不等待上一批, 立即单独成批发送,
+    每批按其中最严重的级别占用发送名额.
+    指定spool_dir时, 任务在事件循环中取出后(等待发送名额之前)先写入本地spool(见spool.Spool), 发送成功后确认;
+    重试后仍然失败的通知留在spool中, 按指数退避(带随机抖动)重新发送, 进程重启后也会继续发送;
+    永久错误(参数错误、内容不合法等)或重新发送replay_max_attempts次仍然失败的通知转入死信文件(见Spool.dead_letter),
+    每隔compact_interval秒压缩一次spool, 长期未确认的通知不会使之后的分段文件一直保留.
+    每个渠道有一个熔断器, 渠道失败率或慢调用比例过高时之后的通知不再等待该渠道超时,
+    直接按故障转移链(见failover.FailoverChain, 默认读取通知配置文件中的Failover)转到后备渠道.
+    相同指纹的通知在suppress_window秒内只发送第一条(见suppression.AlertSuppressor), 被抑制的通知的Future结果为None,
+    窗口结束时再发送一条附加了"又出现了N次"的汇总; 直接提交的通知按渠道、级别和消息内容计算指纹,
+    submit_deferred提交的通知由调用方指定指纹(如NotificationHandler按日志记录计算), 不指定时不抑制.
+    """
+
+    def __init__(self,
+                 config_path: str = "",
+                 concurrency: int = 8,
+                 max_pending: int = 10000,
+                 retries: int = 2,
+                 retry_delay: float = 1,
+                 email_sender=None,
+                 dingding_sender=None,
+                 pack_dingding: bool = True,
+                 max_message_bytes: int = MAX_MESSAGE_BYTES,
+                 digest_title: str = "DataVision报警汇总",
+                 spool_dir: Optional[str] = None,
+                 replay_base_delay: float = 5,
+                 replay_max_delay: float = 300,
+                 replay_max_attempts: int = 10,
+                 compact_interval: float = 60,
+                 failover: Optional[FailoverChain] = None,
+                 metrics: Optional[NotificationMetrics] = None,
+                 suppress_window: float = 60,
+                 suppress_max_entries: int = 10000) -> None:
+        """
+        :param config_path: 通知配置文件路径, 默认在LoggerConfig中
+        :param concurrency: 同时发送的最大任务数
+        :param max_pending: 等待发送的最大任务数, 超过后新任务直接失败
+        :param retries: 发送失败后的重试次数
+        :param retry_delay: 第一次重试前等待的秒数, 之后每次翻倍
+        :param email_sender: 邮件发送器(需要支持在分发器的事件循环中使用), 默认在第一次发送邮件时创建
+        :param dingding_sender: 钉钉发送器, 默认在第一次发送钉钉时创建
+        :param pack_dingding: 是否合并积压的钉钉报警
+        :param max_message_bytes: 合并后每条消息内容的最大字节数
+        :param digest_title: 合并消息的标题
+        :param spool_dir: 未发送通知的持久化目录, 为空时不持久化
+        :param replay_base_delay: spool中的通知第一次重新发送前等待的秒数, 之后每次翻倍
+        :param replay_max_delay: 重新发送的最长等待秒数
+        :param replay_max_attempts: spool中的通知重新发送的最大次数, 超过后转入死信文件
+        :param compact_interval: 压缩spool的间隔(秒)
+        :param failover: 故障转移链, 默认按通知配置文件中的Failover创建
+        :param metrics: 发送指标, 默认使用进程内共用的注册表(按通知配置文件中的Metrics导出)
+        :param suppress_window: 重复通知的抑制窗口(秒), 0表示不抑制
+        :param suppress_max_entries: 最多记录的通知指纹数
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency必须大于0")
+        self._logger = VisionLogger(LOGGER_PATH)
+        self.config_path = config_path
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._email_sender = email_sender
+        self._dingding_sender = dingding_sender
+        self.pack_dingding = pack_dingding
+        self.max_message_bytes = max_message_bytes
+        self.digest_title = digest_title
+        self.replay_base_delay = replay_base_delay
+        self.replay_max_delay = replay_max_delay
+        self.replay_max_attempts = replay_max_attempts
+        self.compact_interval = compact_interval
+        self._spool = Spool(spool_dir) if spool_dir else None
+        if metrics is None:
+            metrics = notification_metrics()
+            export_from_config(config_path, metrics.registry)
+        self._metrics = metrics
+        self.failover = failover if failover is not None else FailoverChain.from_config(config_path, metrics)
+        self._suppressor = None
+        if suppress_window > 0:
+            self._suppressor = AlertSuppressor(window=suppress_window, max_entries=suppress_max_entries)
+        # 已经安排的汇总检查时间
+        self._flush_at = None
+        self._flush_lock = threading.Lock()
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+        # 等待事件循环取走的任务
+        self._pending = collections.deque()
+        self._wakeup_scheduled = False
+        self._closed = False
+        self._lock = threading.Lock()
+        # 以下只在事件循环线程中使用
+        self._semaphore = None
+        self._tasks = set()
+        # 钉钉积压队列和发送任务, _sending为正在发送的各批报警中最严重的队列下标
+        self._backlog = collections.deque()
+        self._sending = []
+        self._backlog_event = None
+        self._backlog_task = None
+        self._stopping = False
+        # 上次运行留下的通知, 启动后立即重新发送
+        if self._spool is not None and len(self._spool):
+            self.start()
+
+    @property
+    def thread(self) -> Optional[threading.Thread]:
+        """
+        :return: 事件循环所在的线程(未启动时为None)
+        """
+        return self._thread
+
+    def start(self):
+        """
+        启动后台事件循环线程(第一次submit时会自动启动)
+        """
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="VisionNotificationDispatcher", daemon=True)
+            self._thread.start()
+
+    @property
+    def spool(self) -> Optional[Spool]:
+        return self._spool
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        if self._spool is not None:
+            for entry in self._spool.pending():
+                self.loop.call_soon(self._replay, entry.id, 0)
+            self.loop.call_later(self.compact_interval, self._compact)
+        self.loop.run_forever()
+
+    def submit(self, channel: str, **kwargs) -> concurrent.futures.Future:
+        """
+        提交一个通知任务
+        :param channel: 渠道 email/dingding
+        :param kwargs: 对应发送器的参数(EmailSender.send_email/DingDingSender.send_message),
+                       可以额外指定level(报警级别), 排队时级别高的先发送
+        :return: 发送结果的Future(被抑制时结果为None)
+        """
+        job = _Job(channel, kwargs, concurrent.futures.Future())
+        return self._submit(job, self._fingerprint(job))
+
+    def submit_deferred(self,
+                        channel: str,
+                        build: Callable[[], dict],
+                        level=None,
+                        key: Optional[Hashable] = None) -> concurrent.futures.Future:
+        """
+        提交一个通知任务, 发送参数由build在事件循环线程中生成(调用方线程不做消息渲染)
+        :param channel: 渠道 email/dingding
+        :param build: 返回发送参数的函数
+        :param level: 报警级别, 排队时级别高的先发送
+        :param key: 重复通知的指纹, 为None时不抑制
+        :return: 发送结果的Future(被抑制时结果为None)
+        """
+        return self._submit(_Job(channel, {}, concurrent.futures.Future(), build, level), key)
+
+    @staticmethod
+    def _fingerprint(job: _Job) -> tuple:
+        """
+        :return: 直接提交的通知的指纹(渠道, 级别和消息内容)
+        """
+        kwargs = job.kwargs
+        message = "\n".join(str(kwargs[name]) for name in FINGERPRINT_FIELDS if kwargs.get(name) is not None)
+        return fingerprint(message or repr(sorted(kwargs.items())), job.channel, job.level)
+
+    def _submit(self, job: _Job, key: Optional[Hashable] = None) -> concurrent.futures.Future:
+        if job.channel not in CHANNELS:
+            raise ValueError("通知渠道不存在: {}".format(job.channel))
+        if key is not None and self._suppressor is not None:
+            if self._closed:
+                raise RuntimeError("通知分发器已关闭")
+            key = (job.channel, key)
+            remaining = self._suppressor.offer(key)
+            if remaining is not None:
+                self._schedule_flush(remaining)
+                job.future.set_result(None)
+                return job.future
+            self._suppressor.set_sample(key, (job.channel, job.kwargs, job.build, job.level))
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("通知分发器已关闭")
+            if len(self._pending) >= self.max_pending:
+                job.future.set_exception(RuntimeError("通知队列已满"))
+                return job.future
+            self._pending.append(job)
+            # 队列深度: 提交后到完成(成功/失败/取消)前
+            depth = self._metrics.channel(job.channel).queue_depth
+            depth.inc()
+            job.future.add_done_callback(lambda _: depth.dec())
+            self._start()
+            if self._wakeup_scheduled:
+                return job.future
+            self._wakeup_scheduled = True
+        self.loop.call_soon_threadsafe(self._drain)
+        return job.future
+
+    def submit_email(self, **kwargs) -> concurrent.futures.Future:
+        """
+        参数同EmailSender.send_email
+        """
+        return self.submit("email", **kwargs)
+
+    def submit_dingding(self, msg_type: str, **kwargs) -> concurrent.futures.Future:
+        """
+        参数同DingDingSender.send_message
+        """
+        return self.submit("dingding", msg_type=msg_type, **kwargs)
+
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        """
+        线程安全地在事件循环线程中延迟执行callback
+        :param delay: 延迟秒数
+        :param callback: 回调函数
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._start()
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, callback)
+
+    def _schedule_flush(self, delay: float):
+        """
+        安排汇总检查, 同一时间只保留最早的一个定时器
+        """
+        with self._flush_lock:
+            at = self._suppressor.clock() + delay
+            if self._flush_at is not None and self._flush_at <= at:
+                return
+            self._flush_at = at
+        self.call_later(delay, self._flush_summaries)
+
+    def _flush_summaries(self):
+        """
+        在事件循环线程中发送已经结束的窗口的汇总
+        """
+        with self._flush_lock:
+            self._flush_at = None
+        if self._stopping:
+            return
+        self._dispatch([self._summary_job(summary) for summary in self._suppressor.expire()])
+        deadline = self._suppressor.next_deadline()
+        if deadline is not None:
+            self._schedule_flush(max(0.0, deadline - self._suppressor.clock()))
+
+    def _summary_job(self, summary: Summary) -> _Job:
+        """
+        :return: 汇总通知: 在第一条通知的正文后附加被抑制的次数;
+                 合并后的其他通知(OTHER_KEY)没有样例, 发送一条通用的钉钉汇总
+        """
+        if summary.sample is None:
+            content = "{}: 最近{}秒内还有{}条重复通知被抑制".format(self.digest_title, self._suppressor.window,
+                                                           summary.count)
+            kwargs = {"msg_type": "text", "content": content, "level": "WARNING"}
+            return _Job("dingding", kwargs, concurrent.futures.Future())
+        channel, kwargs, build, level = summary.sample
+        note = "(最近{}秒内又出现了{}次)".format(self._suppressor.window, summary.count)
+
+        def build_summary() -> dict:
+            summary_kwargs = dict(build() if build is not None else kwargs)
+            for name in ("text", "content"):
+                if isinstance(summary_kwargs.get(name), str):
+                    summary_kwargs[name] = "{}\n\n{}".format(summary_kwargs[name], note)
+                    return summary_kwargs
+            # 没有正文的消息(如feedCard)
+            return {"msg_type": "text", "content": "{}\n{}".format(summary_kwargs.get("title", ""), note),
+                    "level": summary_kwargs.get("level")}
+        return _Job(channel, {}, concurrent.futures.Future(), build_summary, level)
+
+    def _drain(self):
+        with self._lock:
+            jobs = list(self._pending)
+            self._pending.clear()
+            self._wakeup_scheduled = False
+        self._dispatch(jobs)
+
+    def _dispatch(self, jobs: list):
+        """
+        在事件循环线程中开始发送取出的任务
+        """
+        self._semaphore_or_create()
+        for job in jobs:
+            if self._accept(job) is not True:
+                continue
+            if self.pack_dingding and job.channel == "dingding":
+                self._backlog.append(job)
+                continue
+            self._track(self.loop.create_task(self._run_job(job)))
+        if self._backlog:
+            if self._backlog_task is None:
+                self._backlog_event = asyncio.Event()
+                self._backlog_task = self._track(self.loop.create_task(self._run_backlog()))
+            self._backlog_event.set()
+
+    def _track(self, task: asyncio.Task) -> asyncio.Task:
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _accept(self, job: _Job) -> bool:
+        """
+        取出任务时就生成发送参数并写入spool, 还在等待发送名额(concurrency)的任务在进程崩溃后也能重新发送
+        :return: 任务是否需要发送
+        """
+        if job.future.cancelled():
+            return False
+        return self._build(job)
+
+    def _discard(self, job: _Job):
+        """
+        调用方在发送前取消了任务, 从spool中确认(不再重新发送)
+        """
+        if job.spool_id is not None:
+            self._spool.ack(job.spool_id)
+
+    async def _run_job(self, job: _Job):
+        try:
+            async with self._semaphore.hold(job.level):
+                if job.future.set_running_or_notify_cancel() is not True:
+                    self._discard(job)
+                    return
+                await self._attempt(job)
+        except asyncio.CancelledError:
+            # 关闭时被取消, 保证调用方的Future一定会结束
+            self._cancel(job)
+            raise
+
+    @staticmethod
+    def _cancel(job: _Job):
+        if job.future.done() is not True and job.future.cancel() is not True:
+            job.future.set_exception(concurrent.futures.CancelledError())
+
+    def _build(self, job: _Job) -> bool:
+        if job.build is not None:
+            try:
+                job.kwargs = job.build()
+            except Exception as err:
+                job.future.set_exception(err)
+                return False
+            job.build = None
+            if job.level is None:
+                job.level = job.kwargs.get("level")
+        if self._spool is not None:
+            try:
+                job.spool_id = self._spool.enqueue(job.channel, job.kwargs)
+            except (TypeError, ValueError) as err:
+                # 参数中有不能序列化的内容(如文件对象), 只能直接发送
+                self._logger.vision_logger("WARN", "%s通知无法写入spool: %s", job.channel, err)
+        return True
+
+    def _settle(self, job: _Job, result=None, error: Optional[BaseException] = None):
+        """
+        设置任务结果, 成功时从spool中确认, 失败时稍后从spool重新发送
+        """
+        if error is None:
+            if job.spool_id is not None:
+                self._spool.ack(job.spool_id)
+            job.future.set_result(result)
+        else:
+            if job.spool_id is not None:
+                self._retry_later(job.spool_id, job.channel, 0, error)
+            job.future.set_exception(error)
+
+    async def _attempt(self, job: _Job):
+        try:
+            result = await self._deliver(job.channel, job.kwargs)
+        except Exception as err:
+            self._settle(job, error=err)
+        else:
+            self._settle(job, result)
+
+    def _retry_later(self, entry_id: str, channel: str, attempts: int, error: Exception):
+        """
+        发送失败的spool通知: 永久错误或者重新发送的次数用完时转入死信, 否则稍后重新发送
+        """
+        if self._is_permanent(error) or attempts >= self.replay_max_attempts:
+            self._logger.vision_logger("ERROR", "%s通知放弃发送(已重新发送%s次): %s", channel, attempts, error)
+            self._spool.dead_letter(entry_id, "{}: {}".format(type(error).__name__, error))
+            return
+        self._schedule_replay(entry_id, attempts)
+
+    def _schedule_replay(self, entry_id: str, attempts: int):
+        if self._stopping:
+            return
+        delay = min(self.replay_max_delay, self.replay_base_delay * 2 ** attempts)
+        # 随机抖动, 避免重启后大量通知同时重发
+        delay *= random.uniform(0.5, 1.5)
+        self.loop.call_later(delay, self._replay, entry_id, attempts + 1)
+
+    def _replay(self, entry_id: str, attempts: int):
+        if self._stopping:
+            return
+        entry = self._spool.get(entry_id)
+        if entry is not None:
+            self._track(self.loop.create_task(self._replay_entry(entry, attempts)))
+
+    async def _replay_entry(self, entry, attempts: int):
+        try:
+            async with self._semaphore_or_create().hold(entry.kwargs.get("level")):
+                await self._deliver(entry.channel, entry.kwargs)
+        except Exception as err:
+            self._logger.vision_logger("WARN", "spool中的%s通知第%s次重新发送失败: %s", entry.channel, attempts, err)
+            self._retry_later(entry.id, entry.channel, attempts, err)
+        else:
+            self._spool.ack(entry.id)
+
+    def _compact(self):
+        """
+        定时把旧分段中还未确认的通知搬到当前分段, 删除旧分段
+        """
+        if self._stopping:
+            return
+        try:
+            self._spool.compact()
+        except OSError as err:
+            self._logger.vision_logger("WARN", "spool压缩失败: %s", err)
+        self.loop.call_later(self.compact_interval, self._compact)
+
+    def _semaphore_or_create(self) -> PrioritySemaphore:
+        if self._semaphore is None:
+            self._semaphore = PrioritySemaphore(self.concurrency)
+        return self._semaphore
+
+    def metrics(self) -> dict:
+        """
+        :return: 熔断器和故障转移的统计(发送次数、耗时、队列深度等见metrics.REGISTRY)
+        """
+        return self.failover.metrics()
+
+    async def _deliver(self, channel: str, kwargs: dict):
+        """
+        按故障转移链发送一条通知, 当前渠道失败或已熔断时转到下一个渠道
+        :return: 发送成功的发送器的返回值
+        """
+        error = None
+        for target in self.failover.route(channel):
+            try:
+                result = await self._deliver_to(target, self.failover.convert(channel, target, kwargs))
+            except Exception as err:
+                error = err
+                # 消息内容被拒绝(如钉钉的内容太长/参数错误)不是渠道故障, 不转移到后备渠道
+                if getattr(err, 'permanent', False):
+                    break
+                continue
+            if target != channel:
+                self.failover.record_failover(channel, target)
+            return result
+        raise error
+
+    async def _deliver_to(self, channel: str, kwargs: dict):
+        """
+        通过一个渠道发送通知, 失败时重试, 熔断器打开时不再发送
+        :return: 发送器的返回值
+        """
+        breaker = self.failover.breaker(channel)
+        attempt, error = 0, None
+        while True:
+            if breaker.allow() is not True:
+                self.failover.record_rejected(channel)
+                if error is not None:
+                    raise error
+                raise CircuitOpenError(channel, breaker.retry_after())
+            start = self.loop.time()
+            try:
+                result = await self._send(channel, kwargs)
+                error = None
+                # 钉钉拒绝的消息由send_message抛出DingDingError, 网络错误或机器人被拉黑时返回None
+                if channel == "dingding" and result is not True:
+                    from DataVision.LoggerNotification.DingDingNotification import DingDingError
+                    error = DingDingError()
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as err:
+                result, error = None, err
+            # 参数错误等永久错误说明渠道本身是正常的
+            breaker.record(error is None or self._is_permanent(error), self.loop.time() - start)
+            if error is None:
+                return result
+            if attempt >= self.retries or self._is_permanent(error):
+                raise error
+            delay = self.retry_delay * 2 ** attempt
+            attempt += 1
+            self._logger.vision_logger("WARN", "%s通知发送失败(%s), %s秒后第%s次重试",
+                                       channel, error, delay, attempt)
+            await asyncio.sleep(delay)
+
+    async def _run_backlog(self):
+        """
+        逐批发送积压的钉钉报警
+        """
+        while True:
+            jobs = self._next_batch()
+            if jobs:
+                self._track(self.loop.create_task(self._run_batch(jobs)))
+                continue
+            if self._stopping and not self._backlog and not self._sending:
+                return
+            self._backlog_event.clear()
+            try:
+                await self._backlog_event.wait()
+            except asyncio.CancelledError:
+                while self._backlog:
+                    self._cancel(self._backlog.popleft())
+                raise
+
+    def _next_batch(self) -> list:
+        """
+        取出下一批要发送的钉钉报警: 没有正在发送的批次时取出全部积压的报警,
+        否则只取出比正在发送的报警更严重的报警(其余的继续积压, 等上一批发送完成后合并发送)
+        """
+        if not self._backlog:
+            return []
+        if self._sending:
+            top = min(self._sending)
+            jobs = [job for job in self._backlog if lane_of(job.level) < top]
+            if not jobs:
+                return []
+            self._backlog = collections.deque(job for job in self._backlog if lane_of(job.level) >= top)
+        else:
+            jobs = list(self._backlog)
+            self._backlog.clear()
+        batch = []
+        for job in jobs:
+            if job.future.set_running_or_notify_cancel():
+                batch.append(job)
+            else:
+                self._discard(job)
+        return batch
+
+    async def _run_batch(self, jobs: list):
+        """
+        按这批报警中最严重的级别占用一个发送名额后合并发送, 完成后唤醒积压队列的发送任务
+        """
+        lane = min(lane_of(job.level) for job in jobs)
+        self._sending.append(lane)
+        try:
+            async with self._semaphore.hold(LANES[lane]):
+                await self._send_batch(jobs)
+        except asyncio.CancelledError:
+            for job in jobs:
+                self._cancel(job)
+            raise
+        finally:
+            self._sending.remove(lane)
+            self._backlog_event.set()
+
+    async def _send_batch(self, jobs: list):
+        """
+        合并一批钉钉报警并发送, 每个任务的结果为其所在的所有消息都发送成功
+        """
+        items, singles = [], []
+        for job in jobs:
+            item = to_item(job, job.kwargs) if len(jobs) > 1 else None
+            if item is None:
+                singles.append((job.kwargs, [job]))
+            else:
+                items.append(item)
+        messages = singles + pack(items, title=self.digest_title, max_bytes=self.max_message_bytes)
+        if len(messages) < len(jobs):
+            self._logger.vision_logger("DEBUG", "%s条钉钉报警合并为%s条消息发送", len(jobs), len(messages))
+        results = await asyncio.gather(*[self._deliver("dingding", kwargs) for kwargs, _ in messages],
+                                       return_exceptions=True)
+        errors = {}
+        for (_, owners), result in zip(messages, results):
+            if isinstance(result, BaseException):
+                for job in owners:
+                    errors.setdefault(job, result)
+        for job in jobs:
+            self._settle(job, True, errors.get(job))
+
+    @staticmethod
+    def _is_permanent(error: Exception) -> bool:
+        """
+        参数错误、SMTP的5xx应答和钉钉的内容错误(DingDingError.permanent)重试也不会成功
+        """
+        if isinstance(error, (ValueError, TypeError)) or getattr(error, 'permanent', False):
+            return True
+        code = getattr(error, 'code', None)
+        return isinstance(code, int) and 500 <= code < 600
+
+    async def _send(self, channel: str, kwargs: dict):
+        if channel in self.failover.sinks:
+            return await self.failover.sinks[channel].send(**kwargs)
+        if channel == "dingding":
+            # level用于合并时分节和限流排队
+            return await self._get_dingding_sender().send_message(**kwargs)
+        if "level" in kwargs:
+            kwargs = dict(kwargs)
+            kwargs.pop("level")
+        return await self._get_email_sender().send_email(**kwargs)
+
+    def _get_email_sender(self):
+        if self._email_sender is None:
+            from DataVision.LoggerNotification.EmailNotification import EmailSender
+            self._email_sender = EmailSender(loop=self.loop, config_path=self.config_path, metrics=self._metrics)
+        return self._email_sender
+
+    def _get_dingding_sender(self):
+        if self._dingding_sender is None:
+            from DataVision.LoggerNotification.DingDingNotification import DingDingSender
+            self._dingding_sender = DingDingSender(config_path=self.config_path,
+                                                   sleep=asyncio.sleep,
+                                                   session=AsyncHTTPSession(),
+                                                   metrics=self._metrics)
+        return self._dingding_sender
+
+    def shutdown(self, wait: bool = True, timeout: Optional[float] = None):
+        """
+        关闭分发器
+        :param wait: 是否等待已提交的任务发送完成, False时取消未完成的任务
+        :param timeout: 最长等待秒数, 超时后取消剩余任务
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            started = self._thread is not None
+        if started is not True:
+            self.loop.close()
+            return
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(wait), self.loop)
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self._logger.vision_logger("WARN", "通知分发器关闭超时, 取消剩余的%s个任务", len(self._tasks))
+            asyncio.run_coroutine_threadsafe(self._shutdown(False), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    async def _shutdown(self, wait: bool):
+        # 取走shutdown之前提交但还没有被唤醒处理的任务
+        self._drain()
+        if self._suppressor is not None:
+            # 还没有到窗口结束时间的汇总在关闭前发出
+            self._dispatch([self._summary_job(summary) for summary in self._suppressor.drain()])
+        self._stopping = True
+        if self._backlog_event is not None:
+            self._backlog_event.set()
+        tasks = list(self._tasks)
+        if wait is not True:
+            for task in tasks:
+                task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if self._dingding_sender is not None:
+            await self._dingding_sender.close()
+        if self._email_sender is not None:
+            await self._email_sender.pool.close()
+        await self.failover.close()
+        if self._spool is not None:
+            self._spool.close()
+
+    def __enter__(self) -> "NotificationDispatcher":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown()
+
+
+# 进程内共用的分发器
+_default_dispatcher = None
+_default_lock = threading.Lock()
+
+
+def get_dispatcher() -> NotificationDispatcher:
+    """
+    :return: 进程内共用的通知分发器, 进程退出时自动关闭
+    """
+    global _default_dispatcher
+    with _default_lock:
+        if _default_dispatcher is None:
+            _default_dispatcher = NotificationDispatcher()
+        return _default_dispatcher
+
+
+@atexit.register
+def _shutdown_default_dispatcher():
+    if _default_dispatcher is not None:
+        _default_dispatcher.shutdown(timeout=30)
@@ -0,0 +1,185 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: failover
+通知渠道的故障转移链(钉钉 -> 邮件 -> 本地文件/Redis)
+"""
+# Python内置库
+import json
+import threading
+import collections
+from typing import List, Optional
+
+# 项目内部库
+from DataVision.LoggerHandler.logger import VisionLogger
+from DataVision.LoggerNotification.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from DataVision.LoggerNotification.metrics import NotificationMetrics, notification_metrics
+from DataVision.LoggerNotification.sinks import FileSink, RedisSink
+
+# 日志路径
+LOGGER_PATH = '../../DataVision/LoggerConfig/logger_config.yaml'
+
+# 可以出现在故障转移链中的渠道
+FAILOVER_CHANNELS = ("dingding", "email", "file", "redis")
+
+
+def _title_and_text(channel: str, kwargs: dict) -> tuple:
+    """
+    :return: 通知的 (标题, 正文)
+    """
+    if channel == "email":
+        return kwargs.get("subject") or "", kwargs.get("content") or ""
+    text = kwargs.get("text") or kwargs.get("content")
+    if text is None:
+        # link/actionCard/feedCard等消息没有统一的正文, 直接使用消息参数
+        text = json.dumps(kwargs, ensure_ascii=False, default=str)
+    title = kwargs.get("title") or str(text).split("\n", 1)[0][:80]
+    return title, str(text)
+
+
+class FailoverChain(object):
+    """
+    故障转移链:
+        每个渠道有一个熔断器, 熔断器打开的渠道直接跳过(不再等待超时);
+        通知先使用自己的渠道发送, 失败或熔断时依次转到链中排在后面的渠道,
+        参数按目标渠道转换(钉钉消息转为邮件时收件人为email);
+        file和redis只作为兜底存储, 不能直接提交.
+    可以在通知配置文件中配置:
+        "Failover": {
+            "chain": ["dingding", "email", "file"],
+            "email": ["ops@example.com"],
+            "file": "logs/failover_alerts.log",
+            "redis": {"host": "127.0.0.1", "port": 6379, "key": "DataVision:alerts"},
+            "breaker": {"failure_rate": 0.5, "slow_call_seconds": 5, "open_seconds": 30}
+        }
+    metrics返回熔断器状态、状态变化次数、故障转移次数和熔断拒绝次数, 这些统计同时记录到指标注册表中.
+    """
+
+    def __init__(self,
+                 chain: Optional[List[str]] = None,
+                 email: Optional[List[str]] = None,
+                 file: Optional[str] = None,
+                 redis: Optional[dict] = None,
+                 breaker: Optional[dict] = None,
+                 metrics: Optional[NotificationMetrics] = None) -> None:
+        """
+        :param chain: 渠道顺序, 为空时不转移(每个渠道仍然有熔断器)
+        :param email: 转为邮件时的收件人列表
+        :param file: file渠道的文件路径
+        :param redis: redis渠道的RedisSink参数
+        :param breaker: 熔断器参数(CircuitBreaker的参数)
+        :param metrics: 导出的指标, 默认使用进程内共用的注册表
+        """
+        self._logger = VisionLogger(LOGGER_PATH)
+        self.chain = list(chain or [])
+        for channel in self.chain:
+            if channel not in FAILOVER_CHANNELS:
+                raise ValueError("故障转移渠道不存在: {}".format(channel))
+        if len(set(self.chain)) != len(self.chain):
+            raise ValueError("故障转移链中的渠道不能重复")
+        self.email = list(email or [])
+        if "email" in self.chain[1:] and not self.email:
+            raise ValueError("故障转移到邮件时需要配置收件人")
+        self.sinks = {}
+        if "file" in self.chain:
+            if not file:
+                raise ValueError("故障转移到文件时需要配置文件路径")
+            self.sinks["file"] = FileSink(file)
+        if "redis" in self.chain:
+            self.sinks["redis"] = RedisSink(**(redis or {}))
+        self.breaker_options = dict(breaker or {})
+        self._breakers = {}
+        self._lock = threading.Lock()
+        # (渠道, 原状态, 新状态) -> 次数
+        self._transitions = collections.Counter()
+        # (原渠道, 实际发送的后备渠道) -> 次数
+        self._failovers = collections.Counter()
+        # 渠道 -> 熔断拒绝次数
+        self._rejected = collections.Counter()
+        self._metrics = metrics or notification_metrics()
+
+    @classmethod
+    def from_config(cls, config_path: str, metrics: Optional[NotificationMetrics] = None) -> "FailoverChain":
+        """
+        :param config_path: 通知配置文件路径, 没有Failover配置时返回不转移的链
+        :param metrics: 导出的指标
+        """
+        if config_path == "":
+            config_path = ".././LoggerConfig/logger_notification_config.json"
+        try:
+            with open(config_path, 'r') as f:
+                config = json.load(f).get("Failover") or {}
+        except (OSError, ValueError):
+            config = {}
+        return cls(metrics=metrics, **config)
+
+    def route(self, channel: str) -> List[str]:
+        """
+        :param channel: 通知自己的渠道
+        :return: 依次尝试的渠道
+        """
+        if channel in self.chain:
+            return self.chain[self.chain.index(channel):]
+        return [channel]
+
+    def breaker(self, channel: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(channel)
+            if breaker is None:
+                breaker = CircuitBreaker(channel, listener=self._on_transition, **self.breaker_options)
+                self._breakers[channel] = breaker
+            return breaker
+
+    def _on_transition(self, channel: str, previous: str, state: str):
+        self._transitions[(channel, previous, state)] += 1
+        self._metrics.transitions.labels(channel, previous, state).inc()
+        self._metrics.circuit_open.labels(channel).set(1 if state == OPEN else 0.5 if state == HALF_OPEN else 0)
+        if state == OPEN:
+            self._logger.vision_logger("WARN", "%s渠道熔断, 之后的通知直接转移到后备渠道", channel)
+        elif state == CLOSED:
+            self._logger.vision_logger("INFO", "%s渠道恢复", channel)
+
+    def record_failover(self, source: str, target: str):
+        self._failovers[(source, target)] += 1
+        self._metrics.failovers.labels(source, target).inc()
+        self._logger.vision_logger("WARN", "%s通知已转移到%s发送", source, target)
+
+    def record_rejected(self, channel: str):
+        self._rejected[channel] += 1
+        self._metrics.rejected.labels(channel).inc()
+
+    def convert(self, source: str, target: str, kwargs: dict) -> dict:
+        """
+        把发送参数从source渠道转换为target渠道
+        """
+        if target in self.sinks:
+            # 兜底存储记录原来的渠道和参数
+            return {"channel": source, "kwargs": kwargs}
+        if source == target:
+            return kwargs
+        title, text = _title_and_text(source, kwargs)
+        if target == "email":
+            converted = {"target_list": self.email, "subject": title, "content": text}
+        else:
+            converted = {"msg_type": "markdown", "title": title, "text": text}
+        if "level" in kwargs:
+            converted["level"] = kwargs["level"]
+        return converted
+
+    def metrics(self) -> dict:
+        """
+        :return: 熔断器状态、状态变化次数、故障转移次数和熔断拒绝次数
+        """
+        with self._lock:
+            breakers = list(self._breakers.items())
+        return {
+            "breakers": {channel: breaker.state for channel, breaker in breakers},
+            "transitions": {"{}:{}->{}".format(*key): count for key, count in self._transitions.items()},
+            "failovers": {"{}->{}".format(*key): count for key, count in self._failovers.items()},
+            "rejected": dict(self._rejected),
+        }
+
+    async def close(self):
+        for sink in self.sinks.values():
+            await sink.close()
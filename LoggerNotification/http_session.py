@@ -0,0 +1,205 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: http_session
+基于asyncio的HTTP/1.1长连接会话(只实现报警发送需要的部分)
+"""
+# Python内置库
+import ssl
+import asyncio
+import collections
+from typing import Optional
+from urllib.parse import urlsplit
+
+# 幂等的请求方法, 复用的连接失败时可以换新连接重发
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE"))
+
+
+class RequestNotSent(ConnectionResetError):
+    """
+    连接在写入请求之前就已经关闭, 服务端没有收到任何数据
+    """
+
+
+class HTTPResponse(object):
+    """
+    HTTP响应, 属性与asks的响应保持一致
+    """
+
+    def __init__(self, status_code: int, reason: str, headers: dict, content: bytes) -> None:
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def __repr__(self) -> str:
+        return "<HTTPResponse {} {}>".format(self.status_code, self.reason)
+
+
+class AsyncHTTPSession(object):
+    """
+    asyncio的长连接HTTP会话, 按(协议, 主机, 端口)复用空闲连接,
+    同时进行的请求数由信号量限制为connections.
+    post的参数与asks.Session.post一致, 因此可以直接替换DingDingSender的会话.
+    不会自动跟随重定向(钉钉网关返回302表示机器人被拉黑, 需要调用方处理).
+    复用的连接已被服务端关闭时: 请求还没有写入则换新连接重发; 已经写入时服务端可能已经处理了请求,
+    只有幂等的请求(GET等)才重发, POST等默认直接抛出异常(避免同一条报警发送两次), 由调用方决定是否重发.
+    """
+
+    def __init__(self,
+                 connections: int = 4,
+                 timeout: float = 30,
+                 ssl_context: Optional[ssl.SSLContext] = None,
+                 retry_non_idempotent: bool = False) -> None:
+        """
+        :param connections: 最大连接数
+        :param timeout: 单个请求(包括建立连接)的超时时间
+        :param ssl_context: https使用的SSL上下文, 默认为系统默认配置
+        :param retry_non_idempotent: 复用的连接在写入请求后失败时, 是否也重发POST等非幂等的请求
+        """
+        if connections < 1:
+            raise ValueError("连接数必须大于0")
+        self.connections = connections
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.retry_non_idempotent = retry_non_idempotent
+        # {(协议, 主机, 端口): 空闲连接 (reader, writer)}
+        self._idle = collections.defaultdict(collections.deque)
+        # 信号量需要在事件循环中创建
+        self._semaphore = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.connections)
+        return self._semaphore
+
+    async def post(self, url: str, data: bytes = b"", headers: Optional[dict] = None, follow_redirects: bool = False):
+        return await self.request("POST", url, data=data, headers=headers)
+
+    async def get(self, url: str, headers: Optional[dict] = None, follow_redirects: bool = False):
+        return await self.request("GET", url, headers=headers)
+
+    async def request(self, method: str, url: str, data: bytes = b"", headers: Optional[dict] = None) -> HTTPResponse:
+        """
+        :param method: 请求方法
+        :param url: 完整地址
+        :param data: 请求体
+        :param headers: 请求头
+        :return: 响应
+        """
+        parts = urlsplit(url)
+        secure = parts.scheme == "https"
+        port = parts.port or (443 if secure else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        request_headers = collections.OrderedDict([
+            ("Host", parts.netloc),
+            ("Content-Length", str(len(data))),
+            ("Connection", "keep-alive"),
+        ])
+        request_headers.update(headers or {})
+        head = "{} {} HTTP/1.1\r\n{}\r\n\r\n".format(
+            method, path, "\r\n".join("{}: {}".format(k, v) for k, v in request_headers.items()))
+        # 请求头和请求体一次写入, 避免Nagle算法带来的延迟
+        payload = head.encode('latin-1') + data
+
+        async with self._get_semaphore():
+            while True:
+                reader, writer, reused = await self._checkout(key, secure)
+                try:
+                    response = await asyncio.wait_for(self._roundtrip(reader, writer, payload, method), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError) as err:
+                    writer.close()
+                    # 复用的连接可能已被服务端关闭, 换新连接重发
+                    if reused and self._can_resend(method, err):
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if response.headers.get("connection", "").lower() == "close":
+                    writer.close()
+                else:
+                    self._idle[key].append((reader, writer))
+                return response
+
+    def _can_resend(self, method: str, error: Exception) -> bool:
+        """
+        :return: 请求失败后是否可以重发(不会使服务端重复处理同一个非幂等的请求)
+        """
+        return isinstance(error, RequestNotSent) or method in IDEMPOTENT_METHODS or self.retry_non_idempotent
+
+    async def _checkout(self, key: tuple, secure: bool) -> tuple:
+        idle = self._idle[key]
+        while idle:
+            # 后进先出, 优先复用最近使用过的连接
+            reader, writer = idle.pop()
+            if reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+            return reader, writer, True
+        context = None
+        if secure:
+            context = self.ssl_context or ssl.create_default_context()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(key[1], key[2], ssl=context), self.timeout)
+        return reader, writer, False
+
+    @staticmethod
+    async def _roundtrip(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                         payload: bytes, method: str) -> HTTPResponse:
+        if reader.at_eof() or writer.is_closing():
+            raise RequestNotSent("服务端在发送请求前关闭了连接")
+        writer.write(payload)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("服务端关闭了连接")
+        _version, status, reason = (status_line.decode('latin-1').rstrip("\r\n").split(" ", 2) + [""])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        status_code = int(status)
+        if method == "HEAD" or status_code in (204, 304) or 100 <= status_code < 200:
+            content = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";", 1)[0], 16)
+                if size == 0:
+                    # 跳过trailer
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = b"".join(chunks)
+        elif "content-length" in headers:
+            content = await reader.readexactly(int(headers["content-length"]))
+        else:
+            # 没有长度信息时读到连接关闭为止
+            content = await reader.read()
+            headers["connection"] = "close"
+        return HTTPResponse(status_code, reason, headers, content)
+
+    async def close(self):
+        """
+        关闭所有空闲连接
+        """
+        for idle in self._idle.values():
+            while idle:
+                _, writer = idle.pop()
+                writer.close()
+        self._idle.clear()
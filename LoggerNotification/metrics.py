@@ -0,0 +1,526 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: metrics
+通知发送的运行指标(计数器/仪表/直方图), 可以导出为Prometheus文本格式、本地HTTP端点、文件或字典快照
+"""
+# Python内置库
+import os
+import json
+import time
+import bisect
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+# 发送耗时和排队等待时间的默认分桶(秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# 导出的HTTP端点默认端口
+DEFAULT_PORT = 9108
+
+
+class _Shards(object):
+    """
+    按线程分片的数值: 每个线程只修改自己的分片(不需要加锁), 读取时把所有分片相加.
+    分片在线程第一次写入时创建, 线程结束后保留(已经累加的值不能丢失).
+    """
+    __slots__ = ('_local', '_cells', '_lock', '_size')
+
+    def __init__(self, size: int = 1) -> None:
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+        self._size = size
+
+    def cell(self) -> list:
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = [0] * self._size
+            with self._lock:
+                self._cells.append(cell)
+            self._local.cell = cell
+            return cell
+
+    def totals(self) -> list:
+        with self._lock:
+            cells = list(self._cells)
+        totals = [0] * self._size
+        for cell in cells:
+            for index, value in enumerate(cell):
+                totals[index] += value
+        return totals
+
+
+class CounterChild(object):
+    """
+    一组标签值对应的计数器
+    """
+    __slots__ = ('_shards',)
+
+    def __init__(self) -> None:
+        self._shards = _Shards()
+
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError("计数器只能增加")
+        self._shards.cell()[0] += amount
+
+    @property
+    def value(self):
+        return self._shards.totals()[0]
+
+
+class GaugeChild(object):
+    """
+    一组标签值对应的仪表: inc/dec按线程分片, set设置当前值, set_function在读取时调用函数取值
+    """
+    __slots__ = ('_shards', '_offset', '_function')
+
+    def __init__(self) -> None:
+        self._shards = _Shards()
+        self._offset = 0
+        self._function = None
+
+    def inc(self, amount=1):
+        self._shards.cell()[0] += amount
+
+    def dec(self, amount=1):
+        self._shards.cell()[0] -= amount
+
+    def set(self, value):
+        # 与其他线程同时inc/dec时以set之后的增减为准
+        self._offset = value - self._shards.totals()[0]
+
+    def set_function(self, function: Optional[Callable[[], float]]):
+        self._function = function
+
+    @property
+    def value(self):
+        if self._function is not None:
+            return self._function()
+        return self._offset + self._shards.totals()[0]
+
+
+class HistogramChild(object):
+    """
+    一组标签值对应的直方图, 分片中依次保存各分桶(不累计)的次数、总和与次数
+    """
+    __slots__ = ('_shards', '_bounds')
+
+    def __init__(self, bounds: tuple) -> None:
+        self._bounds = bounds
+        self._shards = _Shards(len(bounds) + 3)
+
+    def observe(self, value: float):
+        cell = self._shards.cell()
+        # 等于上界的值属于该分桶(Prometheus的le), 超过所有上界的值在+Inf分桶
+        cell[bisect.bisect_left(self._bounds, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def time(self) -> "_Timer":
+        """
+        with histogram.time(): ...
+        """
+        return _Timer(self)
+
+    @property
+    def value(self) -> dict:
+        totals = self._shards.totals()
+        buckets, cumulative = {}, 0
+        for bound, count in zip(self._bounds + (float("inf"),), totals):
+            cumulative += count
+            buckets[_format_value(bound)] = cumulative
+        return {"buckets": buckets, "sum": totals[-2], "count": totals[-1]}
+
+
+class _Timer(object):
+
+    def __init__(self, histogram: HistogramChild) -> None:
+        self._histogram = histogram
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class Metric(object):
+    """
+    一个指标: 名称、说明、标签名和各组标签值对应的子指标.
+    labels返回的子指标会被缓存, 热点路径上应该保存子指标而不是每次调用labels.
+    """
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        :param values: 按labelnames顺序的标签值
+        :return: 子指标
+        """
+        child = self._children.get(values)
+        if child is not None:
+            return child
+        if len(values) != len(self.labelnames):
+            raise ValueError("{}需要的标签为{}".format(self.name, self.labelnames))
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                values = tuple(str(value) for value in values)
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self) -> list:
+        """
+        :return: [(标签值, 值), ...]
+        """
+        with self._lock:
+            children = list(self._children.items())
+        return [(values, child.value) for values, child in children]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new_child(self) -> GaugeChild:
+        return GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+    def _new_child(self) -> HistogramChild:
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+
+class MetricsRegistry(object):
+    """
+    指标注册表: 同名指标只创建一次(类型或标签不一致时报错).
+    写入(inc/observe)按线程分片, 不加锁; 导出时汇总所有分片.
+    """
+
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._writer = None
+
+    def _get_or_create(self, cls, name: str, documentation: str, labelnames: tuple, **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, documentation, labelnames, **kwargs)
+                self._metrics[name] = metric
+            elif type(metric) is not cls or metric.labelnames != tuple(labelnames):
+                raise ValueError("指标{}已经以不同的类型或标签注册".format(name))
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def metrics(self) -> list:
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        :return: {指标名: {"type", "help", "samples": {"标签=值,...": 值}}}, 直方图的值为{"buckets", "sum", "count"}
+        """
+        snapshot = {}
+        for metric in self.metrics():
+            samples = {}
+            for values, value in metric.samples():
+                key = ",".join("{}={}".format(name, label) for name, label in zip(metric.labelnames, values))
+                samples[key] = value
+            snapshot[metric.name] = {"type": metric.kind, "help": metric.documentation, "samples": samples}
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        """
+        :return: Prometheus文本格式(0.0.4)
+        """
+        lines = []
+        for metric in self.metrics():
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation.replace("\n", " ")))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for values, value in metric.samples():
+                if metric.kind != "histogram":
+                    lines.append("{}{} {}".format(metric.name, _format_labels(metric.labelnames, values),
+                                                  _format_value(value)))
+                    continue
+                for bound, count in value["buckets"].items():
+                    lines.append("{}_bucket{} {}".format(
+                        metric.name, _format_labels(metric.labelnames, values, ("le", bound)), count))
+                labels = _format_labels(metric.labelnames, values)
+                lines.append("{}_sum{} {}".format(metric.name, labels, _format_value(value["sum"])))
+                lines.append("{}_count{} {}".format(metric.name, labels, value["count"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """
+        导出到文件(先写临时文件再替换, 读取方不会读到写了一半的内容);
+        扩展名为.json时写入snapshot, 否则写入Prometheus文本格式(可以给node_exporter的textfile采集)
+        """
+        if path.endswith(".json"):
+            content = json.dumps(self.snapshot(), ensure_ascii=False, sort_keys=True)
+        else:
+            content = self.to_prometheus()
+        directory = os.path.dirname(path)
+        if directory and os.path.exists(directory) is not True:
+            os.makedirs(directory)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+    def serve(self, port: int = DEFAULT_PORT, host: str = "127.0.0.1"):
+        """
+        在后台线程中提供HTTP端点: /metrics为Prometheus文本格式, /metrics.json为snapshot
+        :return: HTTP服务器(server_address为实际监听的地址)
+        """
+        with self._lock:
+            if self._server is not None:
+                return self._server
+            import http.server
+            registry = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+
+                def do_GET(self):
+                    path = self.path.split("?", 1)[0]
+                    if path == "/metrics":
+                        body, content_type = registry.to_prometheus(), "text/plain; version=0.0.4; charset=utf-8"
+                    elif path == "/metrics.json":
+                        body, content_type = json.dumps(registry.snapshot(), ensure_ascii=False), "application/json"
+                    else:
+                        self.send_error(404)
+                        return
+                    body = body.encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            server = http.server.ThreadingHTTPServer((host, port), Handler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="vision-metrics", daemon=True).start()
+            self._server = server
+            return server
+
+    def write_periodically(self, path: str, interval: float = 15) -> threading.Event:
+        """
+        在后台线程中每interval秒导出一次到文件
+        :return: set后停止导出的Event
+        """
+        with self._lock:
+            if self._writer is not None:
+                return self._writer
+            stop = threading.Event()
+
+            def run():
+                while stop.wait(interval) is not True:
+                    self.write(path)
+                self.write(path)
+
+            threading.Thread(target=run, name="vision-metrics-writer", daemon=True).start()
+            self._writer = stop
+            return stop
+
+    def close(self):
+        """
+        停止HTTP端点和定时导出
+        """
+        with self._lock:
+            server, writer = self._server, self._writer
+            self._server = self._writer = None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if writer is not None:
+            writer.set()
+
+
+# 进程内共用的注册表
+REGISTRY = MetricsRegistry()
+
+
+def export_from_config(config_path: str, registry: MetricsRegistry = REGISTRY):
+    """
+    按通知配置文件中的Metrics启动导出, 没有配置时不导出:
+        "Metrics": {"port": 9108, "host": "127.0.0.1", "file": "logs/vision.prom", "interval": 15}
+    """
+    if config_path == "":
+        config_path = ".././LoggerConfig/logger_notification_config.json"
+    try:
+        with open(config_path, 'r') as f:
+            config = json.load(f).get("Metrics") or {}
+    except (OSError, ValueError):
+        config = {}
+    if config.get("port"):
+        registry.serve(int(config["port"]), config.get("host", "127.0.0.1"))
+    if config.get("file"):
+        registry.write_periodically(config["file"], float(config.get("interval", 15)))
+
+
+class ChannelMetrics(object):
+    """
+    一个通知渠道预先绑定好标签的指标, 发送器在热点路径上直接使用
+    """
+
+    def __init__(self, metrics: "NotificationMetrics", channel: str) -> None:
+        self.channel = channel
+        self._results = metrics.results
+        self.sends = metrics.sends.labels(channel)
+        self.sent_bytes = metrics.sent_bytes.labels(channel)
+        self.send_seconds = metrics.send_seconds.labels(channel)
+        self.limiter_wait = metrics.limiter_wait.labels(channel)
+        self.queue_depth = metrics.queue_depth.labels(channel)
+        # (是否成功, 应答码) -> 结果计数器
+        self._result_children = {}
+
+    def record(self, success: bool, code, seconds: float, size: int = 0):
+        """
+        记录一次发送
+        :param success: 是否成功
+        :param code: 钉钉的errcode/HTTP状态码或SMTP应答码, 没有应答时为异常类型名
+        :param seconds: 发送耗时
+        :param size: 发送的字节数
+        """
+        self.sends.inc()
+        result = self._result_children.get((success, code))
+        if result is None:
+            result = self._results.labels(self.channel, "success" if success else "failure", str(code))
+            self._result_children[(success, code)] = result
+        result.inc()
+        self.send_seconds.observe(seconds)
+        if size:
+            self.sent_bytes.inc(size)
+
+
+class NotificationMetrics(object):
+    """
+    邮件和钉钉发送器、分发器和故障转移链共用的指标
+    """
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY) -> None:
+        self.registry = registry
+        self.sends = registry.counter(
+            "vision_notification_sends_total", "发送请求数(每次HTTP请求或SMTP投递算一次)", ("channel",))
+        self.results = registry.counter(
+            "vision_notification_results_total", "按结果和应答码(钉钉errcode/HTTP状态码/SMTP应答码)统计的发送数",
+            ("channel", "result", "code"))
+        self.send_seconds = registry.histogram(
+            "vision_notification_send_seconds", "单次发送的耗时(秒)", ("channel",))
+        self.sent_bytes = registry.counter(
+            "vision_notification_sent_bytes_total", "发送的消息字节数(邮件按MIME块编码后的大小计算)", ("channel",))
+        self.limiter_wait = registry.histogram(
+            "vision_notification_limiter_wait_seconds", "发送前在限流器中排队的时间(秒)", ("channel",))
+        self.queue_depth = registry.gauge(
+            "vision_notification_queue_depth", "已经提交给分发器但还没有完成的通知数", ("channel",))
+        self.failovers = registry.counter(
+            "vision_notification_failovers_total", "转移到后备渠道发送成功的通知数", ("source", "target"))
+        self.rejected = registry.counter(
+            "vision_notification_circuit_rejected_total", "被打开的熔断器拒绝的发送数", ("channel",))
+        self.transitions = registry.counter(
+            "vision_notification_circuit_transitions_total", "熔断器状态变化次数", ("channel", "from", "to"))
+        self.circuit_open = registry.gauge(
+            "vision_notification_circuit_open", "熔断器是否打开(半开时为0.5)", ("channel",))
+        self._channels = {}
+
+    def channel(self, channel: str) -> ChannelMetrics:
+        metrics = self._channels.get(channel)
+        if metrics is None:
+            metrics = self._channels.setdefault(channel, ChannelMetrics(self, channel))
+        return metrics
+
+
+_notification_metrics = {}
+_notification_lock = threading.Lock()
+
+
+def notification_metrics(registry: MetricsRegistry = REGISTRY) -> NotificationMetrics:
+    """
+    :return: 注册表上的通知指标(每个注册表只创建一次)
+    """
+    with _notification_lock:
+        metrics = _notification_metrics.get(id(registry))
+        if metrics is None or metrics.registry is not registry:
+            metrics = NotificationMetrics(registry)
+            _notification_metrics[id(registry)] = metrics
+        return metrics
+
+
+def error_code(error: BaseException) -> str:
+    """
+    :return: 异常中的应答码(SMTP应答码/HTTP状态码), 没有时为异常类型名
+    """
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return str(code)
+    return type(error).__name__
@@ -0,0 +1,99 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: mime_cache
+编码后MIME块的缓存
+"""
+# Python内置库
+import hashlib
+import threading
+import collections
+from typing import Callable, Union
+from email.mime.base import MIMEBase
+
+# 默认缓存上限(编码后的字节数)
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class EncodedPartCache(object):
+    """
+    按内容寻址的LRU缓存, 保存已经完成base64编码的附件和内嵌图片.
+    同一份内容发送给多个收件人时只编码一次.
+    缓存中的MIME块会被多封邮件共用, 取出后不能再修改.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        """
+        :param max_bytes: 缓存中编码后内容的总字节数上限
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._parts = collections.OrderedDict()
+        # 编码在线程池中进行, 需要加锁
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._parts)
+
+    @staticmethod
+    def make_key(kind: str, name: str, data: Union[bytes, str]) -> tuple:
+        """
+        :param kind: MIME块类型(image/attachment)
+        :param name: 文件名(决定Content-Type和头信息)
+        :param data: 文件内容
+        :return: 缓存键
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return kind, name, hashlib.sha1(data).digest()
+
+    def get(self, key: tuple):
+        with self._lock:
+            part = self._parts.get(key)
+            if part is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._parts.move_to_end(key)
+            return part[0]
+
+    def put(self, key: tuple, part: MIMEBase):
+        payload = part.get_payload()
+        size = len(payload) if isinstance(payload, (str, bytes)) else 0
+        # 超过上限的单个块不缓存
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._parts.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._parts[key] = (part, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, old_size) = self._parts.popitem(last=False)
+                self.size -= old_size
+
+    def get_or_build(self, kind: str, name: str, data: Union[bytes, str],
+                     builder: Callable[[str, Union[bytes, str]], MIMEBase]) -> MIMEBase:
+        """
+        从缓存中获取MIME块, 不存在时调用builder生成并放入缓存
+        :param kind: MIME块类型(image/attachment)
+        :param name: 文件名
+        :param data: 文件内容
+        :param builder: builder(name, data) -> MIME块
+        :return: 编码后的MIME块
+        """
+        key = self.make_key(kind, name, data)
+        part = self.get(key)
+        if part is None:
+            part = builder(name, data)
+            self.put(key, part)
+        return part
+
+    def clear(self):
+        with self._lock:
+            self._parts.clear()
+            self.size = 0
@@ -0,0 +1,279 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: mime_stream
+流式发送的邮件(附件按块读取、编码并写入SMTP DATA)
+"""
+# Python内置库
+import io
+import os
+import re
+import uuid
+import base64
+import asyncio
+import mimetypes
+from typing import TYPE_CHECKING, Iterator, Optional, Dict, Union
+from email.generator import BytesGenerator
+from email.mime.multipart import MIMEMultipart
+from email.mime.nonmultipart import MIMENonMultipart
+from email.utils import getaddresses
+from email import policy as email_policy
+
+# Python第三方库(aiosmtplib在第一次发送时才导入)
+if TYPE_CHECKING:
+    import aiosmtplib
+
+# 每次读取的原始字节数(57字节正好编码为一行76个字符)
+CHUNK_SIZE = 57 * 1024
+
+# SMTP DATA中以"."开头的行需要转义
+_PERIOD_REGEX = re.compile(br'(?m)^\.')
+
+
+class FileAttachment(object):
+    """
+    文件附件, 内容不会一次性读入内存.
+    source可以是文件路径, 也可以是二进制模式打开的文件对象.
+    """
+
+    def __init__(self, source: Union[str, os.PathLike, io.IOBase], chunk_size: int = CHUNK_SIZE) -> None:
+        """
+        :param source: 文件路径或文件对象
+        :param chunk_size: 每次读取的字节数(会向下取整为57的倍数)
+        """
+        self.source = source
+        self.chunk_size = max(57, chunk_size // 57 * 57)
+        self._start = None
+        if hasattr(source, 'read') and hasattr(source, 'seek'):
+            try:
+                self._start = source.tell()
+            except (OSError, ValueError):
+                self._start = None
+
+    @property
+    def replayable(self) -> bool:
+        """
+        :return: 能否重新读取(发送失败重试时需要)
+        """
+        return hasattr(self.source, 'read') is not True or self._start is not None
+
+    def iter_base64(self) -> Iterator[bytes]:
+        """
+        按块读取文件并编码为带CRLF换行的base64
+        """
+        f = self.open()
+        try:
+            while True:
+                chunk = self.read_base64(f)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.release(f)
+
+    def open(self):
+        """
+        :return: 从头读取附件内容的文件对象(文件路径时打开文件, 文件对象时回到初始位置)
+        """
+        if hasattr(self.source, 'read'):
+            if self._start is not None:
+                self.source.seek(self._start)
+            return self.source
+        return open(self.source, 'rb')
+
+    def read_base64(self, f) -> bytes:
+        """
+        :param f: open返回的文件对象
+        :return: 下一块内容编码后的带CRLF换行的base64, 读完时为空
+        """
+        chunk = f.read(self.chunk_size)
+        if not chunk:
+            return b""
+        return base64.encodebytes(chunk).replace(b'\n', b'\r\n')
+
+    def release(self, f):
+        """
+        关闭open打开的文件(调用方传入的文件对象由调用方关闭)
+        """
+        if f is not self.source:
+            f.close()
+
+
+def is_streamable(value) -> bool:
+    """
+    :param value: attachments/msgimgs中的值
+    :return: 是否需要流式发送(文件路径或文件对象)
+    """
+    return isinstance(value, (FileAttachment, os.PathLike)) or hasattr(value, 'read')
+
+
+class StreamingMessage(object):
+    """
+    流式邮件: 邮件头和普通内容先序列化(很小), 文件附件在写入SMTP DATA时才分块读取和编码,
+    因此发送时占用的内存与附件大小无关.
+    """
+
+    def __init__(self, message: MIMEMultipart, streams: Dict[bytes, FileAttachment]) -> None:
+        """
+        :param message: 邮件骨架, 文件附件的内容为占位符
+        :param streams: {占位符: 文件附件}
+        """
+        self.message = message
+        self.streams = streams
+        # 上一次发送写入DATA的字节数
+        self.size = 0
+        self.sender = getaddresses(message.get_all('From', []))[0][1]
+        self.recipients = [addr for _, addr in getaddresses(
+            message.get_all('To', []) + message.get_all('Cc', []))]
+
+    @property
+    def replayable(self) -> bool:
+        return all(stream.replayable for stream in self.streams.values())
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        """
+        :return: 完整邮件(CRLF换行, 未做"."转义)的字节块
+        """
+        for part in self._iter_parts():
+            if isinstance(part, FileAttachment):
+                yield from part.iter_base64()
+            else:
+                yield part
+
+    def _iter_parts(self) -> Iterator[Union[bytes, FileAttachment]]:
+        """
+        :return: 序列化后的邮件骨架片段(bytes)和其间的文件附件(FileAttachment)
+        """
+        buffer = io.BytesIO()
+        BytesGenerator(buffer, policy=email_policy.SMTP).flatten(self.message)
+        skeleton = buffer.getvalue()
+        if not self.streams:
+            yield skeleton
+            return
+        pattern = re.compile(b'|'.join(re.escape(token) for token in self.streams))
+        position = 0
+        for match in pattern.finditer(skeleton):
+            yield skeleton[position:match.start()]
+            yield self.streams[match.group(0)]
+            position = match.end()
+        yield skeleton[position:]
+
+    async def send(self, smtp: "aiosmtplib.SMTP"):
+        """
+        通过已连接的SMTP发送, 邮件内容分块写入DATA
+        :param smtp: 已连接(并登录)的SMTP对象
+        :return: DATA命令的响应
+        """
+        import aiosmtplib
+        if smtp.is_ehlo_or_helo_needed:
+            await smtp.ehlo()
+        try:
+            await smtp.mail(self.sender)
+            for recipient in self.recipients:
+                await smtp.rcpt(recipient)
+            start_response = await smtp.execute_command(b"DATA")
+            if start_response.code != aiosmtplib.SMTPStatus.start_input:
+                raise aiosmtplib.SMTPDataError(start_response.code, start_response.message)
+        except aiosmtplib.SMTPResponseException:
+            await smtp.rset()
+            raise
+        loop = asyncio.get_event_loop()
+        writer = _DataWriter(smtp, loop)
+        tail = b"\r\n"
+        self.size = 0
+
+        async def write(chunk: bytes):
+            nonlocal tail
+            if chunk:
+                # 行首的"."只会出现在块的开头或换行之后, 块都从行首开始
+                await writer.write(_PERIOD_REGEX.sub(b"..", chunk))
+                self.size += len(chunk)
+                tail = chunk[-2:]
+        for part in self._iter_parts():
+            if not isinstance(part, FileAttachment):
+                await write(part)
+                continue
+            # 读取文件和base64编码在线程池中执行, 不阻塞事件循环
+            f = await loop.run_in_executor(None, part.open)
+            try:
+                while True:
+                    chunk = await loop.run_in_executor(None, part.read_base64, f)
+                    if not chunk:
+                        break
+                    await write(chunk)
+            finally:
+                part.release(f)
+        await writer.write(b".\r\n" if tail == b"\r\n" else b"\r\n.\r\n")
+        response = await smtp.protocol.read_response(timeout=smtp.timeout)
+        if response.code != aiosmtplib.SMTPStatus.completed:
+            raise aiosmtplib.SMTPDataError(response.code, response.message)
+        return response
+
+
+class _DataWriter(object):
+    """
+    向DATA写入数据块并等待发送缓冲排空, 避免整封邮件堆积在发送缓冲中
+    """
+
+    def __init__(self, smtp: "aiosmtplib.SMTP", loop: asyncio.AbstractEventLoop) -> None:
+        self.smtp = smtp
+        protocol = smtp.protocol
+        self._writer = None
+        if hasattr(protocol, 'write_and_drain') is not True:
+            # aiosmtplib >= 1.1的协议没有公开的排空方法, 用StreamWriter.drain按协议的流量控制等待
+            self._writer = _PooledStreamWriter(protocol.transport, protocol, None, loop)
+
+    async def write(self, data: bytes):
+        if self._writer is None:
+            # aiosmtplib 1.0.x
+            await self.smtp.protocol.write_and_drain(data, timeout=self.smtp.timeout)
+            return
+        self.smtp.protocol.write(data)
+        await asyncio.wait_for(self._writer.drain(), self.smtp.timeout)
+
+
+class _PooledStreamWriter(asyncio.StreamWriter):
+    """
+    只用于等待排空的StreamWriter: 连接属于SMTP连接池, 回收时不关闭连接
+    """
+
+    def __del__(self):
+        pass
+
+
+def make_stream_part(name: str, kind: str = 'attachment') -> tuple:
+    """
+    创建文件附件的MIME骨架, 内容为占位符
+    :param name: 文件名
+    :param kind: attachment - 附件, image - 内嵌图片
+    :return: (MIME块, 占位符)
+    """
+    ctype, encoding = mimetypes.guess_type(name)
+    if ctype is None or encoding is not None:
+        ctype = 'application/octet-stream'
+    _maintype, _subtype = ctype.split('/', 1)
+    part = MIMENonMultipart(_maintype, _subtype)
+    part['Content-Transfer-Encoding'] = 'base64'
+    if kind == 'image':
+        part.add_header('Content-ID', '<{}>'.format(name.split(".")[0]))
+        part.add_header('Content-Disposition', 'inline')
+    else:
+        part.add_header('Content-Disposition', 'attachment', filename=name)
+    token = "VISION-STREAM-{}".format(uuid.uuid4().hex)
+    part.set_payload(token)
+    return part, token.encode('ascii')
+
+
+def split_streams(files: Optional[Dict[str, object]]) -> tuple:
+    """
+    把attachments/msgimgs分为内存中的内容和需要流式发送的文件
+    :return: (内存中的内容, 流式发送的文件)
+    """
+    in_memory, streams = {}, {}
+    for name, value in (files or {}).items():
+        if is_streamable(value):
+            streams[name] = value if isinstance(value, FileAttachment) else FileAttachment(value)
+        else:
+            in_memory[name] = value
+    return in_memory, streams
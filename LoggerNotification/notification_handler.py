@@ -0,0 +1,252 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: notification_handler
+把日志记录转发为钉钉/邮件报警的Handler
+"""
+# Python内置库
+import copy
+import logging
+import threading
+from typing import TYPE_CHECKING, List, Optional
+
+# 项目内部库(分发器依赖asyncio, 在第一次发送报警时才导入)
+from DataVision.LoggerNotification.suppression import fingerprint
+if TYPE_CHECKING:
+    from DataVision.LoggerNotification.dispatcher import NotificationDispatcher
+
+
+def _to_level(level) -> int:
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).upper())
+    if isinstance(value, int) is not True:
+        raise ValueError("日志级别不存在: {}".format(level))
+    return value
+
+
+class Route(object):
+    """
+    一条转发规则: 级别不低于level且logger名称匹配的记录发送到dingding和/或email
+    """
+
+    def __init__(self,
+                 level="ERROR",
+                 loggers: Optional[List[str]] = None,
+                 dingding: bool = False,
+                 email: Optional[List[str]] = None,
+                 at_mobiles: Optional[List[str]] = None,
+                 at_all: bool = False) -> None:
+        """
+        :param level: 最低级别
+        :param loggers: logger名称前缀列表, 为空时匹配所有logger
+        :param dingding: 是否发送钉钉
+        :param email: 邮件收件人列表
+        :param at_mobiles: 钉钉需要@的手机号
+        :param at_all: 钉钉是否@所有人
+        """
+        self.level = _to_level(level)
+        self.loggers = tuple(loggers or ())
+        self.dingding = dingding
+        self.email = list(email or [])
+        self.at_mobiles = list(at_mobiles or [])
+        self.at_all = at_all
+
+    def match(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.level:
+            return False
+        if not self.loggers:
+            return True
+        name = record.name
+        return any(name == prefix or name.startswith(prefix + ".") or prefix == "root"
+                   for prefix in self.loggers)
+
+
+def render_markdown(record: logging.LogRecord, title: str) -> dict:
+    """
+    :param record: 已经准备好(消息已格式化)的日志记录
+    :param title: 报警标题
+    :return: DingDingSender.send_message(msg_type="markdown")的参数, level用于合并积压报警时分节和限流排队
+    """
+    lines = [
+        "### [{}] {}".format(record.levelname, title),
+        "",
+        "> {}".format(record.getMessage().replace("\n", "\n> ")),
+        "",
+        "- logger: {}".format(record.name),
+        "- 位置: {}:{}".format(record.pathname, record.lineno),
+        "- 时间: {}".format(logging.Formatter().formatTime(record, '%Y-%m-%d %H:%M:%S')),
+    ]
+    if record.exc_text:
+        lines.extend(["", "```", record.exc_text, "```"])
+    context = getattr(record, 'vision_context', None)
+    if context:
+        lines.extend(["", "最近日志:", "```"] + context + ["```"])
+    return {"msg_type": "markdown",
+            "title": "[{}] {}".format(record.levelname, title),
+            "text": "\n".join(lines),
+            "level": record.levelname}
+
+
+class NotificationHandler(logging.Handler):
+    """
+    报警Handler, 可以在logger_config.yaml中配置:
+        emit只在调用方线程复制记录并提交给通知分发器(不会等待网络IO),
+        消息的渲染和发送都在分发器的事件循环线程中进行;
+        分发器线程自己产生的日志记录(如发送失败的日志)不会再次转发, 避免报警循环;
+        相同指纹(归一化的消息, logger, 级别)的报警由分发器抑制, 在抑制窗口内只发送第一条,
+        窗口结束时再发送一条"又出现了N次"的汇总(见NotificationDispatcher);
+        context大于0时, 从日志采集器(RingBufferHandler)中取出报警前最近的context条日志附在报警中.
+    """
+    # 报警内容中有日志的位置(文件和行号), 需要vision_logger查找调用位置
+    uses_caller = True
+
+    def __init__(self,
+                 routes: Optional[List[dict]] = None,
+                 title: str = "DataVision报警",
+                 config_path: str = "",
+                 dispatcher: Optional["NotificationDispatcher"] = None,
+                 level=logging.ERROR,
+                 suppress_window: float = 60,
+                 suppress_max_entries: int = 10000,
+                 context: int = 0,
+                 context_level=None,
+                 collector: Optional[str] = None) -> None:
+        """
+        :param routes: 转发规则列表, 每一项为Route的参数, 默认为ERROR及以上发送钉钉
+        :param title: 报警标题
+        :param config_path: 通知配置文件路径, 指定时使用独立的分发器, 否则使用进程内共用的分发器
+        :param dispatcher: 通知分发器
+        :param level: Handler的级别
+        :param suppress_window: 重复报警的抑制窗口(秒), 0表示不抑制;
+                                使用进程内共用的分发器时窗口长度由分发器决定, 这里只决定是否抑制
+        :param suppress_max_entries: 最多记录的报警指纹数(使用独立的分发器时)
+        :param context: 报警中附带的最近日志条数, 0为不附带
+        :param context_level: 附带的日志的最低级别, 默认为所有级别
+        :param collector: 采集器的Handler名称, 默认为最后创建的采集器
+        """
+        super().__init__(level=_to_level(level))
+        if routes is None:
+            routes = [{"level": "ERROR", "dingding": True}]
+        self.routes = [Route(**route) for route in routes]
+        self.title = title
+        self._own_dispatcher = dispatcher is None and config_path != ""
+        if self._own_dispatcher:
+            from DataVision.LoggerNotification.dispatcher import NotificationDispatcher
+            dispatcher = NotificationDispatcher(config_path=config_path, suppress_window=suppress_window,
+                                                suppress_max_entries=suppress_max_entries)
+        self._dispatcher = dispatcher
+        self._local = threading.local()
+        self.suppress_window = suppress_window
+        self.context = context
+        self.context_level = context_level
+        self.collector = collector
+
+    @property
+    def dispatcher(self) -> "NotificationDispatcher":
+        if self._dispatcher is None:
+            from DataVision.LoggerNotification.dispatcher import get_dispatcher
+            self._dispatcher = get_dispatcher()
+        return self._dispatcher
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        复制记录并固定消息内容, 参数和异常对象可能在调用方线程中被修改或释放
+        """
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def handle(self, record: logging.LogRecord):
+        # 分发器线程产生的记录在获取Handler的锁之前就丢弃:
+        # 关闭时logging.shutdown持有该锁等待分发器退出, 分发器线程再获取锁会死锁
+        if self._dispatcher is not None and threading.current_thread() is self._dispatcher.thread:
+            return False
+        return super().handle(record)
+
+    def emit(self, record: logging.LogRecord):
+        routes = [route for route in self.routes if route.match(record)]
+        if not routes:
+            return
+        dispatcher = self.dispatcher
+        if threading.current_thread() is dispatcher.thread or getattr(self._local, 'emitting', False):
+            return
+        self._local.emitting = True
+        try:
+            key = self._fingerprint(record) if self.suppress_window > 0 else None
+            context = self._context(record) if self.context > 0 else None
+            record = self.prepare(record)
+            if context:
+                record.vision_context = context
+            self._submit(record, routes, key)
+        except Exception:
+            self.handleError(record)
+        finally:
+            self._local.emitting = False
+
+    def _context(self, record: logging.LogRecord) -> List[str]:
+        """
+        在调用方线程中取出报警前的日志(之后的日志不会混入)
+        :return: 每条日志的文本
+        """
+        from DataVision.LoggerHandler.collector import get_collector
+        collector = get_collector(self.collector)
+        if collector is None:
+            return []
+        entries = collector.snapshot(level=self.context_level, limit=self.context + 1)
+        # 采集器排在本Handler之前时, 最后一条就是这条报警本身
+        if entries and entries[-1].created == record.created and entries[-1].levelno == record.levelno:
+            entries.pop()
+        return [entry.format() for entry in entries[-self.context:]]
+
+    @staticmethod
+    def _fingerprint(record: logging.LogRecord) -> tuple:
+        # 有参数时消息模板本身就是很好的指纹, 不需要格式化
+        message = record.msg if record.args and isinstance(record.msg, str) else record.getMessage()
+        return fingerprint(message, record.name, record.levelno)
+
+    def _submit(self, record: logging.LogRecord, routes: List[Route], key: Optional[tuple] = None):
+        dispatcher = self.dispatcher
+        for route in routes:
+            if route.dingding:
+                dispatcher.submit_deferred("dingding", self._dingding_builder(record, route), record.levelname, key=key)
+            if route.email:
+                dispatcher.submit_deferred("email", self._email_builder(record, route), record.levelname, key=key)
+
+    def _dingding_builder(self, record: logging.LogRecord, route: Route):
+        def build() -> dict:
+            kwargs = render_markdown(record, self.title)
+            kwargs.update(at_mobiles=route.at_mobiles, is_at_all=route.at_all,
+                          alert_key="{}:{}".format(record.name, record.levelname))
+            return kwargs
+        return build
+
+    def _email_builder(self, record: logging.LogRecord, route: Route):
+        def build() -> dict:
+            first_line = record.getMessage().split("\n", 1)[0][:80]
+            return {"target_list": route.email,
+                    "subject": "[{}][{}] {}".format(self.title, record.levelname, first_line),
+                    "content": self._email_content(record),
+                    "level": record.levelname}
+        return build
+
+    def _email_content(self, record: logging.LogRecord) -> str:
+        content = self.format(record)
+        context = getattr(record, 'vision_context', None)
+        if context:
+            content = "{}\n\n最近日志:\n{}".format(content, "\n".join(context))
+        return content
+
+    def close(self):
+        # 还没有到窗口结束时间的汇总由分发器在关闭时发出
+        try:
+            if self._own_dispatcher and self._dispatcher is not None:
+                self._dispatcher.shutdown(timeout=30)
+        finally:
+            super().close()
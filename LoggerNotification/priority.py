@@ -0,0 +1,275 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: priority
+按报警级别分道排队(级别高的先发送, 等待久的逐渐提升优先级)
+"""
+# Python内置库
+import time
+import heapq
+import itertools
+from typing import Callable, Iterator, Optional
+
+# 队列按级别分道, 下标越小优先级越高
+LANES = ("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG")
+# 没有级别的消息进入的队列
+DEFAULT_LANE = LANES.index("INFO")
+
+# 为最高优先级队列保留的配额比例
+RESERVED_SHARE = 0.2
+# 等待每超过该秒数, 优先级提升一级(避免低优先级消息被饿死)
+AGING_SECONDS = 30
+
+_LEVEL_NUMBERS = ((50, 0), (40, 1), (30, 2), (20, 3))
+
+
+def lane_of(level) -> int:
+    """
+    :param level: 级别名称或logging的级别数值, None表示没有级别
+    :return: 所在队列的下标
+    """
+    if level is None:
+        return DEFAULT_LANE
+    if isinstance(level, int):
+        for number, lane in _LEVEL_NUMBERS:
+            if level >= number:
+                return lane
+        return len(LANES) - 1
+    level = str(level).upper()
+    if level == "WARN":
+        level = "WARNING"
+    return LANES.index(level) if level in LANES else DEFAULT_LANE
+
+
+def reserved_count(capacity: int, share: float) -> int:
+    """
+    :return: capacity中为最高优先级保留的数量(share大于0时至少保留1个, 并且至少给其他队列留下1个)
+    """
+    if capacity <= 1 or share <= 0:
+        return 0
+    return min(capacity - 1, max(1, int(capacity * share)))
+
+
+class Waiter(object):
+    """
+    一个排队中的请求
+    """
+    __slots__ = ('lane', 'enqueued', 'sequence', 'future', 'queued')
+
+    def __init__(self, lane: int, enqueued: float, sequence: int, future=None) -> None:
+        self.lane = lane
+        self.enqueued = enqueued
+        self.sequence = sequence
+        self.future = future
+        # 是否还在WaiterQueue中
+        self.queued = False
+
+    def key(self, aging_seconds: float) -> tuple:
+        """
+        排序键, 越小越先发送(同一优先级按到达顺序):
+            当前的优先级为 lane - (now - enqueued) / aging_seconds, 其中now对所有等待者相同,
+            所以按 lane + enqueued / aging_seconds 排序的结果不随时间变化
+        """
+        lane = self.lane
+        if aging_seconds > 0:
+            lane += self.enqueued / aging_seconds
+        return lane, self.sequence
+
+
+class WaiterQueue(object):
+    """
+    按级别分道的等待队列:
+        每个级别一个按到达顺序排列的队列, 同一级别内的先后就是Waiter.key的先后;
+        队首为各级别队首中key最小的一个, 取队首是O(级别数), 不需要在每次唤醒时重新排序;
+        移出队列(取消)的等待者只做标记, 到达队首时再清理.
+    """
+
+    def __init__(self, aging_seconds: float) -> None:
+        """
+        :param aging_seconds: 等待多少秒提升一级优先级, 0表示不提升
+        """
+        self.aging_seconds = aging_seconds
+        self._lanes = [[] for _ in LANES]
+        # 每个级别第一个可能还在队列中的下标
+        self._heads = [0] * len(LANES)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, waiter: Waiter):
+        waiter.queued = True
+        self._lanes[waiter.lane].append(waiter)
+        self._size += 1
+
+    def discard(self, waiter: Waiter):
+        if waiter.queued:
+            waiter.queued = False
+            self._size -= 1
+
+    def _head(self, lane: int) -> Optional[Waiter]:
+        waiters, head = self._lanes[lane], self._heads[lane]
+        while head < len(waiters) and waiters[head].queued is not True:
+            head += 1
+        if head > 64 and head * 2 > len(waiters):
+            # 已经出队的部分超过一半时整体删除, 均摊O(1)
+            del waiters[:head]
+            head = 0
+        self._heads[lane] = head
+        return waiters[head] if head < len(waiters) else None
+
+    def first(self, lane: Optional[int] = None) -> Optional[Waiter]:
+        """
+        :param lane: 只看该级别的队列
+        :return: 排在最前面的等待者
+        """
+        if lane is not None:
+            return self._head(lane)
+        best, best_key = None, None
+        for index in range(len(self._lanes)):
+            waiter = self._head(index)
+            if waiter is not None:
+                key = waiter.key(self.aging_seconds)
+                if best is None or key < best_key:
+                    best, best_key = waiter, key
+        return best
+
+    def _lane_iter(self, lane: int) -> Iterator[Waiter]:
+        waiters = self._lanes[lane]
+        for index in range(self._heads[lane], len(waiters)):
+            if waiters[index].queued:
+                yield waiters[index]
+
+    def ahead(self, waiter: Waiter, capacity: int, top_capacity: int) -> int:
+        """
+        按顺序给排在waiter前面的等待者分配名额: 最高级别的等待者在已分配数小于top_capacity时占用一个,
+        其他级别在已分配数小于capacity(不超过top_capacity)时占用一个;
+        只扫描可能改变结果的等待者, 不超过top_capacity个
+        :return: 排在waiter前面且现在就能拿到名额的等待者数量
+        """
+        key = waiter.key(self.aging_seconds)
+        taken = top = 0
+        ordered = heapq.merge(*[self._lane_iter(lane) for lane in range(len(self._lanes))],
+                              key=lambda other: other.key(self.aging_seconds))
+        for other in ordered:
+            if other.key(self.aging_seconds) >= key:
+                return taken
+            if taken >= capacity:
+                break
+            taken += 1
+            if other.lane == 0:
+                top += 1
+        else:
+            return taken
+        # 其他级别已经用完名额, 之后只有最高级别的等待者还能占用
+        for other in itertools.islice(self._lane_iter(0), top, None):
+            if taken >= top_capacity or other.key(self.aging_seconds) >= key:
+                break
+            taken += 1
+        return taken
+
+
+class PrioritySemaphore(object):
+    """
+    按级别分道的asyncio信号量:
+        释放时把名额交给排序最靠前的等待者(级别高的优先, 等待aging_seconds秒提升一级);
+        reserved_share比例的名额只能由最高优先级(CRITICAL)使用, 其他级别即使提升了优先级也不能占用.
+    需要在同一个事件循环中使用.
+    """
+
+    def __init__(self,
+                 value: int,
+                 reserved_share: float = RESERVED_SHARE,
+                 aging_seconds: float = AGING_SECONDS,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        """
+        :param value: 名额数
+        :param reserved_share: 为最高优先级保留的名额比例
+        :param aging_seconds: 等待多少秒提升一级优先级, 0表示不提升
+        :param clock: 单调时钟
+        """
+        if value < 1:
+            raise ValueError("value必须大于0")
+        self.value = value
+        self.reserved = reserved_count(value, reserved_share)
+        self.aging_seconds = aging_seconds
+        self.clock = clock
+        self._in_use = 0
+        self._waiters = WaiterQueue(aging_seconds)
+        self._sequence = itertools.count()
+
+    def _can_take(self, lane: int) -> bool:
+        limit = self.value if lane == 0 else self.value - self.reserved
+        return self._in_use < limit
+
+    async def acquire(self, level=None) -> float:
+        """
+        :param level: 级别
+        :return: 等待的秒数
+        """
+        lane = lane_of(level)
+        if not self._waiters and self._can_take(lane):
+            self._in_use += 1
+            return 0.0
+        # 限流器(PriorityLimiter)也会导入本模块, 在curio中使用时不需要加载asyncio
+        import asyncio
+        waiter = Waiter(lane, self.clock(), next(self._sequence), asyncio.get_event_loop().create_future())
+        self._waiters.append(waiter)
+        # 排队中的低级别请求可能只是在等非保留的名额, 新到的高级别请求可以直接使用保留名额
+        self._wake()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 已经分到名额后被取消, 交给下一个等待者
+                self.release()
+            else:
+                self._waiters.discard(waiter)
+            raise
+        return self.clock() - waiter.enqueued
+
+    def release(self):
+        self._in_use -= 1
+        self._wake()
+
+    def _wake(self):
+        """
+        把空闲的名额依次交给队首的等待者, 每次O(级别数)
+        """
+        while self._waiters and self._in_use < self.value:
+            waiter = self._waiters.first()
+            if self._can_take(waiter.lane) is not True:
+                # 只剩下保留的名额, 交给最高级别队列的队首
+                waiter = self._waiters.first(0)
+                if waiter is None:
+                    return
+            self._waiters.discard(waiter)
+            if waiter.future.done():
+                # 已被取消
+                continue
+            self._in_use += 1
+            waiter.future.set_result(None)
+
+    def hold(self, level=None) -> "_Permit":
+        """
+        :return: async with使用的名额
+        """
+        return _Permit(self, level)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+
+class _Permit(object):
+
+    def __init__(self, semaphore: PrioritySemaphore, level) -> None:
+        self._semaphore = semaphore
+        self._level = level
+
+    async def __aenter__(self) -> Optional[float]:
+        return await self._semaphore.acquire(self._level)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
@@ -0,0 +1,259 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: rate_limiter
+异步限流器(钉钉机器人每分钟最多20条)
+"""
+# Python内置库
+import time
+import itertools
+import threading
+import collections
+from typing import Callable, Optional
+
+# 项目内部库
+from DataVision.LoggerNotification.priority import AGING_SECONDS, RESERVED_SHARE, Waiter, WaiterQueue, lane_of, \
+    reserved_count
+
+# 钉钉官方限制: 每个机器人每分钟最多发送20条
+DINGDING_LIMIT = 20
+DINGDING_PERIOD = 60
+
+# 收到"发送太快"(130101)后的冷却时间范围
+MIN_COOLDOWN = 15
+MAX_COOLDOWN = 300
+
+# 等待者醒来后重新检查的最短间隔(秒)
+_MIN_POLL = 0.001
+
+
+class _Reservation(object):
+    """
+    一次acquire预约的发送时间(冷却时整体顺延)
+    """
+    __slots__ = ('at',)
+
+    def __init__(self, at: float) -> None:
+        self.at = at
+
+
+class SlidingWindowLimiter(object):
+    """
+    滑动窗口限流器: 任意period秒内最多放行limit条消息.
+    每条消息在调用acquire时按到达顺序预约发送时间, 超出限制的消息通过await等待(不会阻塞事件循环),
+    因此排队的消息严格按照先后顺序发出.
+    收到服务端的限流错误时调用penalize进入冷却, 连续限流时冷却时间翻倍, 发送成功后调用reward恢复.
+    clock和sleep可以替换, 便于在不同的事件循环中使用以及用假时钟测试.
+    """
+
+    def __init__(self,
+                 limit: int = DINGDING_LIMIT,
+                 period: float = DINGDING_PERIOD,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Optional[Callable] = None) -> None:
+        """
+        :param limit: 窗口内最多放行的消息数
+        :param period: 窗口长度(秒)
+        :param clock: 单调时钟
+        :param sleep: 异步sleep函数, 如curio.sleep/asyncio.sleep
+        """
+        if limit < 1:
+            raise ValueError("limit必须大于0")
+        self.limit = limit
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        # 最近limit条消息预约的发送时间
+        self._slots = collections.deque(maxlen=limit)
+        self._blocked_until = 0.0
+        self._cooldown = MIN_COOLDOWN
+        # 还在等待的预约, 冷却时顺延(只保存等待中的预约, 不保存冷却的历史)
+        self._reservations = set()
+        # 同一个机器人可能被多个线程的事件循环共用
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """
+        调用方持有锁
+        :return: 预约的发送时间
+        """
+        at = max(self.clock(), self._blocked_until)
+        if len(self._slots) == self.limit:
+            at = max(at, self._slots[0] + self.period)
+        self._slots.append(at)
+        return at
+
+    def reserve(self) -> float:
+        """
+        预约一个发送时间(不等待)
+        :return: 需要等待的秒数
+        """
+        with self._lock:
+            at = self._reserve()
+        return at - self.clock()
+
+    async def acquire(self, sleep: Optional[Callable] = None, level=None) -> float:
+        """
+        等待直到可以发送
+        :param sleep: 异步sleep函数, 默认使用初始化时传入的sleep
+        :param level: 消息级别(按到达顺序放行, 不区分级别)
+        :return: 实际等待的秒数
+        """
+        sleep = sleep or self.sleep
+        start = self.clock()
+        with self._lock:
+            reservation = _Reservation(self._reserve())
+            self._reservations.add(reservation)
+        try:
+            while True:
+                # 等待期间可能收到了限流错误, 预约时间已经被penalize顺延
+                delay = reservation.at - self.clock()
+                if delay <= 0:
+                    break
+                await sleep(delay)
+        finally:
+            with self._lock:
+                self._reservations.discard(reservation)
+        return self.clock() - start
+
+    def penalize(self) -> float:
+        """
+        服务端返回发送太快时调用, 所有还未发出的消息整体顺延冷却时间
+        :return: 本次冷却的秒数
+        """
+        with self._lock:
+            cooldown = self._cooldown
+            now = self.clock()
+            self._blocked_until = max(self._blocked_until, now + cooldown)
+            # 整体顺延保持了排队消息之间的间隔, 窗口限制依然成立
+            for reservation in self._reservations:
+                if reservation.at > now:
+                    reservation.at += cooldown
+            self._slots = collections.deque(
+                (slot + cooldown if slot > now else slot for slot in self._slots), maxlen=self.limit)
+            self._cooldown = min(self._cooldown * 2, MAX_COOLDOWN)
+            return cooldown
+
+    def reward(self):
+        """
+        发送成功时调用, 恢复初始的冷却时间
+        """
+        self._cooldown = MIN_COOLDOWN
+
+    @property
+    def blocked_until(self) -> float:
+        return self._blocked_until
+
+
+class PriorityLimiter(SlidingWindowLimiter):
+    """
+    按级别分道的滑动窗口限流器, 窗口限制与SlidingWindowLimiter相同, 但不在到达时预约发送时间:
+        每次窗口内有名额时放行排序最靠前的等待者(级别高的优先, 等待aging_seconds秒提升一级, 同级按到达顺序),
+        因此CRITICAL报警不会排在已经积压的大量INFO报警之后;
+        窗口内reserved_share比例的名额只能由最高优先级(CRITICAL)使用, 其他级别即使提升了优先级也不能占用;
+        等待者用sleep等待(不依赖具体的事件循环), 醒来时按当前排位计算下一次可能轮到的时间.
+    penalize和reward与SlidingWindowLimiter相同.
+    """
+
+    def __init__(self,
+                 limit: int = DINGDING_LIMIT,
+                 period: float = DINGDING_PERIOD,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Optional[Callable] = None,
+                 reserved_share: float = RESERVED_SHARE,
+                 aging_seconds: float = AGING_SECONDS) -> None:
+        """
+        :param reserved_share: 为最高优先级保留的名额比例
+        :param aging_seconds: 等待多少秒提升一级优先级, 0表示不提升
+        其他参数同SlidingWindowLimiter
+        """
+        super().__init__(limit=limit, period=period, clock=clock, sleep=sleep)
+        self.reserved = reserved_count(limit, reserved_share)
+        self.aging_seconds = aging_seconds
+        self._waiters = WaiterQueue(aging_seconds)
+        self._sequence = itertools.count()
+
+    async def acquire(self, sleep: Optional[Callable] = None, level=None) -> float:
+        """
+        等待直到可以发送
+        :param sleep: 异步sleep函数, 默认使用初始化时传入的sleep
+        :param level: 消息级别(级别名称或logging的级别数值)
+        :return: 实际等待的秒数
+        """
+        sleep = sleep or self.sleep
+        with self._lock:
+            waiter = Waiter(lane_of(level), self.clock(), next(self._sequence))
+            delay = self._grant(waiter)
+            if delay is not None:
+                self._waiters.append(waiter)
+        try:
+            while delay is not None:
+                await sleep(delay)
+                with self._lock:
+                    delay = self._grant(waiter)
+        finally:
+            if delay is not None:
+                # 等待时被取消
+                with self._lock:
+                    self._waiters.discard(waiter)
+        return self.clock() - waiter.enqueued
+
+    def _capacity(self, lane: int, used: int) -> int:
+        return (self.limit if lane == 0 else self.limit - self.reserved) - used
+
+    def _grant(self, waiter: Waiter) -> Optional[float]:
+        """
+        :return: None - 放行(已计入窗口并移出队列); 数字 - 还需要等待的秒数
+        """
+        now = self.clock()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        # 滑出窗口的放行记录
+        while self._slots and self._slots[0] <= now - self.period:
+            self._slots.popleft()
+        used = len(self._slots)
+        # 排在前面且现在就能拿到名额的等待者数量(只扫描前面不超过limit个等待者)
+        taken = 0
+        if self._waiters:
+            taken = self._waiters.ahead(waiter, self._capacity(1, used), self._capacity(0, used))
+        position = taken - self._capacity(waiter.lane, used)
+        if position < 0:
+            self._slots.append(now)
+            self._waiters.discard(waiter)
+            return None
+        # 等到窗口内第position+1条放行记录滑出(之后的名额可能被新来的高级别消息占用, 醒来后重新计算)
+        if position < used:
+            at = self._slots[position] + self.period
+        elif used:
+            at = self._slots[-1] + self.period
+        else:
+            at = now + self.period / self.limit
+        return max(at - now, _MIN_POLL)
+
+    @property
+    def waiting(self) -> int:
+        with self._lock:
+            return len(self._waiters)
+
+
+# 进程内每个机器人共用一个限流器 {机器人地址: 限流器}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(key: str,
+                limit: int = DINGDING_LIMIT,
+                period: float = DINGDING_PERIOD) -> SlidingWindowLimiter:
+    """
+    :param key: 限流对象(机器人的地址或token)
+    :param limit: 窗口内最多放行的消息数
+    :param period: 窗口长度(秒)
+    :return: 该对象共用的限流器(按级别分道的PriorityLimiter)
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = PriorityLimiter(limit=limit, period=period)
+            _limiters[key] = limiter
+        return limiter
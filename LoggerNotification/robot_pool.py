@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: robot_pool
+多个钉钉机器人的分片发送
+"""
+# Python内置库
+import time
+import zlib
+import threading
+from typing import Callable, List, Optional
+
+# 项目内部库
+from DataVision.LoggerNotification.rate_limiter import SlidingWindowLimiter, get_limiter
+
+# 机器人选择策略
+STRATEGIES = ("round_robin", "least_recently_used", "hash")
+
+# 网关返回302时机器人被拉黑5分钟
+BLACKLIST_SECONDS = 300
+# 连续网络错误达到该次数后暂时摘除机器人
+MAX_FAILURES = 3
+FAILURE_SECONDS = 30
+
+
+class RobotHealth(object):
+    """
+    一个机器人地址的健康状态(连续网络错误次数和恢复时间), 进程内按地址共用(见get_health):
+    一个发送器中被拉黑或摘除的机器人, 其他发送器也不再使用
+    """
+
+    def __init__(self, clock: Callable[[], float]) -> None:
+        """
+        :param clock: 单调时钟
+        """
+        self.clock = clock
+        self.failures = 0
+        # 在该时间之前机器人不参与轮转
+        self.available_at = 0.0
+        self._lock = threading.Lock()
+
+    def is_healthy(self, now: Optional[float] = None) -> bool:
+        return (self.clock() if now is None else now) >= self.available_at
+
+    def unavailable_for(self) -> float:
+        """
+        :return: 距离恢复还需要的秒数
+        """
+        return max(0.0, self.available_at - self.clock())
+
+    def mark_success(self):
+        self.failures = 0
+
+    def mark_blacklisted(self, seconds: float = BLACKLIST_SECONDS):
+        """
+        被网关拉黑(302), 摘除到恢复为止
+        """
+        with self._lock:
+            self.available_at = max(self.available_at, self.clock() + seconds)
+
+    def mark_failure(self):
+        """
+        网络错误, 连续失败多次后暂时摘除
+        """
+        with self._lock:
+            self.failures += 1
+            if self.failures < MAX_FAILURES:
+                return
+            self.failures = 0
+            self.available_at = max(self.available_at, self.clock() + FAILURE_SECONDS)
+
+
+# 进程内每个机器人共用一份健康状态 {(机器人地址, 时钟): 健康状态}, 不同时钟(如测试的假时钟)的时间不能比较
+_healths = {}
+_healths_lock = threading.Lock()
+
+
+def get_health(url: str, clock: Callable[[], float] = time.monotonic) -> RobotHealth:
+    """
+    :param url: 机器人的完整请求地址
+    :param clock: 单调时钟
+    :return: 该机器人共用的健康状态
+    """
+    with _healths_lock:
+        health = _healths.get((url, clock))
+        if health is None:
+            health = _healths[(url, clock)] = RobotHealth(clock)
+        return health
+
+
+class Robot(object):
+    """
+    单个钉钉机器人: 与同一地址的其他Robot共用限流器和健康状态, 最后使用时间属于所在的机器人池
+    """
+
+    def __init__(self,
+                 url: str,
+                 limiter: SlidingWindowLimiter,
+                 clock: Callable[[], float],
+                 health: Optional[RobotHealth] = None) -> None:
+        """
+        :param url: 机器人的完整请求地址
+        :param limiter: 该机器人的限流器
+        :param clock: 单调时钟
+        :param health: 该机器人的健康状态, 默认使用进程内共用的
+        """
+        self.url = url
+        self.limiter = limiter
+        self.clock = clock
+        self.health = health if health is not None else get_health(url, clock)
+        self.last_used = 0.0
+
+    @property
+    def available_at(self) -> float:
+        return self.health.available_at
+
+    def is_healthy(self, now: Optional[float] = None) -> bool:
+        return self.health.is_healthy(now)
+
+    def unavailable_for(self) -> float:
+        """
+        :return: 距离恢复还需要的秒数
+        """
+        return self.health.unavailable_for()
+
+    def mark_used(self):
+        self.last_used = self.clock()
+
+    def mark_success(self):
+        self.health.mark_success()
+
+    def mark_blacklisted(self, seconds: float = BLACKLIST_SECONDS):
+        self.health.mark_blacklisted(seconds)
+
+    def mark_failure(self):
+        self.health.mark_failure()
+
+    def __repr__(self) -> str:
+        return "<Robot {} healthy={}>".format(self.url[-8:], self.is_healthy())
+
+
+class RobotPool(object):
+    """
+    机器人池, 按策略为每条消息选择机器人:
+        round_robin - 在健康的机器人之间轮流发送
+        least_recently_used - 选择最久没有使用的健康机器人
+        hash - 按报警key的哈希固定到同一个机器人, 保证相关报警的顺序,
+               该机器人不可用时顺延到下一个健康的机器人
+    所有机器人都不可用时返回最早恢复的机器人.
+    机器人的限流器和健康状态按地址在进程内共用(见get_limiter/get_health), 多个发送器使用同一个机器人时互相可见.
+    """
+
+    def __init__(self,
+                 robot_url: str,
+                 tokens: List[str],
+                 strategy: str = "round_robin",
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        """
+        :param robot_url: 机器人地址前缀
+        :param tokens: 机器人token列表
+        :param strategy: 选择策略
+        :param clock: 单调时钟
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError("机器人选择策略不存在: {}".format(strategy))
+        if not tokens:
+            raise ValueError("至少需要一个机器人token")
+        self.strategy = strategy
+        self.clock = clock
+        self.robots = [Robot(robot_url + token, get_limiter(robot_url + token), clock) for token in tokens]
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.robots)
+
+    def choose(self, alert_key: Optional[str] = None) -> Robot:
+        """
+        :param alert_key: 报警的key(hash策略使用, 为空时按round_robin处理)
+        :return: 本条消息使用的机器人
+        """
+        with self._lock:
+            now = self.clock()
+            count = len(self.robots)
+            if self.strategy == "hash" and alert_key is not None:
+                start = zlib.crc32(str(alert_key).encode('utf-8')) % count
+                robot = self._first_healthy(start, now)
+            elif self.strategy == "least_recently_used":
+                healthy = [r for r in self.robots if r.is_healthy(now)]
+                robot = min(healthy, key=lambda r: r.last_used) if healthy else None
+            else:
+                robot = self._first_healthy(self._next, now)
+                if robot is not None:
+                    self._next = (self.robots.index(robot) + 1) % count
+            if robot is None:
+                robot = min(self.robots, key=lambda r: r.available_at)
+            robot.mark_used()
+            return robot
+
+    def _first_healthy(self, start: int, now: float) -> Optional[Robot]:
+        count = len(self.robots)
+        for offset in range(count):
+            robot = self.robots[(start + offset) % count]
+            if robot.is_healthy(now):
+                return robot
+        return None
+
+    def healthy_count(self) -> int:
+        now = self.clock()
+        return sum(1 for robot in self.robots if robot.is_healthy(now))
@@ -0,0 +1,187 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: sinks
+报警的兜底存储: 本地文件和Redis(钉钉和邮件都无法发送时使用)
+"""
+# Python内置库
+import os
+import json
+import asyncio
+import datetime
+import threading
+from typing import Optional
+
+
+def make_record(channel: str, kwargs: dict) -> str:
+    """
+    :param channel: 原来的通知渠道
+    :param kwargs: 原来的发送参数
+    :return: 一行JSON
+    """
+    return json.dumps({"time": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                       "channel": channel,
+                       "message": kwargs}, ensure_ascii=False, default=str)
+
+
+class FileSink(object):
+    """
+    把报警按行(JSON)追加写入本地文件, 可以在多个线程和事件循环中使用
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: 文件路径
+        """
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    async def send(self, channel: str, kwargs: dict) -> bool:
+        line = make_record(channel, kwargs) + "\n"
+        # 文件IO(以及等待其他线程的写入)在默认线程池中进行, 不阻塞事件循环
+        await asyncio.get_event_loop().run_in_executor(None, self._write, line)
+        return True
+
+    def _write(self, line: str):
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    async def close(self):
+        pass
+
+
+class RedisError(Exception):
+    """
+    Redis返回的错误应答
+    """
+
+
+class RedisSink(object):
+    """
+    把报警LPUSH到Redis的列表中(只实现了需要的几个RESP命令, 不依赖redis客户端库):
+        连接在多次写入之间复用, 断开后下一次写入时重新连接;
+        写入后用LTRIM保留最新的max_length条, 与LPUSH在同一次网络往返中发送.
+    需要在同一个事件循环中使用.
+    """
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 6379,
+                 key: str = "DataVision:alerts",
+                 password: Optional[str] = None,
+                 db: int = 0,
+                 max_length: int = 10000,
+                 timeout: float = 5) -> None:
+        """
+        :param host: Redis地址
+        :param port: Redis端口
+        :param key: 列表的key
+        :param password: 密码
+        :param db: 数据库编号
+        :param max_length: 列表保留的最大条数, 0表示不限制
+        :param timeout: 连接和读写的超时秒数
+        """
+        self.host = host
+        self.port = int(port)
+        self.key = key
+        self.password = password
+        self.db = int(db)
+        self.max_length = max_length
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._lock = None
+
+    async def send(self, channel: str, kwargs: dict) -> int:
+        """
+        :return: 写入后列表的长度
+        """
+        commands = [("LPUSH", self.key, make_record(channel, kwargs))]
+        if self.max_length:
+            commands.append(("LTRIM", self.key, 0, self.max_length - 1))
+        return (await self.execute(*commands))[0]
+
+    async def execute(self, *commands: tuple) -> list:
+        """
+        在一次网络往返中执行多个命令
+        :param commands: 命令及参数
+        :return: 每个命令的应答
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            try:
+                return await asyncio.wait_for(self._execute(commands), self.timeout)
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.CancelledError):
+                # 应答没有读完, 连接不能再用
+                await self.close()
+                raise
+
+    async def _execute(self, commands: tuple) -> list:
+        if self._writer is None:
+            await self._connect()
+        self._writer.write(b"".join(self.encode(*command) for command in commands))
+        await self._writer.drain()
+        replies = [await self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            try:
+                await self._execute(tuple(setup))
+            except RedisError:
+                await self.close()
+                raise
+
+    @staticmethod
+    def encode(*args) -> bytes:
+        """
+        :return: RESP格式的命令
+        """
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise EOFError("Redis连接已断开")
+        prefix, value = line[:1], line[1:-2]
+        if prefix == b"+":
+            return value.decode('utf-8')
+        if prefix == b"-":
+            return RedisError(value.decode('utf-8'))
+        if prefix == b":":
+            return int(value)
+        if prefix == b"$":
+            length = int(value)
+            if length < 0:
+                return None
+            return (await self._reader.readexactly(length + 2))[:-2]
+        if prefix == b"*":
+            length = int(value)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RedisError("无法解析的Redis应答: {!r}".format(line))
+
+    async def close(self):
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
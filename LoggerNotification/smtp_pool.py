@@ -0,0 +1,224 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: smtp_pool
+异步SMTP连接池
+"""
+# Python内置库
+import time
+import asyncio
+import collections
+from typing import TYPE_CHECKING
+from email.message import Message
+
+# Python第三方库(aiosmtplib在第一次建立连接时才导入)
+if TYPE_CHECKING:
+    import aiosmtplib
+
+
+class SMTPConnectionPool(object):
+    """
+    SMTP长连接池, 连接在第一次使用时才建立(TLS握手和登录只做一次),
+    空闲超过idle_check秒的连接在复用前用NOOP检查, 断开的连接自动重连,
+    同时在用的连接数由信号量限制为pool_size.
+    """
+
+    def __init__(self,
+                 hostname: str,
+                 port,
+                 username: str = None,
+                 password: str = None,
+                 use_tls: bool = True,
+                 pool_size: int = 4,
+                 idle_check: float = 30,
+                 timeout: float = 60) -> None:
+        """
+        :param hostname: 邮件服务器地址
+        :param port: 邮件服务器端口
+        :param username: 登录用户名, 为空时不登录
+        :param password: 登录密码
+        :param use_tls: 是否使用TLS连接
+        :param pool_size: 最大连接数
+        :param idle_check: 连接空闲超过该秒数后, 复用前先发送NOOP检查
+        :param timeout: 单个SMTP命令的超时时间
+        """
+        if pool_size < 1:
+            raise ValueError("连接池大小必须大于0")
+        self.hostname = hostname
+        self.port = int(port) if port else None
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.pool_size = pool_size
+        self.idle_check = idle_check
+        self.timeout = timeout
+
+        # 空闲连接 (连接, 最后使用时间)
+        self._idle = collections.deque()
+        # 信号量需要在事件循环中创建
+        self._semaphore = None
+        self._closed = False
+
+    @property
+    def idle_size(self) -> int:
+        """
+        :return: 当前空闲的连接数
+        """
+        return len(self._idle)
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.pool_size)
+        return self._semaphore
+
+    async def _connect(self) -> "aiosmtplib.SMTP":
+        import aiosmtplib
+        # 连接建立在当前运行的事件循环中
+        smtp = aiosmtplib.SMTP(
+            hostname=self.hostname,
+            port=self.port,
+            use_tls=self.use_tls,
+            timeout=self.timeout
+        )
+        await smtp.connect()
+        try:
+            if self.username and self.password:
+                await smtp.login(self.username, self.password)
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+    async def _is_alive(self, smtp: "aiosmtplib.SMTP", last_used: float) -> bool:
+        if smtp.is_connected is not True:
+            return False
+        if time.monotonic() - last_used < self.idle_check:
+            return True
+        import aiosmtplib
+        try:
+            await smtp.noop()
+            return True
+        except (aiosmtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _discard(smtp: "aiosmtplib.SMTP"):
+        try:
+            smtp.close()
+        except Exception:
+            pass
+
+    async def acquire(self) -> "aiosmtplib.SMTP":
+        """
+        获取一个可用的连接, 使用完后必须调用release归还
+        :return: 已连接(并登录)的SMTP对象
+        """
+        if self._closed:
+            raise RuntimeError("SMTP连接池已关闭")
+        semaphore = self._get_semaphore()
+        await semaphore.acquire()
+        try:
+            while self._idle:
+                # 后进先出, 优先复用最近使用过的连接
+                smtp, last_used = self._idle.pop()
+                if await self._is_alive(smtp, last_used):
+                    return smtp
+                self._discard(smtp)
+            return await self._connect()
+        except BaseException:
+            semaphore.release()
+            raise
+
+    def release(self, smtp: "aiosmtplib.SMTP", discard: bool = False):
+        """
+        归还连接
+        :param smtp: acquire得到的连接
+        :param discard: 是否直接关闭该连接(连接状态未知时使用)
+        """
+        try:
+            if discard or self._closed or smtp.is_connected is not True:
+                self._discard(smtp)
+            else:
+                self._idle.append((smtp, time.monotonic()))
+        finally:
+            self._get_semaphore().release()
+
+    def connection(self) -> "PooledConnection":
+        """
+        async with pool.connection() as smtp: ...
+        """
+        return PooledConnection(self)
+
+    async def send_message(self, message, retries: int = 1):
+        """
+        使用池中的连接发送邮件, 连接被服务器断开时重连后重发
+        :param message: 邮件对象, 或者带有send(smtp)协程的流式邮件(StreamingMessage)
+        :param retries: 连接断开后的重试次数(无法重新读取的流式邮件不重试)
+        :return: aiosmtplib的发送结果
+        """
+        import aiosmtplib
+        attempt = 0
+        if getattr(message, 'replayable', True) is not True:
+            retries = 0
+        while True:
+            smtp = await self.acquire()
+            try:
+                if isinstance(message, Message):
+                    result = await smtp.send_message(message)
+                else:
+                    result = await message.send(smtp)
+            except aiosmtplib.SMTPServerDisconnected:
+                self.release(smtp, discard=True)
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                continue
+            except (aiosmtplib.SMTPResponseException, aiosmtplib.SMTPRecipientsRefused):
+                # 服务器正常应答的错误(如收件人被拒, aiosmtplib已经发送RSET), 连接仍然可用
+                self.release(smtp)
+                raise
+            except BaseException:
+                self.release(smtp, discard=True)
+                raise
+            self.release(smtp)
+            return result
+
+    async def close(self):
+        """
+        关闭连接池中的所有空闲连接, 使用中的连接在归还时关闭
+        """
+        self._closed = True
+        if not self._idle:
+            return
+        import aiosmtplib
+        while self._idle:
+            smtp, _ = self._idle.pop()
+            try:
+                await smtp.quit()
+            except (aiosmtplib.SMTPException, OSError):
+                self._discard(smtp)
+
+    async def __aenter__(self) -> "SMTPConnectionPool":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+class PooledConnection(object):
+    """
+    连接池连接的异步上下文管理器, 发生异常时连接会被丢弃
+    """
+
+    def __init__(self, pool: SMTPConnectionPool) -> None:
+        self._pool = pool
+        self._smtp = None
+
+    async def __aenter__(self) -> "aiosmtplib.SMTP":
+        self._smtp = await self._pool.acquire()
+        return self._smtp
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._pool.release(self._smtp, discard=exc_type is not None)
+        self._smtp = None
@@ -0,0 +1,319 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: spool
+未发送通知的本地持久化(追加写的分段日志)
+"""
+# Python内置库
+import os
+import json
+import time
+import uuid
+import zlib
+import struct
+import threading
+import collections
+from typing import List, Optional
+
+# 单个分段文件的最大字节数
+SEGMENT_BYTES = 4 * 1024 * 1024
+# 两次fsync之间的最长间隔(秒)
+FSYNC_INTERVAL = 0.2
+# 未fsync的记录达到该数量时立即fsync
+FSYNC_BATCH = 128
+
+# 记录头: 长度 + CRC32
+_HEADER = struct.Struct('>II')
+_SEGMENT_PREFIX = "spool-"
+_SEGMENT_SUFFIX = ".log"
+# 放弃发送的通知(JSON行), 不参与恢复
+DEAD_LETTER_FILE = "dead_letter.jsonl"
+
+# 未确认的通知 (id, 渠道, 参数)
+SpoolEntry = collections.namedtuple('SpoolEntry', ['id', 'channel', 'kwargs'])
+
+
+class Spool(object):
+    """
+    通知的预写日志:
+        enqueue把通知追加写入当前分段并立即返回, fsync由后台线程按批进行
+        (每FSYNC_INTERVAL秒或每FSYNC_BATCH条一次), 因此入队不需要等待磁盘;
+        发送成功后ack追加一条确认记录, 最旧的分段中的通知全部确认后整个分段文件被删除
+        (分段只从最旧的开始删除, 否则较新分段中对更旧分段的确认记录会丢失);
+        当前分段超过segment_bytes后切换到新的分段, compact把旧分段中剩余的通知搬到当前分段;
+        无法发送的通知通过dead_letter写入死信文件后确认;
+        打开时按顺序读取所有分段, 恢复未确认的通知(进程崩溃时最后一条不完整的记录通过长度和CRC识别并丢弃).
+    """
+
+    def __init__(self,
+                 directory: str,
+                 segment_bytes: int = SEGMENT_BYTES,
+                 fsync_interval: float = FSYNC_INTERVAL,
+                 fsync_batch: int = FSYNC_BATCH) -> None:
+        """
+        :param directory: 分段文件所在目录
+        :param segment_bytes: 单个分段文件的最大字节数
+        :param fsync_interval: 两次fsync之间的最长间隔(秒)
+        :param fsync_batch: 未fsync的记录达到该数量时立即fsync
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        os.makedirs(directory, exist_ok=True)
+
+        # {id: SpoolEntry}
+        self._live = collections.OrderedDict()
+        # {id: 分段序号}
+        self._location = {}
+        # {分段序号: 未确认的id集合}
+        self._segments = collections.OrderedDict()
+        self._file = None
+        self._sequence = 0
+        self._size = 0
+        self._unsynced = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+        self._recover()
+        self._rotate()
+        self._flusher = threading.Thread(target=self._flush_loop, name="VisionSpoolFlusher", daemon=True)
+        self._flusher.start()
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def _path(self, sequence: int) -> str:
+        return os.path.join(self.directory, "{}{:08d}{}".format(_SEGMENT_PREFIX, sequence, _SEGMENT_SUFFIX))
+
+    def _segment_numbers(self) -> List[int]:
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith(_SEGMENT_PREFIX) and name.endswith(_SEGMENT_SUFFIX):
+                try:
+                    numbers.append(int(name[len(_SEGMENT_PREFIX):-len(_SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(numbers)
+
+    def _recover(self):
+        for sequence in self._segment_numbers():
+            self._sequence = sequence
+            self._segments[sequence] = set()
+            for record in self._read_segment(self._path(sequence)):
+                op = record.get("op")
+                if op == "put":
+                    entry = SpoolEntry(record["id"], record["channel"], record["kwargs"])
+                    self._live[entry.id] = entry
+                    self._location[entry.id] = sequence
+                    self._segments[sequence].add(entry.id)
+                elif op == "ack":
+                    self._forget(record["id"])
+        # 已经全部确认的分段直接删除
+        self._trim(include_current=True)
+
+    @staticmethod
+    def _read_segment(path: str):
+        with open(path, 'rb') as f:
+            data = f.read()
+        position = 0
+        while position + _HEADER.size <= len(data):
+            length, crc = _HEADER.unpack_from(data, position)
+            start = position + _HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                # 崩溃时写了一半的记录
+                break
+            try:
+                yield json.loads(payload.decode('utf-8'))
+            except ValueError:
+                break
+            position = start + length
+
+    def _forget(self, entry_id: str) -> Optional[int]:
+        self._live.pop(entry_id, None)
+        sequence = self._location.pop(entry_id, None)
+        if sequence is not None:
+            self._segments[sequence].discard(entry_id)
+        return sequence
+
+    def _trim(self, include_current: bool = False):
+        """
+        从最旧的分段开始删除已经全部确认的分段
+        """
+        for sequence in list(self._segments):
+            if self._segments[sequence] or (sequence == self._sequence and include_current is not True):
+                break
+            self._remove_segment(sequence)
+
+    def _remove_segment(self, sequence: int):
+        self._segments.pop(sequence, None)
+        try:
+            os.remove(self._path(sequence))
+        except OSError:
+            pass
+
+    def _rotate(self):
+        if self._file is not None:
+            self._sync_locked()
+            self._file.close()
+        self._sequence += 1
+        self._segments[self._sequence] = set()
+        self._file = open(self._path(self._sequence), 'ab')
+        self._size = 0
+        self._sync_directory()
+        self._trim()
+
+    def _sync_directory(self):
+        # 新建的文件需要fsync目录才能保证崩溃后文件存在(Windows不支持)
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except (OSError, AttributeError):
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _encode(record: dict) -> bytes:
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return _HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    def _append(self, data: bytes):
+        self._file.write(data)
+        self._size += len(data)
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_batch:
+            self._condition.notify()
+
+    def enqueue(self, channel: str, kwargs: dict) -> str:
+        """
+        :param channel: 渠道
+        :param kwargs: 发送参数(需要可以序列化为JSON)
+        :return: 通知的id
+        """
+        entry = SpoolEntry(uuid.uuid4().hex, channel, kwargs)
+        # 序列化在锁外进行, 不能序列化时直接抛出TypeError
+        data = self._encode({"op": "put", "id": entry.id, "channel": channel, "kwargs": kwargs})
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("spool已关闭")
+            if self._size >= self.segment_bytes:
+                self._rotate()
+            self._append(data)
+            self._live[entry.id] = entry
+            self._location[entry.id] = self._sequence
+            self._segments[self._sequence].add(entry.id)
+        return entry.id
+
+    def ack(self, entry_id: str):
+        """
+        确认通知已发送
+        :param entry_id: enqueue返回的id
+        """
+        with self._lock:
+            if self._closed or entry_id not in self._live:
+                return
+            self._append(self._encode({"op": "ack", "id": entry_id}))
+            self._forget(entry_id)
+            self._trim()
+
+    def dead_letter(self, entry_id: str, reason: str):
+        """
+        放弃发送一条通知: 追加写入死信文件(dead_letter.jsonl)后确认, 不再重新发送
+        :param entry_id: enqueue返回的id
+        :param reason: 放弃的原因
+        """
+        with self._lock:
+            entry = self._live.get(entry_id)
+            if self._closed or entry is None:
+                return
+            line = json.dumps({"id": entry.id, "channel": entry.channel, "kwargs": entry.kwargs, "reason": reason,
+                               "time": time.time()}, ensure_ascii=False)
+            with open(os.path.join(self.directory, DEAD_LETTER_FILE), 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+            self._append(self._encode({"op": "ack", "id": entry_id}))
+            self._forget(entry_id)
+            self._trim()
+
+    def get(self, entry_id: str) -> Optional[SpoolEntry]:
+        """
+        :return: 未确认的通知, 已确认时返回None
+        """
+        with self._lock:
+            return self._live.get(entry_id)
+
+    def pending(self) -> List[SpoolEntry]:
+        """
+        :return: 所有未确认的通知(按入队顺序)
+        """
+        with self._lock:
+            return list(self._live.values())
+
+    def compact(self):
+        """
+        把旧分段中剩余的未确认通知重新写入当前分段, 然后删除旧分段
+        """
+        with self._lock:
+            old = [sequence for sequence in self._segments if sequence != self._sequence]
+            if not old:
+                return
+            for sequence in old:
+                for entry_id in list(self._segments[sequence]):
+                    entry = self._live[entry_id]
+                    self._append(self._encode(
+                        {"op": "put", "id": entry.id, "channel": entry.channel, "kwargs": entry.kwargs}))
+                    self._location[entry_id] = self._sequence
+                    self._segments[self._sequence].add(entry_id)
+                self._segments[sequence].clear()
+            # 先保证新写入的记录落盘, 再删除旧分段
+            self._sync_locked()
+            self._trim()
+
+    def _sync_locked(self):
+        if self._file is not None and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def sync(self):
+        """
+        立即把已写入的记录落盘
+        """
+        with self._lock:
+            self._sync_locked()
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                self._condition.wait(self.fsync_interval)
+                if self._closed or self._unsynced == 0:
+                    continue
+                # 持有锁时只把缓冲写入内核, fsync在锁外进行, 入队不会等待磁盘
+                self._file.flush()
+                fd = os.dup(self._file.fileno())
+                self._unsynced = 0
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._sync_locked()
+            self._file.close()
+            # 所有通知都已确认时不留下分段文件
+            if not self._live:
+                self._trim(include_current=True)
+            self._condition.notify()
+        self._flusher.join()
@@ -0,0 +1,192 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: suppression
+重复报警抑制(同一报警在时间窗口内只发送第一条, 窗口结束时发送汇总)
+"""
+# Python内置库
+import re
+import time
+import threading
+import collections
+from typing import Callable, Hashable, List, Optional
+
+# 消息中会变化的部分: UUID、十六进制地址、数字
+_NORMALIZE_REGEX = re.compile(
+    r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'
+    r'|0x[0-9a-fA-F]+'
+    r'|\d+(?:\.\d+)?')
+
+# 参与指纹计算的最大消息长度
+MAX_FINGERPRINT_LENGTH = 512
+
+# 汇总 (指纹, 窗口内被抑制的次数, 第一条报警)
+Summary = collections.namedtuple('Summary', ['key', 'count', 'sample'])
+# 待取走的汇总过多时合并使用的指纹(没有报警样例)
+OTHER_KEY = ("其他报警",)
+
+
+def normalize(message: str) -> str:
+    """
+    :param message: 报警消息
+    :return: 去掉UUID/地址/数字后的消息, 相同原因的报警得到相同的结果
+    """
+    return _NORMALIZE_REGEX.sub('#', message[:MAX_FINGERPRINT_LENGTH])
+
+
+def fingerprint(message: str, logger_name: str, level) -> tuple:
+    """
+    :return: 报警指纹 (级别, logger名称, 归一化的消息)
+    """
+    return level, logger_name, normalize(message)
+
+
+class _Entry(object):
+    __slots__ = ('deadline', 'count', 'sample')
+
+    def __init__(self, deadline: float, sample) -> None:
+        self.deadline = deadline
+        self.count = 0
+        self.sample = sample
+
+
+class AlertSuppressor(object):
+    """
+    重复报警抑制器:
+        每个指纹的第一条报警立即放行, 之后window秒内的相同报警只计数;
+        窗口结束时如果有被抑制的报警, 生成一条汇总并开始下一个窗口, 否则删除该指纹;
+        指纹保存在有上限的LRU(OrderedDict)中, 被淘汰的指纹如果有未汇总的计数会立即生成汇总;
+        所有窗口长度相同, 到期时间按创建顺序递增, 因此到期检查只需要从队列头部弹出;
+        被淘汰的指纹留在到期队列中的条目超过max_entries后整体清理一次, 队列不超过2 * max_entries条;
+        等待取走的汇总按指纹合并, 超过max_entries个指纹后合并为一条OTHER_KEY汇总(没有样例).
+    内存占用只与max_entries有关, offer和expire都是O(1)(均摊), 可以在多个线程中调用.
+    """
+
+    def __init__(self,
+                 window: float = 60,
+                 max_entries: int = 10000,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        """
+        :param window: 抑制窗口(秒)
+        :param max_entries: 最多记录的指纹数
+        :param clock: 单调时钟
+        """
+        if max_entries < 1:
+            raise ValueError("max_entries必须大于0")
+        self.window = window
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+        # (到期时间, 指纹, 条目)
+        self._deadlines = collections.deque()
+        # 淘汰或到期后等待取走的汇总 {指纹: Summary}
+        self._summaries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def offer(self, key: Hashable) -> Optional[float]:
+        """
+        :param key: 报警指纹
+        :return: None - 放行该报警(之后可以用set_sample记录该报警, 用于生成汇总);
+                 数字 - 该报警被抑制, 值为距离窗口结束的秒数
+        """
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.count += 1
+                return max(0.0, entry.deadline - now)
+            entry = _Entry(now + self.window, None)
+            self._entries[key] = entry
+            self._add_deadline(key, entry)
+            if len(self._entries) > self.max_entries:
+                old_key, old_entry = self._entries.popitem(last=False)
+                if old_entry.count:
+                    self._add_summary(old_key, old_entry.count, old_entry.sample)
+            return None
+
+    def _add_deadline(self, key: Hashable, entry: _Entry):
+        """
+        加入到期队列, 被淘汰的指纹的条目过多时清理(调用方持有锁)
+        """
+        deadlines = self._deadlines
+        deadlines.append((entry.deadline, key, entry))
+        if len(deadlines) > 2 * self.max_entries:
+            entries = self._entries
+            # 顺序不变, 每个指纹只剩下当前窗口的一条
+            self._deadlines = collections.deque(
+                item for item in deadlines if entries.get(item[1]) is item[2] and item[2].deadline == item[0])
+
+    def _add_summary(self, key: Hashable, count: int, sample):
+        """
+        加入待取走的汇总, 同一指纹合并计数(调用方持有锁)
+        """
+        summaries = self._summaries
+        pending = summaries.get(key)
+        if pending is None and len(summaries) >= self.max_entries:
+            key, sample = OTHER_KEY, None
+            pending = summaries.get(key)
+        if pending is not None:
+            count += pending.count
+            sample = pending.sample if pending.sample is not None else sample
+        summaries[key] = Summary(key, count, sample)
+
+    def set_sample(self, key: Hashable, sample):
+        """
+        :param key: 报警指纹
+        :param sample: 放行的报警, 窗口结束时随汇总一起返回
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.sample = sample
+
+    def next_deadline(self) -> Optional[float]:
+        """
+        :return: 最早结束的窗口的时间
+        """
+        with self._lock:
+            return self._deadlines[0][0] if self._deadlines else None
+
+    def expire(self) -> List[Summary]:
+        """
+        :return: 已经结束的窗口的汇总(包括被淘汰的指纹)
+        """
+        with self._lock:
+            self._expire(self.clock())
+            summaries = list(self._summaries.values())
+            self._summaries.clear()
+            return summaries
+
+    def drain(self) -> List[Summary]:
+        """
+        :return: 所有还有未汇总计数的指纹的汇总(关闭时调用, 不等待窗口结束)
+        """
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry.count:
+                    self._add_summary(key, entry.count, entry.sample)
+            summaries = list(self._summaries.values())
+            self._summaries.clear()
+            self._entries.clear()
+            self._deadlines.clear()
+            return summaries
+
+    def _expire(self, now: float):
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, key, entry = self._deadlines.popleft()
+            if self._entries.get(key) is not entry or entry.deadline != deadline:
+                # 已被淘汰或已经开始了新的窗口
+                continue
+            if entry.count:
+                self._add_summary(key, entry.count, entry.sample)
+                entry.count = 0
+                entry.deadline = now + self.window
+                self._add_deadline(key, entry)
+            else:
+                del self._entries[key]
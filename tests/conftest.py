@@ -0,0 +1,54 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: conftest
+测试公共配置: 仓库目录就是DataVision包, 检出目录不叫DataVision时也按DataVision导入;
+以及测试共用的假时钟
+"""
+# Python内置库
+import os
+import sys
+import types
+
+# Python第三方库
+import pytest
+
+# 仓库根目录
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if os.path.basename(ROOT) == "DataVision":
+    sys.path.insert(0, os.path.dirname(ROOT))
+elif "DataVision" not in sys.modules:
+    _package = types.ModuleType("DataVision")
+    _package.__path__ = [ROOT]
+    sys.modules["DataVision"] = _package
+
+
+class FakeClock(object):
+    """
+    假时钟: 由测试推进时间; sleep只交出控制权并告诉测试要等待的秒数
+    """
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, delay: float):
+        return _Sleep(delay)
+
+
+class _Sleep(object):
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+
+    def __await__(self):
+        yield self.delay
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_aggregator
+多进程日志汇总的正确性: 多个工作进程通过汇总进程写同一个按大小切分(并压缩)的文件,
+读回当前文件和所有切分出的文件, 每个进程的记录不能丢失、重复、乱序或者行内交错
+"""
+# Python内置库
+import os
+import re
+import gzip
+import json
+import logging
+import multiprocessing
+
+# 项目内部库
+from DataVision.LoggerHandler.aggregator import start_aggregator
+
+PRODUCERS = 4
+RECORDS = 3000
+# 每个进程写入约0.5MB, 切分十几次
+MAX_BYTES = 128 * 1024
+PAYLOAD = "x" * 100
+
+_LINE = re.compile(r"^\S+ \S+ - Mode:INFO - Message:producer (\d+) record (\d+) (x*)$")
+_SEGMENT = re.compile(r"^vision_log\.log\.(\S+?)(?:\.(\d+))?(?:\.gz)?$")
+
+
+def _write_config(directory: str) -> str:
+    config = {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {"fast": {"class": "DataVision.LoggerHandler.formatters.FastFormatter",
+                                "format": "%(asctime)s - Mode:%(levelname)s - Message:%(message)s",
+                                "datefmt": "%F %T"}},
+        "handlers": {"info_file_handler": {
+            "class": "DataVision.LoggerHandler.rotating_handler.VisionRotatingFileHandler",
+            "level": "DEBUG", "formatter": "fast", "filename": os.path.join(directory, "vision_log.log"),
+            "maxBytes": MAX_BYTES, "compress": "gzip", "encoding": "utf8"}},
+        "root": {"level": "DEBUG", "handlers": ["info_file_handler"]},
+        "vision": {"multiprocess": {"enabled": True, "address": os.path.join(directory, "vision_log.sock")}},
+    }
+    path = os.path.join(directory, "logger_config.yaml")
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return path
+
+
+def _produce(config_path: str, producer: int, records: int):
+    from DataVision.LoggerHandler.logger import VisionLogger
+    vision = VisionLogger(config_path)
+    for i in range(records):
+        vision.vision_logger("INFO", "producer %d record %d %s", producer, i, PAYLOAD)
+    # multiprocessing的子进程退出时不执行atexit, 需要自己刷新并关闭Handler
+    logging.shutdown()
+
+
+def _read_lines(directory: str) -> tuple:
+    """
+    :return: (按时间顺序排列的所有日志行(切分出的文件在前, 当前文件在最后), 切分出的文件名列表)
+    """
+    segments = []
+    for name in os.listdir(directory):
+        match = _SEGMENT.match(name)
+        if match is not None:
+            segments.append(((match.group(1), int(match.group(2) or 0)), name))
+    segments.sort()
+    lines = []
+    for _, name in segments:
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(os.path.join(directory, name), 'rt', encoding='utf8') as f:
+            lines.extend(f.read().splitlines())
+    with open(os.path.join(directory, "vision_log.log"), 'rt', encoding='utf8') as f:
+        lines.extend(f.read().splitlines())
+    return lines, [name for _, name in segments]
+
+
+def test_producers_share_rotating_file(tmp_path):
+    directory = str(tmp_path)
+    config_path = _write_config(directory)
+    aggregator = start_aggregator(config_path)
+    try:
+        # 工作进程继承测试进程中已经导入的模块
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=_produce, args=(config_path, producer, RECORDS))
+                   for producer in range(PRODUCERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+        assert [worker.exitcode for worker in workers] == [0] * PRODUCERS
+    finally:
+        # 工作进程都已断开, 汇总进程写完剩余记录、等待压缩完成后退出
+        aggregator.terminate()
+        aggregator.join(60)
+    assert aggregator.exitcode == 0
+
+    lines, segments = _read_lines(directory)
+    assert len(segments) > 1
+    assert all(name.endswith(".gz") for name in segments)
+    sequences = [[] for _ in range(PRODUCERS)]
+    for line in lines:
+        match = _LINE.match(line)
+        # 不同进程的记录不能在行内交错
+        assert match is not None and match.group(3) == PAYLOAD, line
+        sequences[int(match.group(1))].append(int(match.group(2)))
+    # 每个进程的记录不丢失、不重复, 并且保持写入顺序
+    for sequence in sequences:
+        assert sequence == list(range(RECORDS))
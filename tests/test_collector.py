@@ -0,0 +1,40 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_collector
+日志采集器(RingBufferHandler)的测试
+"""
+# Python内置库
+import logging
+
+# 项目内部库
+from DataVision.LoggerHandler.collector import RingBufferHandler
+
+
+def _fill(handler: RingBufferHandler, count: int):
+    for i in range(count):
+        handler.handle(logging.makeLogRecord({"name": "DataVision.test_collector", "msg": "msg %d", "args": (i,),
+                                              "levelno": logging.INFO, "levelname": "INFO"}))
+
+
+def test_snapshot_exactly_full():
+    handler = RingBufferHandler(capacity=3)
+    try:
+        _fill(handler, 3)
+        assert [entry.message for entry in handler.snapshot()] == ["msg 0", "msg 1", "msg 2"]
+        assert [entry.message for entry in handler.snapshot(limit=2)] == ["msg 1", "msg 2"]
+    finally:
+        handler.close()
+
+
+def test_snapshot_wraparound():
+    handler = RingBufferHandler(capacity=3)
+    try:
+        _fill(handler, 2)
+        assert [entry.message for entry in handler.snapshot()] == ["msg 0", "msg 1"]
+        _fill(handler, 7)
+        assert len(handler) == 3
+        assert [entry.message for entry in handler.snapshot()] == ["msg 4", "msg 5", "msg 6"]
+    finally:
+        handler.close()
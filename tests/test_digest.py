@@ -0,0 +1,35 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_digest
+积压报警合并(digest.pack)的测试
+"""
+# 项目内部库
+from DataVision.LoggerNotification.digest import pack, to_item
+
+
+def _kwargs(level: str, text: str, alert_key: str = None) -> dict:
+    return {"msg_type": "markdown", "title": text, "text": text, "level": level, "alert_key": alert_key}
+
+
+def test_warn_is_an_alias_of_warning():
+    items = [to_item(index, _kwargs(level, "alert {}".format(index)))
+             for index, level in enumerate(["INFO", "WARN", "ERROR", "warning", "FATAL"])]
+    assert [item.level for item in items] == ["INFO", "WARNING", "ERROR", "WARNING", "CRITICAL"]
+    (kwargs, owners), = pack(items)
+    # WARN与WARNING在同一节中, 排在ERROR之后、INFO之前
+    assert owners == [4, 2, 1, 3, 0]
+    assert kwargs["text"].count("#### WARNING") == 1
+    assert kwargs["level"] == "CRITICAL"
+
+
+def test_alert_key_from_most_severe_item():
+    items = [to_item("info", _kwargs("INFO", "disk almost full", "disk")),
+             to_item("error", _kwargs("ERROR", "database down", "db")),
+             to_item("critical", _kwargs("CRITICAL", "cluster down", "cluster")),
+             to_item("error2", _kwargs("ERROR", "database slow", "db2"))]
+    (kwargs, owners), = pack(items)
+    assert owners == ["critical", "error", "error2", "info"]
+    assert kwargs["alert_key"] == "cluster"
+    assert kwargs["title"].startswith("[CRITICAL]")
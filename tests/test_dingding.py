@@ -0,0 +1,60 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_dingding
+钉钉发送的测试: 模块级send在每个线程中使用自己的curio内核
+"""
+# Python内置库
+import threading
+
+# 项目内部库
+from DataVision.LoggerNotification import DingDingNotification
+
+
+class StubSender(object):
+    """
+    钉钉发送器的替身: 返回发送时所在的线程
+    """
+
+    def __init__(self) -> None:
+        self.closed = False
+
+    async def send_message(self, msg_type: str, alert_key: str = None, **msg_kwargs):
+        return threading.get_ident()
+
+    async def close(self):
+        self.closed = True
+
+
+def test_module_send_uses_a_kernel_per_thread(monkeypatch):
+    monkeypatch.setattr(DingDingNotification, "DingDingSender", StubSender)
+    monkeypatch.setattr(DingDingNotification, "_local", threading.local())
+    monkeypatch.setattr(DingDingNotification, "_default_senders", [])
+    results, errors = [], []
+    barrier = threading.Barrier(4)
+
+    def worker():
+        try:
+            barrier.wait()
+            for _ in range(3):
+                results.append((threading.get_ident(), DingDingNotification.send("text", content="x"),
+                                DingDingNotification._get_default_sender()))
+        except Exception as err:
+            errors.append(err)
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert errors == []
+    assert all(ident == sent for ident, sent, _ in results)
+    # 同一线程复用发送器和内核, 不同线程互不共用
+    defaults = {ident: default for ident, _, default in results}
+    assert len(results) == 12 and len(defaults) == 4
+    assert len({id(kernel) for _, kernel in defaults.values()}) == 4
+    assert all(default == defaults[ident] for ident, _, default in results)
+    senders = [sender for sender, _ in DingDingNotification._default_senders]
+    DingDingNotification._close_default_sender()
+    assert len(senders) == 4 and all(sender.closed for sender in senders)
+    assert DingDingNotification._default_senders == []
@@ -0,0 +1,415 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_failover
+熔断器状态变化(假时钟)和故障转移链的测试:
+钉钉、邮件和Redis分别使用本地的HTTP服务器、aiosmtpd和简单的RESP服务器代替
+"""
+# Python内置库
+import json
+import email
+import socket
+import threading
+import socketserver
+import http.server
+import asyncio
+import email.policy
+from typing import Callable
+
+# Python第三方库
+import pytest
+from aiosmtpd.controller import Controller
+
+# 项目内部库
+from DataVision.LoggerNotification.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from DataVision.LoggerNotification.failover import FailoverChain
+from DataVision.LoggerNotification.sinks import FileSink
+from DataVision.LoggerNotification.dispatcher import NotificationDispatcher
+from DataVision.LoggerNotification.http_session import AsyncHTTPSession
+from DataVision.LoggerNotification.DingDingNotification import MSG_TOO_LONG, PARAM_ERROR, DingDingError, \
+    DingDingSender
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _breaker(clock: Callable[[], float], transitions: list, **kwargs) -> CircuitBreaker:
+    options = dict(window=4, min_calls=4, failure_rate=0.5, open_seconds=10, slow_call_seconds=1)
+    options.update(kwargs)
+    return CircuitBreaker("dingding", clock=clock,
+                          listener=lambda name, previous, state: transitions.append((previous, state)), **options)
+
+
+def test_breaker_opens_on_failure_rate(clock):
+    transitions = []
+    breaker = _breaker(clock, transitions)
+    for success in (True, False, True):
+        breaker.record(success)
+    # 调用次数不足min_calls时不打开
+    assert breaker.state == CLOSED
+    breaker.record(False)
+    assert breaker.state == OPEN
+    assert breaker.allow() is False
+    clock.now = 4
+    assert breaker.retry_after() == 6
+    assert transitions == [(CLOSED, OPEN)]
+
+
+def test_breaker_opens_on_slow_calls(clock):
+    transitions = []
+    breaker = _breaker(clock, transitions)
+    for elapsed in (0.1, 2, 0.1, 3):
+        breaker.record(True, elapsed)
+    assert breaker.state == OPEN
+
+
+def test_breaker_half_open_probe_closes(clock):
+    transitions = []
+    breaker = _breaker(clock, transitions, half_open_calls=2)
+    for _ in range(4):
+        breaker.record(False)
+    clock.now = 10
+    assert breaker.state == HALF_OPEN
+    # 最多同时放行half_open_calls次探测
+    assert breaker.allow() is True
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+    breaker.record(True)
+    assert breaker.state == HALF_OPEN
+    breaker.record(True)
+    assert breaker.state == CLOSED
+    assert transitions == [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)]
+    # 关闭后重新统计, 之前的失败不再计入
+    for success in (True, True, True, False):
+        breaker.record(success)
+    assert breaker.state == CLOSED
+
+
+def test_breaker_half_open_failure_reopens(clock):
+    transitions = []
+    breaker = _breaker(clock, transitions)
+    for _ in range(4):
+        breaker.record(False)
+    clock.now = 10
+    assert breaker.allow() is True
+    breaker.record(False)
+    assert breaker.state == OPEN
+    clock.now = 15
+    # 重新打开后从这次打开开始计时
+    assert breaker.state == OPEN
+    clock.now = 20
+    assert breaker.state == HALF_OPEN
+    assert transitions == [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, OPEN), (OPEN, HALF_OPEN)]
+
+
+def test_breaker_release_returns_probe(clock):
+    transitions = []
+    breaker = _breaker(clock, transitions)
+    for _ in range(4):
+        breaker.record(False)
+    clock.now = 10
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+    # 探测调用被取消, 名额归还
+    breaker.release()
+    assert breaker.allow() is True
+
+
+def test_failover_chain_validation(tmp_path):
+    with pytest.raises(ValueError):
+        FailoverChain(chain=["dingding", "sms"])
+    with pytest.raises(ValueError):
+        FailoverChain(chain=["dingding", "dingding"])
+    with pytest.raises(ValueError):
+        FailoverChain(chain=["dingding", "email"])
+    with pytest.raises(ValueError):
+        FailoverChain(chain=["dingding", "file"])
+    chain = FailoverChain(chain=["dingding", "email", "file"], email=["ops@localhost"],
+                          file=str(tmp_path / "alerts.log"))
+    assert chain.route("dingding") == ["dingding", "email", "file"]
+    assert chain.route("email") == ["email", "file"]
+    assert chain.convert("dingding", "email", {"msg_type": "markdown", "title": "磁盘", "text": "磁盘已满",
+                                               "level": "ERROR"}) == \
+        {"target_list": ["ops@localhost"], "subject": "磁盘", "content": "磁盘已满", "level": "ERROR"}
+    assert chain.convert("dingding", "file", {"content": "x"}) == {"channel": "dingding", "kwargs": {"content": "x"}}
+
+
+class RobotHandler(http.server.BaseHTTPRequestHandler):
+    """
+    钉钉机器人接口的替身, 返回服务器上设置的errcode
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.bodies.append(json.loads(body.decode('utf-8')))
+        response = json.dumps({"errcode": self.server.errcode, "errmsg": "stand-in"}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class RobotServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, errcode: int = 0) -> None:
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), RobotHandler)
+        self.errcode = errcode
+        self.bodies = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RedisHandler(socketserver.StreamRequestHandler):
+    """
+    只支持RedisSink用到的LPUSH/LTRIM的RESP服务器
+    """
+
+    def _read_command(self) -> list:
+        line = self.rfile.readline()
+        if not line:
+            return []
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        lists = self.server.lists
+        while True:
+            args = self._read_command()
+            if not args:
+                return
+            command = args[0].upper()
+            if command == b"LPUSH":
+                values = lists.setdefault(args[1].decode('utf-8'), [])
+                values.insert(0, args[2].decode('utf-8'))
+                self.wfile.write(b":%d\r\n" % len(values))
+            elif command == b"LTRIM":
+                values = lists.setdefault(args[1].decode('utf-8'), [])
+                del values[int(args[3]) + 1:]
+                self.wfile.write(b"+OK\r\n")
+            else:
+                self.wfile.write(b"-ERR unknown command\r\n")
+
+
+class RedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), RedisHandler)
+        self.port = self.server_address[1]
+        self.lists = {}
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MailHandler(object):
+
+    def __init__(self) -> None:
+        self.subjects = []
+
+    async def handle_DATA(self, server, session, envelope):
+        message = email.message_from_bytes(envelope.content, policy=email.policy.default)
+        self.subjects.append(str(message["Subject"]))
+        return '250 OK'
+
+
+@pytest.fixture
+def mail():
+    handler = MailHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=_free_port())
+    controller.start()
+    try:
+        yield controller
+    finally:
+        controller.stop()
+
+
+@pytest.fixture
+def redis():
+    server = RedisServer()
+    try:
+        yield server
+    finally:
+        server.stop()
+
+
+def _config(tmp_path, robot_port: int, mail_port: int) -> str:
+    path = str(tmp_path / "notification.json")
+    with open(path, 'w') as f:
+        json.dump({"Email": {"mail_host": "127.0.0.1", "mail_port": str(mail_port), "mail_user": "vision",
+                             "mail_password": "", "mail_suffix": "localhost", "mail_use_tls": False},
+                   "DingDing": {"robot_url": "http://127.0.0.1:{}/robot/send?access_token=".format(robot_port),
+                                "robot_token": "stand-in"}}, f)
+    return path
+
+
+def _dispatcher(config_path: str, failover: FailoverChain, **kwargs) -> NotificationDispatcher:
+    kwargs.setdefault("retries", 0)
+    # 编号不同的报警指纹相同, 这里测试的是每一条的发送
+    kwargs.setdefault("suppress_window", 0)
+    return NotificationDispatcher(config_path=config_path, pack_dingding=False, concurrency=1, failover=failover,
+                                  **kwargs)
+
+
+def _send(dispatcher: NotificationDispatcher, count: int, tag: str) -> list:
+    futures = [dispatcher.submit_dingding("markdown", title="{} {}".format(tag, i), text="报警 {} {}".format(tag, i))
+               for i in range(count)]
+    return [future.result(10) for future in futures]
+
+
+def test_dingding_down_fails_over_to_email(tmp_path, mail, clock):
+    failover = FailoverChain(chain=["dingding", "email"], email=["ops@localhost"],
+                             breaker={"window": 2, "min_calls": 2, "open_seconds": 30, "clock": clock})
+    # 钉钉的端口上没有服务
+    dispatcher = _dispatcher(_config(tmp_path, _free_port(), mail.port), failover)
+    try:
+        _send(dispatcher, 5, "a")
+        metrics = dispatcher.metrics()
+    finally:
+        dispatcher.shutdown()
+    assert mail.handler.subjects == ["a {}".format(i) for i in range(5)]
+    assert metrics["breakers"] == {"dingding": OPEN, "email": CLOSED}
+    assert metrics["failovers"] == {"dingding->email": 5}
+    # 熔断之后的通知不再尝试钉钉
+    assert metrics["rejected"] == {"dingding": 3}
+    assert metrics["transitions"] == {"dingding:closed->open": 1}
+
+
+def test_email_down_too_fails_over_to_redis(tmp_path, redis):
+    failover = FailoverChain(chain=["dingding", "email", "redis", "file"], email=["ops@localhost"],
+                             redis={"port": redis.port, "key": "alerts", "max_length": 3},
+                             file=str(tmp_path / "alerts.log"), breaker={"window": 2, "min_calls": 2})
+    dispatcher = _dispatcher(_config(tmp_path, _free_port(), _free_port()), failover)
+    try:
+        _send(dispatcher, 4, "b")
+        metrics = dispatcher.metrics()
+    finally:
+        dispatcher.shutdown()
+    assert metrics["failovers"] == {"dingding->redis": 4}
+    # LTRIM只保留最新的max_length条
+    records = [json.loads(line) for line in redis.lists["alerts"]]
+    assert [record["message"]["title"] for record in records] == ["b 3", "b 2", "b 1"]
+    assert records[0]["channel"] == "dingding"
+    assert not (tmp_path / "alerts.log").exists()
+
+
+def test_everything_down_falls_back_to_file(tmp_path):
+    path = tmp_path / "alerts.log"
+    failover = FailoverChain(chain=["dingding", "email", "redis", "file"], email=["ops@localhost"],
+                             redis={"port": _free_port(), "timeout": 1}, file=str(path))
+    dispatcher = _dispatcher(_config(tmp_path, _free_port(), _free_port()), failover)
+    try:
+        _send(dispatcher, 2, "c")
+        metrics = dispatcher.metrics()
+    finally:
+        dispatcher.shutdown()
+    assert metrics["failovers"] == {"dingding->file": 2}
+    with open(str(path), encoding='utf-8') as f:
+        assert [json.loads(line)["message"]["title"] for line in f] == ["c 0", "c 1"]
+
+
+def test_file_sink_writes_off_the_loop(tmp_path, monkeypatch):
+    sink = FileSink(str(tmp_path / "alerts.log"))
+    threads = []
+    write = sink._write
+    monkeypatch.setattr(sink, "_write", lambda line: threads.append(threading.get_ident()) or write(line))
+
+    async def run() -> int:
+        await asyncio.gather(*[sink.send("dingding", {"title": "g {}".format(i)}) for i in range(3)])
+        return threading.get_ident()
+    loop_thread = asyncio.run(run())
+    assert len(threads) == 3 and loop_thread not in threads
+    with open(str(tmp_path / "alerts.log"), encoding='utf-8') as f:
+        assert sorted(json.loads(line)["message"]["title"] for line in f) == ["g 0", "g 1", "g 2"]
+
+
+def test_dingding_recovers_through_half_open(tmp_path, mail, clock):
+    robot_port = _free_port()
+    failover = FailoverChain(chain=["dingding", "email"], email=["ops@localhost"],
+                             breaker={"window": 2, "min_calls": 2, "open_seconds": 30, "clock": clock})
+    dispatcher = _dispatcher(_config(tmp_path, robot_port, mail.port), failover)
+    robot = None
+    try:
+        _send(dispatcher, 3, "d")
+        assert failover.breaker("dingding").state == OPEN
+        robot = RobotServer(robot_port)
+        # 熔断期间即使钉钉已经恢复也不发送
+        _send(dispatcher, 1, "e")
+        assert robot.bodies == []
+        clock.now = 30
+        _send(dispatcher, 2, "f")
+        metrics = dispatcher.metrics()
+    finally:
+        dispatcher.shutdown()
+        if robot is not None:
+            robot.stop()
+    assert [body["markdown"]["title"] for body in robot.bodies] == ["f 0", "f 1"]
+    assert mail.handler.subjects == ["d 0", "d 1", "d 2", "e 0"]
+    assert metrics["breakers"]["dingding"] == CLOSED
+    assert metrics["transitions"] == {"dingding:closed->open": 1, "dingding:open->half_open": 1,
+                                      "dingding:half_open->closed": 1}
+
+
+def test_content_error_is_not_a_channel_failure(tmp_path, mail):
+    robot = RobotServer(_free_port(), errcode=MSG_TOO_LONG)
+    failover = FailoverChain(chain=["dingding", "email"], email=["ops@localhost"],
+                             breaker={"window": 2, "min_calls": 2})
+    dispatcher = _dispatcher(_config(tmp_path, robot.server_address[1], mail.port), failover, retries=2,
+                             retry_delay=0.01)
+    try:
+        for i in range(4):
+            future = dispatcher.submit_dingding("markdown", title="g {}".format(i), text="太长的内容")
+            error = future.exception(10)
+            assert isinstance(error, DingDingError)
+            assert error.errcode == MSG_TOO_LONG
+        metrics = dispatcher.metrics()
+    finally:
+        dispatcher.shutdown()
+        robot.stop()
+    # 内容错误不重试、不转移到邮件, 也不打开熔断器
+    assert len(robot.bodies) == 4
+    assert mail.handler.subjects == []
+    assert metrics["breakers"] == {"dingding": CLOSED}
+    assert metrics["failovers"] == {}
+
+
+def test_send_message_raises_on_rejection(tmp_path):
+    robot = RobotServer(_free_port(), errcode=MSG_TOO_LONG)
+    sender = DingDingSender(config_path=_config(tmp_path, robot.server_address[1], _free_port()),
+                            sleep=asyncio.sleep, session=AsyncHTTPSession())
+
+    async def run() -> list:
+        errors = []
+        try:
+            for text in ("太长的内容", ""):
+                with pytest.raises(DingDingError) as raised:
+                    await sender.send_message("markdown", title="h", text=text)
+                errors.append(raised.value.errcode)
+        finally:
+            await sender.close()
+        return errors
+    try:
+        # 钉钉拒绝和本地格式错误都不会返回为真的错误码
+        assert asyncio.run(run()) == [MSG_TOO_LONG, PARAM_ERROR]
+    finally:
+        robot.stop()
+    assert len(robot.bodies) == 1
@@ -0,0 +1,91 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_http_session
+长连接会话(AsyncHTTPSession)的测试: 复用的连接在请求写入后被服务端关闭时, 只重发幂等的请求
+"""
+# Python内置库
+import asyncio
+
+# Python第三方库
+import pytest
+
+# 项目内部库
+from DataVision.LoggerNotification.http_session import AsyncHTTPSession
+
+
+class DroppingServer(object):
+    """
+    HTTP替身服务器: 收到第drop_at个请求后不应答直接关闭连接, 其余请求应答200并保持连接
+    """
+
+    def __init__(self, drop_at: int = 2) -> None:
+        self.drop_at = drop_at
+        self.requests = []
+        self.server = None
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return "http://127.0.0.1:{}/robot/send".format(self.server.sockets[0].getsockname()[1])
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+                self.requests.append(request_line.split(b" ", 1)[0].decode('latin-1'))
+                if len(self.requests) == self.drop_at:
+                    return
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: keep-alive\r\n\r\nok")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def _run(method: str, retry_non_idempotent: bool = False) -> tuple:
+    async def run() -> tuple:
+        server = DroppingServer()
+        url = await server.start()
+        session = AsyncHTTPSession(retry_non_idempotent=retry_non_idempotent)
+        try:
+            first = await session.request(method, url, data=b"{}")
+            try:
+                second = await session.request(method, url, data=b"{}")
+            except (ConnectionError, asyncio.IncompleteReadError) as err:
+                second = err
+        finally:
+            await session.close()
+            await server.stop()
+        return first.status_code, second, server.requests
+    return asyncio.run(run())
+
+
+def test_post_is_not_resent_after_write():
+    status, second, requests = _run("POST")
+    assert status == 200
+    # 服务端已经收到了第二个请求, 不能再发送一次
+    assert isinstance(second, (ConnectionError, asyncio.IncompleteReadError))
+    assert requests == ["POST", "POST"]
+
+
+@pytest.mark.parametrize("method, retry_non_idempotent", [("GET", False), ("POST", True)])
+def test_resend_on_new_connection(method, retry_non_idempotent):
+    status, second, requests = _run(method, retry_non_idempotent)
+    assert status == 200
+    assert second.status_code == 200
+    assert requests == [method] * 3
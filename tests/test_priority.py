@@ -0,0 +1,176 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_priority
+按级别分道排队(WaiterQueue/PrioritySemaphore)的测试, 以及分发器中严重的报警不排在积压的钉钉报警之后
+"""
+# Python内置库
+import time
+import random
+import asyncio
+
+# 项目内部库
+from DataVision.LoggerNotification.priority import LANES, PrioritySemaphore, Waiter, WaiterQueue, reserved_count
+from DataVision.LoggerNotification.rate_limiter import PriorityLimiter
+from DataVision.LoggerNotification.dispatcher import NotificationDispatcher
+
+
+def _reference_ahead(waiters: list, waiter: Waiter, now: float, aging_seconds: float, capacity: int,
+                     top_capacity: int) -> int:
+    """
+    原来的实现: 每次按当前的优先级重新排序后从头扫描
+    """
+    def rank(other: Waiter) -> tuple:
+        lane = other.lane
+        if aging_seconds > 0:
+            lane -= (now - other.enqueued) / aging_seconds
+        return lane, other.sequence
+    taken = 0
+    for other in sorted(waiters, key=rank):
+        if rank(other) >= rank(waiter):
+            break
+        if taken < (top_capacity if other.lane == 0 else capacity):
+            taken += 1
+    return taken
+
+
+def test_ahead_matches_full_sort():
+    generator = random.Random(7)
+    for _ in range(300):
+        aging_seconds = generator.choice([0, 5, 30])
+        queue = WaiterQueue(aging_seconds)
+        waiters = []
+        # 到达时间按到达顺序递增(单调时钟)
+        times = sorted(generator.uniform(0, 100) for _ in range(generator.randint(0, 60)))
+        for sequence, enqueued in enumerate(times):
+            waiter = Waiter(generator.randrange(len(LANES)), enqueued, sequence)
+            queue.append(waiter)
+            waiters.append(waiter)
+        for waiter in generator.sample(waiters, len(waiters) // 4):
+            queue.discard(waiter)
+            waiters.remove(waiter)
+        now = 100.0
+        mine = Waiter(generator.randrange(len(LANES)), now, 1000)
+        top_capacity = generator.randint(-2, 10)
+        capacity = top_capacity - generator.randint(0, 3)
+        assert queue.ahead(mine, capacity, top_capacity) == \
+            _reference_ahead(waiters, mine, now, aging_seconds, capacity, top_capacity)
+        if waiters:
+            assert queue.first() is min(waiters, key=lambda other: other.key(aging_seconds))
+
+
+def test_queue_discards_lazily():
+    queue = WaiterQueue(0)
+    waiters = [Waiter(3, 0.0, sequence) for sequence in range(200)]
+    for waiter in waiters:
+        queue.append(waiter)
+    for waiter in waiters[:150]:
+        queue.discard(waiter)
+        queue.discard(waiter)
+    assert len(queue) == 50
+    assert queue.first() is waiters[150]
+    # 出队的部分被整体删除
+    assert len(queue._lanes[3]) == 50
+
+
+def test_semaphore_order_reserved_and_aging():
+    now = [0.0]
+
+    async def run() -> list:
+        semaphore = PrioritySemaphore(5, reserved_share=0.2, aging_seconds=30, clock=lambda: now[0])
+        granted = []
+
+        async def job(name: str, level: str):
+            async with semaphore.hold(level):
+                granted.append(name)
+                await asyncio.sleep(0)
+        # 占满非保留的4个名额
+        for _ in range(4):
+            await semaphore.acquire("INFO")
+        tasks = [asyncio.ensure_future(job("info-old", "INFO"))]
+        await asyncio.sleep(0)
+        now[0] = 65.0
+        tasks += [asyncio.ensure_future(job("warning", "WARNING")), asyncio.ensure_future(job("debug", "DEBUG"))]
+        await asyncio.sleep(0)
+        # 保留名额直接给新到的CRITICAL
+        tasks.append(asyncio.ensure_future(job("critical", "CRITICAL")))
+        await asyncio.sleep(0)
+        assert granted == ["critical"]
+        for _ in range(4):
+            semaphore.release()
+        await asyncio.gather(*tasks)
+        assert semaphore.waiting == 0
+        return granted
+    # 等待了65秒的INFO提升了两级多, 排在刚到的WARNING之前
+    assert asyncio.run(run()) == ["critical", "info-old", "warning", "debug"]
+
+
+def test_semaphore_cancelled_waiter():
+    async def run():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+        waiter = asyncio.ensure_future(semaphore.acquire("ERROR"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert semaphore.waiting == 0
+        semaphore.release()
+        assert await semaphore.acquire() == 0.0
+    asyncio.run(run())
+
+
+def test_reserved_count():
+    assert reserved_count(1, 0.2) == 0
+    assert reserved_count(10, 0) == 0
+    # 名额少于5个时也为最高优先级保留1个
+    assert [reserved_count(capacity, 0.2) for capacity in (2, 3, 4, 5, 10, 20)] == [1, 1, 1, 1, 2, 4]
+    assert reserved_count(3, 0.9) == 2
+
+
+class LimitedSender(object):
+    """
+    钉钉发送器的替身: 每条消息按级别经过限流器后发送成功
+    """
+
+    def __init__(self, limiter: PriorityLimiter) -> None:
+        self.limiter = limiter
+        self.sent = []
+
+    async def send_message(self, level=None, **kwargs):
+        await self.limiter.acquire(level=level)
+        self.sent.append(level)
+        return True
+
+    async def close(self):
+        pass
+
+
+def _wait_for(predicate, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.005)
+    return predicate()
+
+
+def test_critical_alert_does_not_wait_behind_backlog_batch():
+    limiter = PriorityLimiter(limit=10, period=1.0, sleep=asyncio.sleep)
+    dispatcher = NotificationDispatcher(config_path="/nonexistent", dingding_sender=LimitedSender(limiter), retries=0,
+                                        suppress_window=0)
+    try:
+        # link消息不能合并, 同一批的24条INFO报警在限流器中排队(每个窗口只能发送8条)
+        infos = [dispatcher.submit_dingding("link", title="info {}".format(i), text="x", message_url="http://x",
+                                            level="INFO") for i in range(24)]
+        assert _wait_for(lambda: limiter.waiting > 0)
+        start = time.monotonic()
+        critical = dispatcher.submit_dingding("link", title="critical", text="x", message_url="http://x",
+                                              level="CRITICAL")
+        assert critical.result(5) is True
+        # 不等待积压的INFO报警发送完成, 直接使用限流器为CRITICAL保留的名额
+        assert time.monotonic() - start < 0.5
+        assert not all(future.done() for future in infos)
+        assert [future.result(5) for future in infos] == [True] * 24
+    finally:
+        dispatcher.shutdown()
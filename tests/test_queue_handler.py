@@ -0,0 +1,71 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_queue_handler
+队列模式的测试: 停止时哨兵被drop_oldest策略丢弃或者Handler卡住, stop_queue_logging也不会一直等待
+"""
+# Python内置库
+import time
+import logging
+import threading
+
+# 项目内部库
+from DataVision.LoggerHandler.queue_handler import start_queue_logging, stop_queue_logging
+
+
+class BlockingHandler(logging.Handler):
+    """
+    第一条日志在unblock之前一直阻塞, 记录写出的消息
+    """
+
+    def __init__(self) -> None:
+        logging.Handler.__init__(self)
+        self.started = threading.Event()
+        self.unblock = threading.Event()
+        self.messages = []
+
+    def emit(self, record: logging.LogRecord):
+        self.started.set()
+        self.unblock.wait(10)
+        self.messages.append(record.getMessage())
+
+
+def _start(name: str, handler: BlockingHandler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.addHandler(handler)
+    queue_handler = start_queue_logging(logger, {"maxsize": 2, "overflow": "drop_oldest"})
+    logger.error("r1")
+    assert handler.started.wait(5)
+    # 后台线程卡在r1上, 队列中还能放入一条
+    logger.error("r2")
+    return logger, queue_handler
+
+
+def test_stop_does_not_wait_for_dropped_sentinel():
+    handler = BlockingHandler()
+    logger, queue_handler = _start("test_queue_handler.dropped", handler)
+    stopper = threading.Thread(target=stop_queue_logging)
+    stopper.start()
+    time.sleep(0.1)
+    # 哨兵已经放入队列, 停止过程中还在写日志的线程按drop_oldest先丢弃r2, 再丢弃哨兵
+    for message in ("r3", "r4"):
+        queue_handler.handle(logging.makeLogRecord({"msg": message, "levelno": logging.ERROR}))
+    handler.unblock.set()
+    stopper.join(5)
+    assert stopper.is_alive() is False
+    assert handler.messages == ["r1", "r3", "r4"]
+    assert logger.handlers == [handler]
+    logger.removeHandler(handler)
+
+
+def test_stop_times_out_on_stuck_handler():
+    handler = BlockingHandler()
+    logger, _ = _start("test_queue_handler.stuck", handler)
+    start = time.monotonic()
+    stop_queue_logging(timeout=0.1)
+    assert time.monotonic() - start < 2
+    assert logger.handlers == [handler]
+    handler.unblock.set()
+    logger.removeHandler(handler)
@@ -0,0 +1,90 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_rate_limiter
+限流器(SlidingWindowLimiter/PriorityLimiter)的测试: 使用假时钟, 协程由测试逐步驱动, 不真正等待
+"""
+# 项目内部库
+from DataVision.LoggerNotification.rate_limiter import MIN_COOLDOWN, PriorityLimiter, SlidingWindowLimiter
+
+
+def step(coroutine):
+    """
+    :return: ("sleep", 等待的秒数) 或 ("done", 返回值)
+    """
+    try:
+        return "sleep", coroutine.send(None)
+    except StopIteration as stop:
+        return "done", stop.value
+
+
+def test_window_limit_and_fifo_order(clock):
+    limiter = SlidingWindowLimiter(limit=3, period=10, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        assert step(limiter.acquire()) == ("done", 0.0)
+    # 超出限制的消息按到达顺序预约, 第4条等到第1条滑出窗口
+    waiting = [limiter.acquire() for _ in range(4)]
+    assert [step(coroutine) for coroutine in waiting] == [("sleep", 10.0)] * 3 + [("sleep", 20.0)]
+    clock.now = 10.0
+    assert [step(coroutine)[0] for coroutine in waiting[:3]] == ["done"] * 3
+    assert limiter.reserve() == 10.0
+
+
+def test_penalize_shifts_waiting_reservations(clock):
+    limiter = SlidingWindowLimiter(limit=1, period=10, clock=clock, sleep=clock.sleep)
+    assert step(limiter.acquire()) == ("done", 0.0)
+    waiter = limiter.acquire()
+    assert step(waiter) == ("sleep", 10.0)
+    clock.now = 2.0
+    assert limiter.penalize() == MIN_COOLDOWN
+    # 醒来后发现预约被顺延了冷却时间
+    clock.now = 10.0
+    assert step(waiter) == ("sleep", MIN_COOLDOWN)
+    clock.now = 10.0 + MIN_COOLDOWN
+    assert step(waiter) == ("done", 10.0 + MIN_COOLDOWN)
+    # 新的消息不早于冷却结束
+    assert limiter.reserve() >= 2.0 + MIN_COOLDOWN - clock.now
+
+
+def test_cooldown_doubles_and_resets(clock):
+    limiter = SlidingWindowLimiter(limit=1, period=10, clock=clock, sleep=clock.sleep)
+    assert [limiter.penalize() for _ in range(3)] == [MIN_COOLDOWN, MIN_COOLDOWN * 2, MIN_COOLDOWN * 4]
+    limiter.reward()
+    assert limiter.penalize() == MIN_COOLDOWN
+
+
+def test_penalties_do_not_accumulate_state(clock):
+    limiter = SlidingWindowLimiter(limit=20, period=60, clock=clock, sleep=clock.sleep)
+    for i in range(1000):
+        clock.now = i * 1000.0
+        assert step(limiter.acquire())[0] == "done"
+        limiter.penalize()
+        limiter.reward()
+    assert not limiter._reservations
+    assert len(limiter._slots) <= limiter.limit
+
+
+def test_cancelled_waiter_is_forgotten(clock):
+    limiter = SlidingWindowLimiter(limit=1, period=10, clock=clock, sleep=clock.sleep)
+    step(limiter.acquire())
+    waiter = limiter.acquire()
+    step(waiter)
+    waiter.close()
+    assert not limiter._reservations
+
+
+def test_priority_limiter_critical_bypasses_backlog(clock):
+    limiter = PriorityLimiter(limit=5, period=10, clock=clock, sleep=clock.sleep, reserved_share=0.2,
+                              aging_seconds=0)
+    # INFO最多使用4个名额, 第5个保留给CRITICAL
+    for _ in range(4):
+        assert step(limiter.acquire(level="INFO"))[0] == "done"
+    backlog = [limiter.acquire(level="INFO") for _ in range(3)]
+    assert [step(coroutine)[0] for coroutine in backlog] == ["sleep"] * 3
+    assert step(limiter.acquire(level="CRITICAL"))[0] == "done"
+    assert limiter.waiting == 3
+    # 窗口滑过后积压的INFO按到达顺序放行
+    clock.now = 10.0
+    assert [step(coroutine)[0] for coroutine in backlog] == ["done"] * 3
+    assert limiter.waiting == 0
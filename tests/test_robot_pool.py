@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_robot_pool
+钉钉机器人池(RobotPool)的测试: 选择策略、跳过不健康的机器人, 以及同一地址的健康状态在机器人池之间共用
+"""
+# Python内置库
+import zlib
+
+# Python第三方库
+import pytest
+
+# 项目内部库
+from DataVision.LoggerNotification.robot_pool import BLACKLIST_SECONDS, FAILURE_SECONDS, MAX_FAILURES, RobotPool
+
+TOKENS = ["a", "b", "c"]
+
+
+def _pool(name: str, clock, strategy: str = "round_robin") -> RobotPool:
+    # 每个测试使用不同的地址, 不与其他测试共用健康状态和限流器
+    return RobotPool("https://oapi.example.com/{}?access_token=".format(name), TOKENS, strategy=strategy, clock=clock)
+
+
+def _tokens(robots: list) -> list:
+    return [robot.url.rsplit("=", 1)[1] for robot in robots]
+
+
+def test_round_robin(clock):
+    pool = _pool("round_robin", clock)
+    assert _tokens([pool.choose() for _ in range(4)]) == ["a", "b", "c", "a"]
+
+
+def test_least_recently_used(clock):
+    pool = _pool("least_recently_used", clock, strategy="least_recently_used")
+    for token in TOKENS:
+        clock.now += 1
+        assert _tokens([pool.choose()]) == [token]
+    clock.now += 1
+    assert _tokens([pool.choose()]) == ["a"]
+
+
+def test_hash_keeps_key_on_one_robot(clock):
+    pool = _pool("hash", clock, strategy="hash")
+    keys = ["disk", "db", "cluster", "queue"]
+    for key in keys:
+        expected = TOKENS[zlib.crc32(key.encode('utf-8')) % len(TOKENS)]
+        assert _tokens([pool.choose(key) for _ in range(3)]) == [expected] * 3
+    # 没有key时按round_robin处理
+    assert _tokens([pool.choose() for _ in range(3)]) == TOKENS
+
+
+@pytest.mark.parametrize("strategy", ["round_robin", "least_recently_used", "hash"])
+def test_unhealthy_robot_skipped(clock, strategy):
+    pool = _pool("skip_" + strategy, clock, strategy=strategy)
+    key = next(key for key in ("k{}".format(i) for i in range(100)) if zlib.crc32(key.encode('utf-8')) % 3 == 1)
+    pool.robots[1].mark_blacklisted()
+    assert pool.healthy_count() == 2
+    chosen = set()
+    for _ in range(6):
+        clock.now += 1
+        chosen.update(_tokens([pool.choose(key)]))
+    assert "b" not in chosen
+    # 拉黑到期后恢复
+    clock.now += BLACKLIST_SECONDS
+    assert pool.healthy_count() == 3
+
+
+def test_all_unhealthy_returns_earliest_recovery(clock):
+    pool = _pool("all_unhealthy", clock)
+    for seconds, robot in zip((30, 10, 20), pool.robots):
+        robot.mark_blacklisted(seconds)
+    robot = pool.choose()
+    assert _tokens([robot]) == ["b"]
+    assert robot.unavailable_for() == 10
+
+
+def test_health_shared_between_pools(clock):
+    first = _pool("shared", clock)
+    second = _pool("shared", clock)
+    # 另一个发送器中连续的网络错误摘除机器人, 本池也跳过它
+    for _ in range(MAX_FAILURES):
+        first.robots[0].mark_failure()
+    assert second.robots[0].is_healthy() is False
+    assert _tokens([second.choose() for _ in range(3)]) == ["b", "c", "b"]
+    assert first.robots[0].limiter is second.robots[0].limiter
+    clock.now += FAILURE_SECONDS
+    assert second.healthy_count() == 3
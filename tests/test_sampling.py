@@ -0,0 +1,201 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_sampling
+采样Filter(SamplingFilter)的测试
+"""
+# Python内置库
+import time
+import logging
+
+# Python第三方库
+import pytest
+
+# 项目内部库
+from DataVision.LoggerHandler.sampling import SUMMARY_ATTRIBUTE, SamplingFilter
+
+LOGGER_NAME = "DataVision.test_sampling"
+
+
+def _record(lineno: int, created: float = 1000.0, levelno: int = logging.ERROR, name: str = LOGGER_NAME,
+            msg: str = "连接失败: %s") -> logging.LogRecord:
+    record = logging.makeLogRecord({"name": name, "msg": msg, "args": ("timeout",),
+                                    "levelno": levelno, "levelname": logging.getLevelName(levelno),
+                                    "pathname": "/srv/app/worker.py", "filename": "worker.py", "lineno": lineno})
+    record.created = created
+    return record
+
+
+def test_evict_without_summaries():
+    # summary_interval为0时分组不会进入待汇总表, 淘汰有抑制条数的分组不能抛出KeyError
+    sampling_filter = SamplingFilter(first=1, every=0, max_keys=2, summary_interval=0)
+    results = [sampling_filter.filter(_record(lineno)) for lineno in (1, 1, 2, 3)]
+    assert results == [True, False, True, True]
+    assert sampling_filter.suppressed == 1
+    assert len(sampling_filter._states) == 2
+
+
+class _Capture(logging.Handler):
+
+    def __init__(self) -> None:
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(record)
+
+
+@pytest.fixture
+def captured():
+    """
+    汇总日志通过被抑制记录的logger输出, 在该logger上收集
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    handler = _Capture()
+    logger.addHandler(handler)
+    propagate, logger.propagate = logger.propagate, False
+    try:
+        yield handler.records
+    finally:
+        logger.removeHandler(handler)
+        logger.propagate = propagate
+
+
+def test_first_then_every():
+    sampling_filter = SamplingFilter(first=3, every=4, period=10, summary_interval=0)
+    kept = [i for i in range(20) if sampling_filter.filter(_record(1, created=1000.0 + i * 0.1))]
+    # 前3条, 之后每4条保留1条
+    assert kept == [0, 1, 2, 6, 10, 14, 18]
+    assert sampling_filter.suppressed == 13
+    # 新的周期重新计数
+    assert [sampling_filter.filter(_record(1, created=1010.0)) for _ in range(4)] == [True] * 3 + [False]
+
+
+def test_first_then_every_drop_all():
+    sampling_filter = SamplingFilter(first=2, every=0, period=10, summary_interval=0)
+    assert [sampling_filter.filter(_record(1)) for _ in range(5)] == [True, True, False, False, False]
+
+
+def test_token_bucket():
+    sampling_filter = SamplingFilter(policy="token_bucket", rate=2, burst=3, summary_interval=0)
+    # 突发最多burst条
+    assert [sampling_filter.filter(_record(1, created=1000.0)) for _ in range(5)] == [True] * 3 + [False] * 2
+    # 每秒补充rate个令牌
+    assert [sampling_filter.filter(_record(1, created=1001.0)) for _ in range(3)] == [True, True, False]
+    # 令牌最多积攒burst个
+    assert [sampling_filter.filter(_record(1, created=1100.0)) for _ in range(4)] == [True] * 3 + [False]
+
+
+def test_key_grouping():
+    by_callsite = SamplingFilter(first=1, every=0, summary_interval=0)
+    assert [by_callsite.filter(_record(lineno)) for lineno in (1, 2, 1, 2)] == [True, True, False, False]
+    by_template = SamplingFilter(key="template", first=1, every=0, summary_interval=0)
+    assert [by_template.filter(_record(lineno)) for lineno in (1, 2)] == [True, False]
+    assert by_template.filter(_record(1, msg="超时: %s")) is True
+    combined = SamplingFilter(key=["logger", "level"], first=1, every=0, summary_interval=0)
+    records = [_record(1), _record(2), _record(1, levelno=logging.WARNING), _record(1, name="DataVision.other")]
+    assert [combined.filter(record) for record in records] == [True, False, True, True]
+
+
+def test_levels_and_loggers():
+    sampling_filter = SamplingFilter(first=1, every=0, levels=["ERROR"], loggers=["DataVision.test_sampling"],
+                                     summary_interval=0)
+    assert [sampling_filter.filter(_record(1)) for _ in range(2)] == [True, False]
+    # 不在levels中的等级和不在loggers中的logger不采样
+    assert all(sampling_filter.filter(_record(1, levelno=logging.WARNING)) for _ in range(3))
+    assert all(sampling_filter.filter(_record(1, name="DataVision.other")) for _ in range(3))
+    # 子logger按名称前缀匹配, 名称只是相同开头的logger不匹配
+    assert sampling_filter.filter(_record(2, name="DataVision.test_sampling.child")) is True
+    assert sampling_filter.filter(_record(2, name="DataVision.test_sampling.child")) is False
+    assert all(sampling_filter.filter(_record(3, name="DataVision.test_sampling_other")) for _ in range(3))
+
+
+def test_invalid_options():
+    with pytest.raises(ValueError):
+        SamplingFilter(key="thread")
+    with pytest.raises(ValueError):
+        SamplingFilter(policy="random")
+    with pytest.raises(ValueError):
+        SamplingFilter(max_keys=0)
+
+
+def test_max_keys_bounds_states():
+    sampling_filter = SamplingFilter(first=1, every=0, max_keys=3, summary_interval=0)
+    for lineno in range(100):
+        sampling_filter.filter(_record(lineno))
+    assert len(sampling_filter._states) == 3
+    # 最近出现的分组保留在表中, 被淘汰的分组重新开始计数
+    sampling_filter.filter(_record(97))
+    assert sampling_filter.filter(_record(99)) is False
+    assert sampling_filter.filter(_record(0)) is True
+
+
+def test_summary_emitted_after_interval(captured):
+    sampling_filter = SamplingFilter(first=1, every=0, period=60, summary_interval=10)
+    for i in range(5):
+        sampling_filter.filter(_record(1, created=1000.0 + i * 0.5))
+    assert captured == []
+    # 下一条日志到来时输出汇总
+    sampling_filter.filter(_record(2, created=1010.0))
+    assert len(captured) == 1
+    summary = captured[0]
+    assert summary.__dict__[SUMMARY_ATTRIBUTE] is True
+    assert summary.levelno == logging.ERROR
+    assert summary.getMessage() == "[采样] 9.5秒内抑制了4条日志: worker.py:1 '连接失败: %s'"
+    # 汇总日志本身不被采样
+    assert sampling_filter.filter(summary) is True
+    # 汇总后清零, 没有新的抑制时不再输出
+    sampling_filter.filter(_record(3, created=1021.0))
+    assert len(captured) == 1
+
+
+def test_summary_keeps_evicted_groups(captured):
+    sampling_filter = SamplingFilter(first=1, every=0, max_keys=2, summary_interval=10)
+    for lineno in (1, 1, 1, 2, 3, 4):
+        sampling_filter.filter(_record(lineno, created=1000.0))
+    # 第1行的分组已经被淘汰, 抑制的条数仍然会输出
+    assert 1 not in [key[1] for key in sampling_filter._states]
+    sampling_filter.flush_summaries()
+    messages = sorted(record.getMessage().split("秒内", 1)[1] for record in captured)
+    assert messages == ["抑制了2条日志: worker.py:1 '连接失败: %s'"]
+
+
+def test_summary_merges_overflowing_groups(captured):
+    sampling_filter = SamplingFilter(first=1, every=0, max_keys=1, summary_interval=10)
+    for lineno in range(1, 11):
+        for _ in range(2):
+            sampling_filter.filter(_record(lineno, created=1000.0))
+    # 待汇总表最多保存2*max_keys个被淘汰的分组, 其余合并为一条(另外还有表中的max_keys个分组)
+    assert len(sampling_filter._dirty) <= 2 + 1 + 1
+    sampling_filter.flush_summaries()
+    counts = {}
+    for record in captured:
+        message = record.getMessage()
+        counts[message.split(": ", 1)[1]] = int(message.split("抑制了", 1)[1].split("条", 1)[0])
+    assert sum(counts.values()) == 10
+    assert counts["(其他分组)"] == 7
+
+
+def test_summary_emitted_by_timer_without_later_logs(captured):
+    sampling_filter = SamplingFilter(first=1, every=0, period=60, summary_interval=0.05)
+    now = time.time()
+    for i in range(3):
+        sampling_filter.filter(_record(1, created=now + i * 0.001))
+    # 之后没有日志到来, 由后台定时器输出汇总
+    deadline = time.monotonic() + 5
+    while not captured and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(captured) == 1
+    assert captured[0].getMessage().endswith("抑制了2条日志: worker.py:1 '连接失败: %s'")
+    assert (captured[0].pathname, captured[0].lineno) == ("/srv/app/worker.py", 1)
+
+
+def test_summary_sample_does_not_keep_record():
+    sampling_filter = SamplingFilter(first=1, every=0, period=60, summary_interval=0)
+    record = _record(1)
+    record.exc_info = (ValueError, ValueError("large"), None)
+    sampling_filter.filter(_record(1))
+    sampling_filter.filter(record)
+    state = sampling_filter._states[("/srv/app/worker.py", 1)]
+    assert state.sample == ("/srv/app/worker.py", "worker.py", 1, None, "连接失败: %s")
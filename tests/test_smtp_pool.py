@@ -0,0 +1,259 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_smtp_pool
+SMTP连接池(SMTPConnectionPool)和流式附件的测试, 使用本地的aiosmtpd替身服务器
+"""
+# Python内置库
+import io
+import os
+import json
+import email
+import socket
+import asyncio
+import threading
+import email.policy
+from email.mime.text import MIMEText
+
+# Python第三方库
+import pytest
+import aiosmtplib
+from aiosmtpd.controller import Controller
+
+# 项目内部库
+from DataVision.LoggerNotification.smtp_pool import SMTPConnectionPool
+from DataVision.LoggerNotification.EmailNotification import EmailSender, make_streaming_message
+
+# 被替身服务器拒绝的收件人
+REJECTED = "nobody@localhost"
+
+
+class RecordingHandler(object):
+    """
+    记录连接数、NOOP次数和收到的邮件
+    """
+
+    def __init__(self) -> None:
+        self.connections = 0
+        self.noops = 0
+        self.subjects = []
+        self.contents = []
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.connections += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_NOOP(self, server, session, envelope, arg):
+        self.noops += 1
+        return "250 OK"
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address == REJECTED:
+            return "550 mailbox unavailable"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.contents.append(envelope.content)
+        self.subjects.append(envelope.content.decode("utf-8").split("Subject: ", 1)[1].split("\n", 1)[0].strip())
+        return "250 OK"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StandInServer(object):
+    """
+    可以重启的aiosmtpd服务器(Controller停止后不能再次启动, 重启时在同一端口上新建)
+    """
+
+    def __init__(self) -> None:
+        self.handler = RecordingHandler()
+        self.hostname = "127.0.0.1"
+        self.port = _free_port()
+        self._controller = None
+
+    def start(self):
+        self._controller = Controller(self.handler, hostname=self.hostname, port=self.port)
+        self._controller.start()
+
+    def stop(self):
+        if self._controller is not None:
+            self._controller.stop()
+            self._controller = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+
+@pytest.fixture
+def server():
+    stand_in = StandInServer()
+    stand_in.start()
+    try:
+        yield stand_in
+    finally:
+        stand_in.stop()
+
+
+def _message(index: int, to: str = "alert@localhost") -> MIMEText:
+    message = MIMEText("body {}".format(index))
+    message['From'] = "vision@localhost"
+    message['To'] = to
+    message['Subject'] = "alert {}".format(index)
+    return message
+
+
+def _pool(stand_in: StandInServer, **kwargs) -> SMTPConnectionPool:
+    return SMTPConnectionPool(stand_in.hostname, stand_in.port, use_tls=False, **kwargs)
+
+
+def test_connects_lazily_and_reuses_connection(server):
+    async def run():
+        async with _pool(server, pool_size=2) as pool:
+            assert server.handler.connections == 0
+            for index in range(10):
+                await pool.send_message(_message(index))
+            assert pool.idle_size == 1
+    asyncio.run(run())
+    assert server.handler.connections == 1
+    assert server.handler.subjects == ["alert {}".format(index) for index in range(10)]
+
+
+def test_concurrency_limited_by_pool_size(server):
+    async def run():
+        pool = _pool(server, pool_size=3)
+        in_use = peak = 0
+
+        async def send(index: int):
+            nonlocal in_use, peak
+            async with pool.connection() as smtp:
+                in_use += 1
+                peak = max(peak, in_use)
+                await smtp.send_message(_message(index))
+                await asyncio.sleep(0.01)
+                in_use -= 1
+        await asyncio.gather(*[send(index) for index in range(30)])
+        await pool.close()
+        return peak
+    assert asyncio.run(run()) == 3
+    assert server.handler.connections == 3
+    assert len(server.handler.subjects) == 30
+
+
+def test_idle_connection_checked_with_noop(server):
+    async def run():
+        async with _pool(server, idle_check=0) as pool:
+            await pool.send_message(_message(0))
+            await pool.send_message(_message(1))
+    asyncio.run(run())
+    assert server.handler.noops == 1
+    assert server.handler.connections == 1
+
+
+def test_reconnects_after_server_restart(server):
+    async def run():
+        pool = _pool(server, idle_check=0)
+        await pool.send_message(_message(0))
+        # 服务器重启, 池中的空闲连接已经断开
+        server.restart()
+        await pool.send_message(_message(1))
+        await pool.close()
+    asyncio.run(run())
+    assert server.handler.connections == 2
+    assert server.handler.subjects == ["alert 0", "alert 1"]
+
+
+def test_rejected_recipient_keeps_connection(server):
+    async def run():
+        async with _pool(server) as pool:
+            with pytest.raises(aiosmtplib.SMTPRecipientsRefused):
+                await pool.send_message(_message(0, to=REJECTED))
+            assert pool.idle_size == 1
+            await pool.send_message(_message(1))
+    asyncio.run(run())
+    assert server.handler.connections == 1
+    assert server.handler.subjects == ["alert 1"]
+
+
+def test_closed_pool_rejects_acquire(server):
+    async def run():
+        pool = _pool(server)
+        await pool.send_message(_message(0))
+        await pool.close()
+        assert pool.idle_size == 0
+        with pytest.raises(RuntimeError):
+            await pool.acquire()
+    asyncio.run(run())
+
+
+def test_pool_size_must_be_positive():
+    with pytest.raises(ValueError):
+        SMTPConnectionPool("127.0.0.1", 25, pool_size=0)
+
+
+class ThreadRecordingFile(io.BytesIO):
+    """
+    记录read在哪些线程中调用的文件对象
+    """
+
+    def __init__(self, data: bytes) -> None:
+        io.BytesIO.__init__(self, data)
+        self.threads = set()
+
+    def read(self, size: int = -1) -> bytes:
+        self.threads.add(threading.get_ident())
+        return io.BytesIO.read(self, size)
+
+
+def test_streams_file_attachments_off_the_loop(server, tmp_path):
+    data = os.urandom(300 * 1024)
+    path = tmp_path / "big.bin"
+    path.write_bytes(data)
+    source = ThreadRecordingFile(b"vision log\n" * 20000)
+
+    async def run() -> int:
+        message = make_streaming_message(sender="vision@localhost", targets="alert@localhost", subject="files",
+                                         content="附件", attachments={"big.bin": path, "log.bin": source})
+        async with _pool(server) as pool:
+            await pool.send_message(message)
+        return threading.get_ident()
+    loop_thread = asyncio.run(run())
+    parsed = email.message_from_bytes(server.handler.contents[0], policy=email.policy.default)
+    attachments = {part.get_filename(): part.get_content() for part in parsed.iter_attachments()}
+    assert attachments == {"big.bin": data, "log.bin": source.getvalue()}
+    # 文件在线程池中读取, 不在事件循环所在的线程中
+    assert source.threads and loop_thread not in source.threads
+
+
+def test_send_many_raises_spec_iterator_error(server, tmp_path):
+    config_path = str(tmp_path / "notification.json")
+    with open(config_path, 'w') as f:
+        json.dump({"Email": {"mail_host": server.hostname, "mail_port": server.port, "mail_user": "vision",
+                             "mail_password": "", "mail_suffix": "localhost", "mail_use_tls": False}}, f)
+
+    def specs():
+        for i in range(2):
+            yield {"target_list": "alert@localhost", "subject": "bulk {}".format(i), "content": "body"}
+        raise ValueError("broken spec source")
+
+    async def run() -> list:
+        sender = EmailSender(config_path=config_path, pool_size=2)
+        results = []
+        try:
+            with pytest.raises(ValueError, match="broken spec source"):
+                async for result in sender.send_many(specs(), concurrency=1):
+                    results.append(result)
+        finally:
+            await sender.pool.close()
+        return results
+    results = asyncio.run(run())
+    # 异常之前读取的邮件已经发送, 异常不会被吞掉
+    assert sorted(result.index for result in results) == [0, 1]
+    assert len(server.handler.subjects) == 2
@@ -0,0 +1,230 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_spool
+通知spool的测试: 崩溃后恢复(复制落盘后的分段文件模拟进程崩溃)、不完整的记录、死信和压缩,
+以及分发器取出任务时写入spool、重启后重新发送
+"""
+# Python内置库
+import os
+import json
+import time
+import shutil
+import asyncio
+
+# 项目内部库
+from DataVision.LoggerNotification.spool import DEAD_LETTER_FILE, Spool
+from DataVision.LoggerNotification.dispatcher import NotificationDispatcher
+
+
+def _crash_copy(spool: Spool, directory: str) -> str:
+    """
+    模拟进程崩溃: 记录落盘后复制分段文件(不经过close), 再关闭原来的spool
+    :return: 复制后的目录
+    """
+    spool.sync()
+    target = str(directory) + "-crashed"
+    shutil.copytree(spool.directory, target)
+    spool.close()
+    return target
+
+
+def _segments(directory: str) -> list:
+    return sorted(name for name in os.listdir(directory) if name.startswith("spool-"))
+
+
+def _wait_for(predicate, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_recover_unacked_after_crash(tmp_path):
+    spool = Spool(str(tmp_path / "spool"))
+    ids = [spool.enqueue("dingding", {"msg_type": "text", "content": "alert {}".format(i)}) for i in range(5)]
+    spool.ack(ids[1])
+    spool.ack(ids[3])
+    recovered = Spool(_crash_copy(spool, tmp_path))
+    try:
+        assert [entry.id for entry in recovered.pending()] == [ids[0], ids[2], ids[4]]
+        assert recovered.get(ids[2]).kwargs == {"msg_type": "text", "content": "alert 2"}
+        assert recovered.get(ids[1]) is None
+    finally:
+        recovered.close()
+
+
+def test_recover_drops_torn_tail(tmp_path):
+    spool = Spool(str(tmp_path / "spool"))
+    kept = spool.enqueue("email", {"subject": "kept"})
+    directory = _crash_copy(spool, tmp_path)
+    path = os.path.join(directory, _segments(directory)[-1])
+    with open(path, 'rb') as f:
+        data = f.read()
+    # 崩溃时写了一半的第二条记录
+    with open(path, 'ab') as f:
+        f.write(data[:len(data) // 2])
+    recovered = Spool(directory)
+    try:
+        assert [entry.id for entry in recovered.pending()] == [kept]
+        # 恢复后追加写入的记录在下一个分段中, 不受损坏的尾部影响
+        added = recovered.enqueue("email", {"subject": "added"})
+    finally:
+        recovered.close()
+    recovered = Spool(directory)
+    try:
+        assert [entry.id for entry in recovered.pending()] == [kept, added]
+    finally:
+        recovered.close()
+
+
+def test_garbled_record_stops_recovery_of_segment(tmp_path):
+    spool = Spool(str(tmp_path / "spool"))
+    first = spool.enqueue("email", {"subject": "first"})
+    spool.enqueue("email", {"subject": "second"})
+    directory = _crash_copy(spool, tmp_path)
+    path = os.path.join(directory, _segments(directory)[-1])
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    # 改坏最后一条记录的内容, CRC不再匹配
+    data[-2] ^= 0xff
+    with open(path, 'wb') as f:
+        f.write(bytes(data))
+    recovered = Spool(directory)
+    try:
+        assert [entry.id for entry in recovered.pending()] == [first]
+    finally:
+        recovered.close()
+
+
+def test_close_removes_segments_when_all_acked(tmp_path):
+    directory = str(tmp_path / "spool")
+    spool = Spool(directory)
+    spool.ack(spool.enqueue("email", {"subject": "done"}))
+    spool.close()
+    assert _segments(directory) == []
+
+
+def test_dead_letter(tmp_path):
+    directory = str(tmp_path / "spool")
+    spool = Spool(directory)
+    entry_id = spool.enqueue("dingding", {"msg_type": "text", "content": "bad"})
+    spool.dead_letter(entry_id, "ValueError: bad content")
+    assert len(spool) == 0
+    spool.close()
+    with open(os.path.join(directory, DEAD_LETTER_FILE), encoding='utf-8') as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 1
+    assert lines[0]["id"] == entry_id
+    assert lines[0]["kwargs"] == {"msg_type": "text", "content": "bad"}
+    assert lines[0]["reason"] == "ValueError: bad content"
+    # 死信不参与恢复
+    recovered = Spool(directory)
+    try:
+        assert recovered.pending() == []
+    finally:
+        recovered.close()
+
+
+def test_compact_moves_old_entries(tmp_path):
+    directory = str(tmp_path / "spool")
+    spool = Spool(directory, segment_bytes=256)
+    old = spool.enqueue("email", {"subject": "old"})
+    for i in range(20):
+        spool.ack(spool.enqueue("email", {"subject": "filler {}".format(i)}))
+    # 最旧的分段中还有未确认的通知, 之后的分段都不能删除
+    assert len(_segments(directory)) > 2
+    spool.compact()
+    assert len(_segments(directory)) == 1
+    recovered = Spool(_crash_copy(spool, tmp_path))
+    try:
+        assert [entry.id for entry in recovered.pending()] == [old]
+    finally:
+        recovered.close()
+
+
+class FakeSender(object):
+    """
+    钉钉发送器的替身: mode为block时一直等待, error时抛出指定的异常, 否则发送成功
+    """
+
+    def __init__(self, mode: str = "ok", error: Exception = None) -> None:
+        self.mode = mode
+        self.error = error
+        self.sent = []
+
+    async def send_message(self, **kwargs):
+        self.sent.append(kwargs)
+        if self.mode == "block":
+            await asyncio.sleep(60)
+        if self.mode == "error":
+            raise self.error
+        return True
+
+    async def close(self):
+        pass
+
+
+def _dispatcher(sender: FakeSender, spool_dir: str, **kwargs) -> NotificationDispatcher:
+    return NotificationDispatcher(config_path="/nonexistent", dingding_sender=sender, pack_dingding=False,
+                                  spool_dir=spool_dir, retry_delay=0.01, replay_base_delay=0.01,
+                                  replay_max_delay=0.02, suppress_window=0, **kwargs)
+
+
+def test_spooled_before_send_slot_and_replayed_after_crash(tmp_path):
+    blocked = FakeSender("block")
+    dispatcher = _dispatcher(blocked, str(tmp_path / "spool"), concurrency=1, retries=0)
+    for i in range(4):
+        dispatcher.submit_dingding("text", content="alert {}".format(i))
+    # 只有一个发送名额, 其余三个还在等待时就已经写入spool
+    assert _wait_for(lambda: len(dispatcher.spool) == 4)
+    assert len(blocked.sent) == 1
+    directory = str(tmp_path / "spool") + "-crashed"
+    dispatcher.spool.sync()
+    shutil.copytree(dispatcher.spool.directory, directory)
+    dispatcher.shutdown(wait=False)
+
+    sender = FakeSender()
+    restarted = _dispatcher(sender, directory)
+    try:
+        assert _wait_for(lambda: len(restarted.spool) == 0)
+        assert sorted(kwargs["content"] for kwargs in sender.sent) == ["alert {}".format(i) for i in range(4)]
+    finally:
+        restarted.shutdown()
+    assert _segments(directory) == []
+
+
+def test_permanent_error_goes_to_dead_letter(tmp_path):
+    directory = str(tmp_path / "spool")
+    sender = FakeSender("error", ValueError("bad content"))
+    dispatcher = _dispatcher(sender, directory, retries=3)
+    try:
+        future = dispatcher.submit_dingding("text", content="x")
+        assert isinstance(future.exception(5), ValueError)
+        assert _wait_for(lambda: len(dispatcher.spool) == 0)
+        # 永久错误不重试也不重新发送
+        assert len(sender.sent) == 1
+    finally:
+        dispatcher.shutdown()
+    with open(os.path.join(directory, DEAD_LETTER_FILE), encoding='utf-8') as f:
+        assert json.loads(f.readline())["reason"] == "ValueError: bad content"
+
+
+def test_replay_gives_up_after_max_attempts(tmp_path):
+    directory = str(tmp_path / "spool")
+    sender = FakeSender("error", OSError("down"))
+    dispatcher = _dispatcher(sender, directory, retries=0, replay_max_attempts=2)
+    try:
+        future = dispatcher.submit_dingding("text", content="y")
+        assert isinstance(future.exception(5), OSError)
+        # 第一次发送 + 两次重新发送
+        assert _wait_for(lambda: len(sender.sent) == 3 and len(dispatcher.spool) == 0)
+        time.sleep(0.1)
+        assert len(sender.sent) == 3
+    finally:
+        dispatcher.shutdown()
+    with open(os.path.join(directory, DEAD_LETTER_FILE), encoding='utf-8') as f:
+        assert json.loads(f.readline())["reason"] == "OSError: down"
@@ -0,0 +1,124 @@
+# -*- coding: UTF-8 -*-
+"""
+Created on 2018年11月15日
+@author: Leo
+@file: test_suppression
+重复报警抑制(AlertSuppressor)的测试, 以及分发器对直接提交的通知的抑制和汇总
+"""
+# Python内置库
+import time
+import logging
+
+# 项目内部库
+from DataVision.LoggerNotification.suppression import OTHER_KEY, AlertSuppressor
+from DataVision.LoggerNotification.dispatcher import NotificationDispatcher
+from DataVision.LoggerNotification.notification_handler import NotificationHandler
+
+
+def test_window_and_summary(clock):
+    suppressor = AlertSuppressor(window=10, clock=clock)
+    assert suppressor.offer("a") is None
+    suppressor.set_sample("a", "first")
+    assert suppressor.offer("a") == 10
+    clock.now = 4
+    assert suppressor.offer("a") == 6
+    assert suppressor.expire() == []
+    clock.now = 10
+    summaries = suppressor.expire()
+    assert [(summary.key, summary.count, summary.sample) for summary in summaries] == [("a", 2, "first")]
+    # 有汇总时开始下一个窗口, 下一个窗口内没有报警时删除指纹
+    clock.now = 20
+    assert suppressor.expire() == []
+    assert len(suppressor) == 0
+
+
+def test_memory_bounded_by_max_entries(clock):
+    # 大量只出现一次的指纹: 到期队列和待取走的汇总都不超过max_entries的常数倍
+    suppressor = AlertSuppressor(window=60, max_entries=10, clock=clock)
+    for i in range(10000):
+        clock.now = i * 0.001
+        suppressor.offer(i)
+        suppressor.offer(i)
+    assert len(suppressor) == 10
+    assert len(suppressor._deadlines) <= 2 * 10
+    assert len(suppressor._summaries) <= 10 + 1
+    summaries = suppressor.drain()
+    assert len(summaries) <= 10 + 1
+    assert sum(summary.count for summary in summaries) == 10000
+
+
+def test_evicted_summaries_merged_per_key(clock):
+    suppressor = AlertSuppressor(window=60, max_entries=2, clock=clock)
+    for _ in range(3):
+        for key in ("a", "b", "c"):
+            suppressor.offer(key)
+            suppressor.offer(key)
+    # 同一指纹多次被淘汰时合并计数, 超过max_entries个指纹的部分合并为OTHER_KEY
+    summaries = {summary.key: summary.count for summary in suppressor.drain()}
+    assert summaries == {"a": 3, "b": 3, OTHER_KEY: 3}
+
+
+class RecordingSender(object):
+    """
+    钉钉发送器的替身: 记录发送的参数
+    """
+
+    def __init__(self) -> None:
+        self.sent = []
+
+    async def send_message(self, **kwargs):
+        self.sent.append(kwargs)
+        return True
+
+    async def close(self):
+        pass
+
+
+def _dispatcher(sender: RecordingSender, **kwargs) -> NotificationDispatcher:
+    return NotificationDispatcher(config_path="/nonexistent", dingding_sender=sender, pack_dingding=False, **kwargs)
+
+
+def test_dispatcher_suppresses_direct_submits():
+    sender = RecordingSender()
+    dispatcher = _dispatcher(sender, suppress_window=0.2)
+    try:
+        futures = [dispatcher.submit_dingding("text", content="磁盘使用率{}%".format(90 + i)) for i in range(3)]
+        assert [future.result(5) for future in futures] == [True, None, None]
+        deadline = time.monotonic() + 5
+        while len(sender.sent) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        dispatcher.shutdown()
+    # 窗口结束时在第一条通知的正文后附加被抑制的次数
+    assert [kwargs["content"] for kwargs in sender.sent] == ["磁盘使用率90%", "磁盘使用率90%\n\n(最近0.2秒内又出现了2次)"]
+
+
+def test_dispatcher_sends_merged_summaries_on_shutdown():
+    sender = RecordingSender()
+    dispatcher = _dispatcher(sender, suppress_max_entries=1)
+    for name in ("alpha", "beta", "gamma"):
+        dispatcher.submit_dingding("markdown", title=name, text="{} down".format(name))
+        dispatcher.submit_dingding("markdown", title=name, text="{} down".format(name))
+    dispatcher.shutdown()
+    texts = sorted(kwargs.get("text") or kwargs["content"] for kwargs in sender.sent)
+    # alpha的汇总带有样例, 之后被淘汰的beta和还在窗口中的gamma合并为一条没有样例的通用汇总
+    assert texts == ["DataVision报警汇总: 最近60秒内还有2条重复通知被抑制",
+                     "alpha down", "alpha down\n\n(最近60秒内又出现了1次)", "beta down", "gamma down"]
+
+
+def test_handler_alerts_suppressed_by_dispatcher():
+    sender = RecordingSender()
+    dispatcher = _dispatcher(sender)
+    handler = NotificationHandler(dispatcher=dispatcher)
+    logger = logging.getLogger("test_suppression.handler")
+    logger.addHandler(handler)
+    try:
+        for i in range(3):
+            logger.error("任务%s执行失败", i)
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+        dispatcher.shutdown()
+    assert len(sender.sent) == 2
+    assert "任务0执行失败" in sender.sent[0]["text"]
+    assert sender.sent[1]["text"].endswith("(最近60秒内又出现了2次)")